@@ -0,0 +1,117 @@
+"""
+join 认证基准测试
+
+    python -m benchmarks.bench_auth
+    python -m benchmarks.bench_auth --joins 10000 --store-latency-ms 1 --json
+
+--joins 个客户端（各自不同的 IP）依次 join，比较：
+    off    不认证，用户名照单全收
+    cold   认证，每个令牌第一次出现：HMAC 校验 + 查用户库
+    warm   同一批令牌断线后重新 join（重连风暴），全部命中令牌缓存
+    flood  一个 IP 发 --joins 个伪造令牌，超出按 IP 限速的部分不做校验直接拒绝
+--store-latency-ms 模拟一个远程用户库，每次查询 await 这么久。
+报告每秒能接受的 join 数和每个 join 的耗时（完整的 handle_join；每人一个房间，join 通知只发给自己）。
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.bench_fanout import _FakeConnection
+from core.auth import Authenticator, UserStore, issue_token
+from core.chat_server import ChatServer
+from core.socket_base import SocketBase
+
+SECRET = b'bench-secret'
+
+
+class _SlowStore(UserStore):
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def lookup(self, username):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return True
+
+
+def _connections(first, count, same_ip=False):
+    connections = []
+    for i in range(first, first + count):
+        connection = _FakeConnection(i)
+        connection.remote_address = ('10.0.0.1' if same_ip else f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+                                     40000)
+        connections.append(connection)
+    return connections
+
+
+async def _join_all(server, connections, tokens):
+    started = time.perf_counter()
+    for i, connection in enumerate(connections):
+        server.add_connection(connection)
+        # a room each: the join notice goes to one member, not to everyone joined so far
+        await server.handle_join({'username': f"user{i}", 'room': f"room{i}", 'history': 0,
+                                  'auth': tokens[i]}, connection)
+    return time.perf_counter() - started
+
+
+def _leave_all(server, connections):
+    # dropped without the leave broadcast, like a server that lost its clients at once
+    for connection in connections:
+        session = SocketBase.remove_connection(server, connection)
+        if session is not None and session.username is not None:
+            server.presence.remove(session.username)
+
+
+async def run_case(mode, joins, store_latency):
+    auth = None
+    if mode != 'off':
+        auth = Authenticator(SECRET, _SlowStore(store_latency), cache_size=joins * 2)
+    server = ChatServer(heartbeat_interval=0, mailbox_size=0, auth=auth)
+    tokens = [issue_token(SECRET, f"user{i}") for i in range(joins)]
+    if mode == 'flood':
+        tokens = [token[:-4] + 'AAAA' for token in tokens]
+    connections = _connections(0, joins, same_ip=mode == 'flood')
+    if mode == 'warm':
+        await _join_all(server, connections, tokens)
+        _leave_all(server, connections)
+        connections = _connections(joins, joins)
+    elapsed = await _join_all(server, connections, tokens)
+    joined = server.sessions.users
+    result = {
+        'mode': mode,
+        'joins': joins,
+        'joined': joined,
+        'store_latency_ms': store_latency * 1000,
+        'joins_per_sec': round(joins / elapsed),
+        'us_per_join': round(elapsed / joins * 1e6, 1),
+    }
+    if auth is not None:
+        result.update(verified=auth.verified, throttled=auth.throttled, cache_hits=auth.cache.hits)
+    _leave_all(server, connections)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='join throughput with and without token authentication')
+    parser.add_argument('--joins', type=int, default=10000)
+    parser.add_argument('--store-latency-ms', type=float, default=0,
+                        help='simulated user store lookup time')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for mode in ('off', 'cold', 'warm', 'flood'):
+        result = asyncio.run(run_case(mode, args.joins, args.store_latency_ms / 1000))
+        if args.json:
+            print(json.dumps(result))
+        else:
+            extra = ''
+            if mode != 'off':
+                extra = (f" verified={result['verified']} cache hits={result['cache_hits']}"
+                         f" throttled={result['throttled']}")
+            print(f"{mode:>5}  joins={args.joins}  joined={result['joined']:<6} "
+                  f"joins/s={result['joins_per_sec']:<8} per join={result['us_per_join']}us{extra}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+广播批量合并基准测试：吞吐 vs 延迟
+
+    python -m benchmarks.bench_batching
+    python -m benchmarks.bench_batching --clients 1000 --windows 0 1 5 20 --rate 20000 --json
+
+一个房间里有 --clients 个假连接（见 bench_fanout），不断往房间里发聊天消息，
+对每个合并窗口（毫秒，0 表示不合并）测量：
+    messages_per_sec  每秒广播出去的消息数
+    writes            写入 transport 的帧数（≈ 系统调用次数）
+    p50 / p99         从消息进入 ChatServer.deliver 到写给所有成员的延迟
+--rate 限定发送速率（条/秒），为 0 时尽可能快地发送，得到最大吞吐。
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.bench_fanout import _FakeConnection, _percentile
+from core.chat_server import ChatServer
+from core.message_types import BATCH, MESSAGE, build_message
+
+ROOM = 'bench'
+
+
+class _TimedServer(ChatServer):
+    # records when every message actually went out to the room
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def _send_room(self, room, payload):
+        super()._send_room(room, payload)
+        now = time.perf_counter()
+        data = payload.data
+        items = data['messages'] if data['type'] == BATCH else (data,)
+        self.latencies.extend(now - item['timestamp'] for item in items)
+
+
+async def run_case(window_ms, clients, messages, batch_max, rate):
+    server = _TimedServer(batch_window=window_ms / 1000, batch_max=batch_max,
+                          queue_size=messages + 1)
+    connections = [_FakeConnection(i) for i in range(clients)]
+    for i, connection in enumerate(connections):
+        server.add_connection(connection)
+        server.sessions.add_user(connection, f"user{i}", ROOM)
+
+    started = time.perf_counter()
+    for n in range(messages):
+        if rate:
+            # pace the sender, sleeping whenever it gets ahead of schedule
+            ahead = started + n / rate - time.perf_counter()
+            if ahead > 0.001:
+                await asyncio.sleep(ahead)
+        elif n % 8 == 0:
+            # messages arrive from many sockets, let the loop run in between
+            await asyncio.sleep(0)
+        payload = build_message(MESSAGE, username='bench', room=ROOM,
+                                content='x' * 64, timestamp=time.perf_counter())
+        server.deliver(ROOM, payload)
+    while len(server.latencies) < messages:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - started
+
+    writes = sum(item['sent'] for item in server.queue_stats())
+    latencies = sorted(server.latencies)
+    return {
+        'window_ms': window_ms,
+        'clients': clients,
+        'messages': messages,
+        'messages_per_sec': round(messages / elapsed, 1),
+        'deliveries_per_sec': round(messages * clients / elapsed, 1),
+        'writes': writes,
+        'messages_per_write': round(messages * clients / max(writes, 1), 2),
+        'p50_latency_ms': round(_percentile(latencies, 50) * 1000, 3),
+        'p99_latency_ms': round(_percentile(latencies, 99) * 1000, 3),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='broadcast batching benchmark')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--windows', type=float, nargs='+', default=[0, 1, 2, 5, 10, 20],
+                        help='batch windows in milliseconds, 0 disables batching')
+    parser.add_argument('--batch-max', type=int, default=64)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='messages per second offered to the room, 0 = as fast as possible')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for window in args.windows:
+        result = await run_case(window, args.clients, args.messages, args.batch_max, args.rate)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"window={window:>5g}ms msg/s={result['messages_per_sec']:<10} "
+                  f"msg/write={result['messages_per_write']:<6} "
+                  f"p50={result['p50_latency_ms']}ms p99={result['p99_latency_ms']}ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
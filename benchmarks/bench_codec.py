@@ -0,0 +1,147 @@
+"""
+编解码基准测试
+
+    python -m benchmarks.bench_codec [--number 20000] [--json]
+
+对 join / message / leave 三种消息比较：
+    legacy  原来的 format_message（每个字段先 json.dumps 一次做检查）
+    json    单次 json.dumps
+    binary  二进制编码
+的编码耗时、解码耗时和线上字节数；message_iso 是时间戳还是 ISO 字符串时的同一条消息。
+另外比较生成一个时间戳的耗时（core/clock.py）：
+    now_iso      原来的 datetime.now().isoformat()
+    clock        事件循环同一轮内的缓存读取，带房间内不倒退的检查
+    clock_iso    同上，--iso-timestamps 模式
+    clock_tick   每次都是新的一轮：读系统时间并安排失效回调
+"""
+import argparse
+import asyncio
+import json
+import timeit
+from datetime import datetime
+
+from core.clock import Clock
+from core.codec import BINARY_CODEC, JSON_CODEC
+
+
+def legacy_format_message(msg_type, **kwargs):
+    # format_message before the codec module, kept as the baseline
+    data = {'type': str(msg_type)}
+    for k, v in kwargs.items():
+        try:
+            json.dumps({k: v})
+            data[k] = v
+        except Exception:
+            data[k] = str(v)
+    return json.dumps(data, ensure_ascii=False)
+
+
+PAYLOADS = {
+    'join': {
+        'type': 'join',
+        'username': 'alice',
+        'room': 'Chatroom 0',
+        'timestamp': 1714564800123,
+        'online_count': 1234,
+    },
+    'message': {
+        'type': 'message',
+        'username': 'alice',
+        'room': 'Chatroom 0',
+        'content': '大家好，今晚八点开会，记得带上周的数据 :)',
+        'timestamp': 1714564800123,
+    },
+    'leave': {
+        'type': 'leave',
+        'username': 'alice',
+        'room': 'Chatroom 0',
+        'timestamp': 1714564800123,
+        'online_count': 1233,
+    },
+    'message_iso': {
+        'type': 'message',
+        'username': 'alice',
+        'room': 'Chatroom 0',
+        'content': '大家好，今晚八点开会，记得带上周的数据 :)',
+        'timestamp': '2024-05-01T12:00:00.123456',
+    },
+}
+
+
+def _per_call_us(func, number):
+    return round(min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6, 3)
+
+
+def run(number):
+    results = []
+    for name, data in PAYLOADS.items():
+        fields = {k: v for k, v in data.items() if k != 'type'}
+        legacy = legacy_format_message(data['type'], **fields)
+        encoded_json = JSON_CODEC.encode(data)
+        encoded_binary = BINARY_CODEC.encode(data)
+        results.append({
+            'payload': name, 'codec': 'legacy',
+            'encode_us': _per_call_us(lambda: legacy_format_message(data['type'], **fields), number),
+            'decode_us': _per_call_us(lambda: json.loads(legacy), number),
+            'bytes': len(legacy.encode('utf-8')),
+        })
+        results.append({
+            'payload': name, 'codec': 'json',
+            'encode_us': _per_call_us(lambda: JSON_CODEC.encode(data), number),
+            'decode_us': _per_call_us(lambda: JSON_CODEC.decode(encoded_json), number),
+            'bytes': len(encoded_json.encode('utf-8')),
+        })
+        results.append({
+            'payload': name, 'codec': 'binary',
+            'encode_us': _per_call_us(lambda: BINARY_CODEC.encode(data), number),
+            'decode_us': _per_call_us(lambda: BINARY_CODEC.decode(encoded_binary), number),
+            'bytes': len(encoded_binary),
+        })
+    return results
+
+
+async def _clock_cases(number):
+    # inside a coroutine every call falls in the same loop round, the cached path
+    clock = Clock()
+    iso_clock = Clock(iso=True)
+
+    def tick():
+        # what the first timestamp of every round costs
+        clock._ms = None
+        return clock.stamp('Chatroom 0')
+
+    results = [
+        {'clock': 'now_iso', 'us': _per_call_us(lambda: datetime.now().isoformat(), number)},
+        {'clock': 'clock', 'us': _per_call_us(lambda: clock.stamp('Chatroom 0'), number)},
+        {'clock': 'clock_iso', 'us': _per_call_us(lambda: iso_clock.stamp('Chatroom 0'), number)},
+        {'clock': 'clock_tick', 'us': _per_call_us(tick, number)},
+    ]
+    # let the expiry callbacks scheduled by tick() run
+    await asyncio.sleep(0)
+    return results
+
+
+def run_clock(number):
+    return asyncio.run(_clock_cases(number))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='codec benchmark')
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+    for result in run(args.number):
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{result['payload']:>11} {result['codec']:>7} encode={result['encode_us']}us "
+                  f"decode={result['decode_us']}us bytes={result['bytes']}")
+    for result in run_clock(args.number):
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"  timestamp {result['clock']:>10} {result['us']}us")
+
+
+if __name__ == '__main__':
+    main()
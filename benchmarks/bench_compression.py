@@ -0,0 +1,122 @@
+"""
+广播压缩基准测试：带宽与 CPU
+
+    python -m benchmarks.bench_compression
+    python -m benchmarks.bench_compression --recipients 1000 --windows 15 12 10 --json
+
+用一段模拟的聊天流（不同长度的中英文消息，JSON 编码）广播给 --recipients 个连接，比较：
+    none        不压缩
+    per-conn    websockets 自带的 permessage-deflate：每个连接一个压缩上下文，每个接收者各压缩一次
+    shared-W    core/compression.py：不保留上下文，每条消息按窗口 W 只压缩一次，所有接收者共用
+    zjson       core/codec.py 的 zjson 编码：应用层 deflate + 预置共享字典，同样每条只编码一次
+报告每条消息每个接收者的线上字节数，以及每次广播（全部接收者）花在成帧和压缩上的 CPU 时间。
+"""
+import argparse
+import json
+import random
+import time
+
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import Frame, Opcode
+
+from core.codec import JSON_CODEC, ZJSON_CODEC
+from core.compression import Deflate
+from core.fanout import encode_frame
+
+WORDS = ['hello', 'meeting', 'tonight', 'ok', 'lol', 'deploy', 'the', 'build', 'is', 'green',
+         '大家好', '今晚', '八点', '开会', '收到', '数据', '谢谢', '没问题']
+
+
+def chat_stream(count, seed=0):
+    # realistic sizes: mostly short lines, some long ones
+    rng = random.Random(seed)
+    messages = []
+    for n in range(count):
+        words = rng.choice((2, 4, 8, 12, 30, 60))
+        messages.append(JSON_CODEC.encode({
+            'type': 'message',
+            'username': f"user{rng.randrange(500)}",
+            'room': f"room{rng.randrange(20)}",
+            'content': ' '.join(rng.choice(WORDS) for _ in range(words)),
+            'timestamp': 1714564800000 + n * 350 + rng.randrange(350),
+            'seq': n + 1,
+        }))
+    return messages
+
+
+def run_none(messages, recipients):
+    started = time.perf_counter()
+    wire = 0
+    for message in messages:
+        wire += len(encode_frame(message))  # one frame, written to every recipient
+    cpu = time.perf_counter() - started
+    return wire / len(messages), cpu / len(messages)
+
+
+def run_per_connection(messages, recipients):
+    # what websockets does with compression='deflate': a context per connection
+    contexts = [PerMessageDeflate(False, False, 15, 15, {'memLevel': 5}) for _ in range(recipients)]
+    started = time.perf_counter()
+    wire = 0
+    for message in messages:
+        data = message.encode('utf-8')
+        for context in contexts:
+            frame = context.encode(Frame(Opcode.TEXT, data))
+            wire += len(frame.data) + 2 + (2 if len(frame.data) > 125 else 0)
+    cpu = time.perf_counter() - started
+    return wire / len(messages) / recipients, cpu / len(messages)
+
+
+def run_shared(messages, recipients, window_bits):
+    deflate = Deflate(window_bits=window_bits)
+    started = time.perf_counter()
+    wire = 0
+    for message in messages:
+        wire += len(deflate.frame(message, window_bits))  # once, then written to every recipient
+    cpu = time.perf_counter() - started
+    return wire / len(messages), cpu / len(messages)
+
+
+def run_zjson(messages, recipients):
+    decoded = [json.loads(message) for message in messages]
+    started = time.perf_counter()
+    wire = 0
+    for data in decoded:
+        # includes the JSON encoding the other modes got for free
+        wire += len(encode_frame(ZJSON_CODEC.encode(data)))
+    cpu = time.perf_counter() - started
+    return wire / len(messages), cpu / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='broadcast compression benchmark')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--recipients', type=int, nargs='+', default=[10, 1000])
+    parser.add_argument('--windows', type=int, nargs='+', default=[15, 12, 10])
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    messages = chat_stream(args.messages)
+    average = sum(len(message.encode('utf-8')) for message in messages) / len(messages)
+    if not args.json:
+        print(f"{len(messages)} messages, {average:.0f} bytes on average")
+    for recipients in args.recipients:
+        # per-conn is slow with many recipients, give it a proportional sample
+        sample = messages[:max(20, args.messages * 10 // recipients)]
+        cases = [('none', run_none(messages, recipients)),
+                 ('per-conn', run_per_connection(sample, recipients))]
+        cases += [(f"shared-{bits}", run_shared(messages, recipients, bits)) for bits in args.windows]
+        cases.append(('zjson', run_zjson(messages, recipients)))
+        for mode, (wire, cpu) in cases:
+            result = {'mode': mode, 'recipients': recipients, 'bytes_per_recipient': round(wire, 1),
+                      'bytes_per_broadcast': round(wire * recipients),
+                      'cpu_us_per_broadcast': round(cpu * 1e6, 2)}
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{mode:>9}  recipients={recipients:<5} bytes/recipient={result['bytes_per_recipient']:<7} "
+                      f"cpu/broadcast={result['cpu_us_per_broadcast']}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+私信路由基准测试
+
+    python -m benchmarks.bench_dm
+    python -m benchmarks.bench_dm --online 1000 100000 --json
+
+--online 个已 join 的假连接，随机两人之间发 --messages 条私信，比较单条私信的处理耗时：
+    scan   遍历全部会话按用户名找目标（没有索引时的做法）
+    index  ChatServer.handle_dm，经用户名索引一次查到目标连接
+index 的耗时不应随在线人数增长。
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from benchmarks.bench_fanout import _FakeConnection
+from core.chat_server import ChatServer
+from core.message_types import DM, build_message
+
+
+def _scan_dm(server, sender, message_data):
+    # find the target by looking at every session
+    target = message_data['to']
+    for connection, session in server.sessions.sessions.items():
+        if session.username == target:
+            dm = build_message(DM, username=sender, to=target, content=message_data['content'])
+            server.send_queued(connection, dm)
+            return
+
+
+async def run_case(online, messages):
+    server = ChatServer(heartbeat_interval=0, queue_size=messages + 1)
+    connections = [_FakeConnection(i) for i in range(online)]
+    for i, connection in enumerate(connections):
+        server.add_connection(connection)
+        server.sessions.add_user(connection, f"user{i}", 'lobby')
+    rng = random.Random(0)
+    pairs = [(rng.randrange(online), rng.randrange(online)) for _ in range(messages)]
+
+    started = time.perf_counter()
+    for sender, target in pairs:
+        _scan_dm(server, f"user{sender}", {'to': f"user{target}", 'content': 'psst'})
+    scan_us = (time.perf_counter() - started) / messages * 1e6
+
+    started = time.perf_counter()
+    for sender, target in pairs:
+        await server.handle_dm({'to': f"user{target}", 'content': 'psst'}, connections[sender])
+    index_us = (time.perf_counter() - started) / messages * 1e6
+    return {'online': online, 'messages': messages,
+            'scan_us': round(scan_us, 2), 'index_us': round(index_us, 2)}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='direct message routing benchmark')
+    parser.add_argument('--online', type=int, nargs='+', default=[100, 10000, 100000])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for online in args.online:
+        result = await run_case(online, args.messages)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"online={online:<7} scan={result['scan_us']}us/dm  index={result['index_us']}us/dm")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
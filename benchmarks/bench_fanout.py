@@ -0,0 +1,151 @@
+"""
+广播扇出基准测试
+
+    python -m benchmarks.bench_fanout
+    python -m benchmarks.bench_fanout --clients 100 1000 10000 --messages 200 --json
+
+用内存中的假连接测量 SocketBase.broadcast 的吞吐（消息/秒）和 p99 投递延迟
+（从调用 broadcast 到该连接的字节进入 transport 的时间），
+并与原来的 gather + _safe_send 实现做对比。
+一小部分连接可以模拟成慢连接（每写一帧就暂停，drain 需要等待），
+新实现下它们的积压进入各自的 OutboundQueue，不计入投递延迟。
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from websockets.connection import State
+
+from core.fanout import encode_frame
+from core.socket_base import SocketBase
+
+
+class _FakeTransport:
+    __slots__ = ('owner', 'last_write', 'bytes_written')
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.last_write = 0.0
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.last_write = time.perf_counter()
+        self.bytes_written += len(data)
+        if self.owner.drain_delay:
+            self.owner._paused = True
+
+    def is_closing(self):
+        return False
+
+
+class _FakeConnection:
+    # a slow connection pauses writing after every frame until drained
+    def __init__(self, index, drain_delay=0.0):
+        self.state = State.OPEN
+        self.extensions = []
+        self.transport = _FakeTransport(self)
+        self.remote_address = ('127.0.0.1', 10000 + index)
+        self.drain_delay = drain_delay
+        self._paused = False
+
+    async def drain(self):
+        await asyncio.sleep(self.drain_delay)
+        self._paused = False
+
+    async def send(self, message):
+        # what websockets does per recipient: frame, write, then drain
+        self.transport.write(encode_frame(message))
+        await self.drain()
+
+
+async def _gather_broadcast(base, message):
+    # the previous SocketBase.broadcast, kept here as the baseline
+    targets = base.connected_clients.copy()
+    tasks = [base._safe_send(client, message) for client in targets]
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+
+async def run_case(mode, clients, messages, slow_fraction, slow_delay):
+    base = SocketBase()
+    connections = []
+    for i in range(clients):
+        delay = slow_delay if random.random() < slow_fraction else 0.0
+        connections.append(_FakeConnection(i, delay))
+    for conn in connections:
+        base.add_connection(conn)
+
+    message = json.dumps({
+        'type': 'message',
+        'username': 'bench',
+        'content': 'x' * 64,
+        'timestamp': '2024-01-01T00:00:00.000000'
+    })
+
+    latencies = []
+    sender_waits = []
+    started = time.perf_counter()
+    for _ in range(messages):
+        t0 = time.perf_counter()
+        if mode == 'fanout':
+            await base.broadcast(message)
+        else:
+            await _gather_broadcast(base, message)
+        sender_waits.append(time.perf_counter() - t0)
+        # connections still backed up in their queue are not counted here
+        latencies.extend(conn.transport.last_write - t0 for conn in connections
+                         if conn.transport.last_write >= t0)
+    elapsed = time.perf_counter() - started
+    dropped = sum(item['dropped'] for item in base.queue_stats())
+
+    latencies.sort()
+    sender_waits.sort()
+    return {
+        'mode': mode,
+        'clients': clients,
+        'messages': messages,
+        'messages_per_sec': round(messages / elapsed, 1),
+        'deliveries_per_sec': round(messages * clients / elapsed, 1),
+        'p50_delivery_ms': round(_percentile(latencies, 50) * 1000, 3),
+        'p99_delivery_ms': round(_percentile(latencies, 99) * 1000, 3),
+        'p99_sender_wait_ms': round(_percentile(sender_waits, 99) * 1000, 3),
+        'queue_drops': dropped,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='broadcast fan-out benchmark')
+    parser.add_argument('--clients', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--slow-fraction', type=float, default=0.01,
+                        help='fraction of connections whose drain has to wait')
+    parser.add_argument('--slow-delay', type=float, default=0.002,
+                        help='seconds a slow connection takes to drain')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    random.seed(0)
+    for clients in args.clients:
+        # keep the total amount of work roughly constant across sizes
+        messages = max(10, args.messages * 100 // max(clients, 100))
+        for mode in ('gather', 'fanout'):
+            result = await run_case(mode, clients, messages, args.slow_fraction, args.slow_delay)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{mode:>7} clients={clients:<6} msg/s={result['messages_per_sec']:<10} "
+                      f"p50={result['p50_delivery_ms']}ms p99={result['p99_delivery_ms']}ms "
+                      f"sender_wait_p99={result['p99_sender_wait_ms']}ms drops={result['queue_drops']}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+"""
+文件传输基准测试
+
+    python -m benchmarks.bench_files
+    python -m benchmarks.bench_files --size-mb 1024 --json
+
+启动 `server.py --file-dir <临时目录>`（聊天限流保持默认开启），一个客户端上传 --size-mb MB 的随机文件，
+另一个客户端把它下载回来并校验。报告上传 / 下载的 MB/s，以及服务端进程的内存：
+开始前、上传期间和下载期间的 VmRSS 峰值（RssAnon 是其中不属于文件页的部分）。
+服务端边收边写盘、下载时 mmap 并把发完的页交还，所以峰值应该和文件大小无关。
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_workers import REPO_ROOT, _wait_for_port
+from core.chat_client import ChatClient
+
+
+def _memory(pid):
+    # {'VmRSS': kB, 'RssAnon': kB} of a process, from /proc (Linux only)
+    memory = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'RssAnon'):
+                memory[key] = int(value.split()[0])
+    return memory
+
+
+async def _watch(pid, peak, stop):
+    while not stop.is_set():
+        for key, value in _memory(pid).items():
+            peak[key] = max(peak.get(key, 0), value)
+        await asyncio.sleep(0.02)
+
+
+async def _measure(pid, work):
+    # run work() while sampling the server's memory, returns (seconds, result, peak kB)
+    peak = {}
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(_watch(pid, peak, stop))
+    started = time.perf_counter()
+    result = await work()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await watcher
+    return elapsed, result, peak
+
+
+async def run_case(pid, port, directory, size):
+    source = os.path.join(directory, 'source.bin')
+    digest = hashlib.sha256()
+    with open(source, 'wb') as file:
+        for _ in range(size // (1 << 20)):
+            block = os.urandom(1 << 20)
+            digest.update(block)
+            file.write(block)
+
+    downloads = os.path.join(directory, 'downloads')
+    os.makedirs(downloads)
+    sender = ChatClient('localhost', port, reconnect=False)
+    receiver = ChatClient('localhost', port, reconnect=False, download_dir=downloads)
+    listeners = []
+    for name, client in (('sender', sender), ('receiver', receiver)):
+        await client.connect_to_server(name)
+        listeners.append(asyncio.create_task(client.listen_for_messages(client.handle_server_message)))
+    await asyncio.sleep(0.2)
+    before = _memory(pid)
+
+    upload_time, file_id, upload_peak = await _measure(pid, lambda: sender.send_file(source))
+    if file_id is None:
+        raise RuntimeError("upload failed")
+
+    async def download():
+        await receiver.get_file(file_id)
+        await asyncio.sleep(0)
+        while receiver.downloads or not os.listdir(downloads):
+            await asyncio.sleep(0.005)
+
+    download_time, _, download_peak = await _measure(pid, download)
+    target = os.path.join(downloads, f"{file_id}_source.bin")
+    with open(target, 'rb') as file:
+        check = hashlib.file_digest(file, 'sha256')
+    if check.hexdigest() != digest.hexdigest():
+        raise RuntimeError("downloaded file differs")
+
+    for task in listeners:
+        task.cancel()
+    for client in (sender, receiver):
+        await client.close()
+    mb = size / (1 << 20)
+    return {
+        'size_mb': mb,
+        'upload_mb_per_sec': round(mb / upload_time, 1),
+        'download_mb_per_sec': round(mb / download_time, 1),
+        'rss_before_mb': round(before['VmRSS'] / 1024, 1),
+        'rss_peak_upload_mb': round(upload_peak['VmRSS'] / 1024, 1),
+        'rss_peak_download_mb': round(download_peak['VmRSS'] / 1024, 1),
+        'anon_before_mb': round(before['RssAnon'] / 1024, 1),
+        'anon_peak_mb': round(max(upload_peak['RssAnon'], download_peak['RssAnon']) / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='chunked file transfer throughput and server memory')
+    parser.add_argument('--size-mb', type=int, nargs='+', default=[256])
+    parser.add_argument('--port', type=int, default=12395)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for size_mb in args.size_mb:
+        with tempfile.TemporaryDirectory() as directory:
+            server = subprocess.Popen(
+                [sys.executable, 'server.py', '--port', str(args.port),
+                 '--file-dir', os.path.join(directory, 'files'), '--log-level', 'off'],
+                cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                if not _wait_for_port(args.port):
+                    raise RuntimeError("server did not start")
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    # ChatClient prints on connect and for every event
+                    result = asyncio.run(run_case(server.pid, args.port, directory, size_mb << 20))
+            finally:
+                server.terminate()
+                server.wait()
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{size_mb:>6} MB  upload={result['upload_mb_per_sec']}MB/s "
+                  f"download={result['download_mb_per_sec']}MB/s  server RSS "
+                  f"before={result['rss_before_mb']}MB peak upload={result['rss_peak_upload_mb']}MB "
+                  f"peak download={result['rss_peak_download_mb']}MB  anon peak={result['anon_peak_mb']}MB")
+
+
+if __name__ == '__main__':
+    main()
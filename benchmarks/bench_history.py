@@ -0,0 +1,91 @@
+"""
+历史回放基准测试（重连风暴）
+
+    python -m benchmarks.bench_history
+    python -m benchmarks.bench_history --clients 5000 --history 50 --json
+
+先往临时目录的 MessageLog 里写入若干房间的消息，然后让大量假连接同时 join，
+每个连接回放最近 --history 条消息。对比两种方式：
+    log    每次都从日志读取并为每个客户端重新编码成帧（原来的做法）
+    cache  HistoryCache 命中，直接写入缓存好的 JSON 帧
+输出每秒回放的帧数，以及缓存的命中/未命中次数。
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+
+from benchmarks.bench_fanout import _FakeConnection
+from core.chat_server import ChatServer
+from core.codec import Payload
+from core.message_log import MessageLog
+from core.message_types import MESSAGE, build_message
+
+
+async def _replay_from_log(server, websocket, room, limit):
+    # the replay path before the cache: read, decode and frame for every client
+    for _, _, text in server.message_log.read_recent(room, limit):
+        server.send_queued(websocket, Payload.from_json(text))
+
+
+async def run_case(mode, clients, rooms, history, directory):
+    message_log = MessageLog(directory)
+    server = ChatServer(message_log=message_log, queue_size=history * 2)
+    for r in range(rooms):
+        room = f"room{r}"
+        for n in range(history):
+            payload = build_message(MESSAGE, username=f"user{n}", room=room,
+                                    content=f"message {n} " + 'x' * 40, timestamp=time.time())
+            server.persist(room, payload)
+            server.history.add(room, payload)
+    connections = [_FakeConnection(i) for i in range(clients)]
+    for connection in connections:
+        server.add_connection(connection)
+
+    started = time.perf_counter()
+    for i, connection in enumerate(connections):
+        room = f"room{i % rooms}"
+        if mode == 'cache':
+            await server.send_history(connection, room, (None, history))
+        else:
+            await _replay_from_log(server, connection, room, history)
+    elapsed = time.perf_counter() - started
+
+    written = sum(connection.transport.bytes_written for connection in connections)
+    await message_log.close()
+    result = {
+        'mode': mode,
+        'clients': clients,
+        'history': history,
+        'frames': clients * history,
+        'frames_per_sec': round(clients * history / elapsed),
+        'bytes_written': written,
+    }
+    if mode == 'cache':
+        stats = server.history.stats()
+        result.update(hits=stats['hits'], misses=stats['misses'])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='history replay benchmark')
+    parser.add_argument('--clients', type=int, nargs='+', default=[500, 5000])
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--history', type=int, default=50, help='messages replayed per client')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for clients in args.clients:
+        for mode in ('log', 'cache'):
+            with tempfile.TemporaryDirectory() as directory:
+                result = asyncio.run(run_case(mode, clients, args.rooms, args.history, directory))
+            if args.json:
+                print(json.dumps(result))
+            else:
+                extra = f"  hits={result['hits']} misses={result['misses']}" if mode == 'cache' else ''
+                print(f"{mode:>5}  clients={clients:>5}  frames/s={result['frames_per_sec']:>9}{extra}")
+
+
+if __name__ == '__main__':
+    main()
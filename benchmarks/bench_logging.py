@@ -0,0 +1,122 @@
+"""
+日志对事件循环的阻塞时间
+
+    python -m benchmarks.bench_logging
+    python -m benchmarks.bench_logging --records 20000 --reader-rate 2000000 --json
+
+模拟服务器把日志重定向到一个读得慢的管道（读端每秒只读 --reader-rate 字节），
+在事件循环里写 --records 条逐条消息日志，比较：
+    off       日志关闭（基线）
+    print     原来的 print()
+    stream    标准库 logging.StreamHandler，同步写
+    pipeline  core/log.py 的后台线程批量写出
+统计事件循环里花在日志调用上的总时间和单次最长时间，以及同时运行的 1ms 定时器的延迟 p99。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+from benchmarks.bench_fanout import _percentile
+from core.log import get_logger, setup_logging
+
+
+def _slow_reader(fd, rate):
+    # drains the pipe at a fixed byte rate, like a busy terminal or log shipper
+    chunk = max(1, rate // 100)
+    while True:
+        try:
+            data = os.read(fd, chunk)
+        except OSError:
+            return
+        if not data:
+            return
+        time.sleep(len(data) / rate)
+
+
+async def _ticker(lags, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - started - 0.001)
+
+
+async def run_case(mode, records, reader_rate):
+    read_fd, write_fd = os.pipe()
+    reader = threading.Thread(target=_slow_reader, args=(read_fd, reader_rate), daemon=True)
+    reader.start()
+    stream = os.fdopen(write_fd, 'w', buffering=1)
+
+    pipeline = None
+    logger = get_logger('messages')
+    if mode == 'stream':
+        logger = logging.getLogger('bench.stream')
+        logger.propagate = False
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+    elif mode == 'off':
+        setup_logging('off')
+    elif mode == 'pipeline':
+        # a queue as large as the run, so nothing is dropped and all of it is written
+        pipeline = setup_logging('debug', stream=stream, max_queue=records + 1)
+
+    lags = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(_ticker(lags, stop))
+    calls = []
+    content = 'x' * 80
+    for n in range(records):
+        started = time.perf_counter()
+        if mode == 'print':
+            print(f"[message from user{n % 100} in room{n % 10}]: {content}", file=stream)
+        else:
+            logger.debug("message from %s in %s: %s", f"user{n % 100}", f"room{n % 10}", content)
+        calls.append(time.perf_counter() - started)
+        if n % 50 == 0:
+            await asyncio.sleep(0)
+    stop.set()
+    await ticker
+
+    if pipeline is not None:
+        setup_logging('off')  # waits for the writer thread to finish the backlog
+    stream.close()
+    reader.join(timeout=60)
+    os.close(read_fd)
+
+    calls.sort()
+    lags.sort()
+    return {
+        'mode': mode,
+        'records': records,
+        'blocked_ms_total': round(sum(calls) * 1000, 3),
+        'call_p99_us': round(_percentile(calls, 99) * 1e6, 2),
+        'call_max_ms': round(calls[-1] * 1000, 3),
+        'loop_lag_p99_ms': round(_percentile(lags, 99) * 1000, 3),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='logging loop-blocking benchmark')
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--reader-rate', type=int, default=1000000,
+                        help='bytes per second the pipe reader consumes')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for mode in ('off', 'print', 'stream', 'pipeline'):
+        result = await run_case(mode, args.records, args.reader_rate)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{mode:>8}  blocked={result['blocked_ms_total']}ms  "
+                  f"call_p99={result['call_p99_us']}us  call_max={result['call_max_ms']}ms  "
+                  f"loop_lag_p99={result['loop_lag_p99_ms']}ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
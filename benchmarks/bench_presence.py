@@ -0,0 +1,74 @@
+"""
+在线用户列表基准测试
+
+    python -m benchmarks.bench_presence
+    python -m benchmarks.bench_presence --users 100000 --json
+
+--users 个在线用户，比较取一页（50 个，按名字排序、游标分页）的耗时：
+    scan   每次遍历全部会话、排序再切片（没有索引时的做法）
+    index  core/presence.py 的有序索引，bisect 定位后切片
+另外报告有序索引每次 join + leave 的维护开销。
+"""
+import argparse
+import json
+import random
+import time
+
+from core.presence import PresenceIndex, fold_name
+
+
+def _scan_page(usernames, after, limit):
+    keys = sorted(fold_name(name) for name in usernames)
+    if after is not None:
+        keys = [key for key in keys if key > after]
+    return keys[:limit]
+
+
+def run_case(users, pages, limit):
+    names = [f"user{n:07d}" for n in random.Random(0).sample(range(users * 10), users)]
+    index = PresenceIndex(send=None)
+    for name in names:
+        index.add(name)
+    cursors = [None] + [fold_name(name) for name in random.Random(1).sample(names, pages - 1)]
+
+    started = time.perf_counter()
+    scan_pages = max(1, pages // 100)  # a full sort per page is slow, sample fewer
+    for after in cursors[:scan_pages]:
+        _scan_page(names, after, limit)
+    scan_us = (time.perf_counter() - started) / scan_pages * 1e6
+
+    started = time.perf_counter()
+    for after in cursors:
+        index.page(after, limit)
+    index_us = (time.perf_counter() - started) / pages * 1e6
+
+    started = time.perf_counter()
+    for n in range(pages):
+        name = f"churn{n}"
+        index.add(name)
+        index.remove(name)
+    churn_us = (time.perf_counter() - started) / pages * 1e6
+
+    return {'users': users, 'limit': limit, 'scan_page_us': round(scan_us, 1),
+            'index_page_us': round(index_us, 2), 'join_leave_us': round(churn_us, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='online user listing benchmark')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for users in args.users:
+        result = run_case(users, args.pages, args.limit)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"users={users:<7} scan={result['scan_page_us']}us/page  "
+                  f"index={result['index_page_us']}us/page  join+leave={result['join_leave_us']}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+限流基准测试：一个刷屏客户端让服务器付出多少
+
+    python -m benchmarks.bench_ratelimit
+    python -m benchmarks.bench_ratelimit --clients 10000 --frames 20000 --json
+
+房间里有 --clients 个假连接，其中一个在极短时间内发 --frames 条聊天消息。
+按服务器收到一帧后的处理顺序（限流检查 -> 解析 -> 广播）计时，比较：
+    off  不限流，每帧都解析并扇出给整个房间
+    on   core/ratelimit.py 的令牌桶（默认 20 条/秒，突发 40），超限帧在解析前丢弃
+报告服务器总耗时、实际扇出的消息数，以及被丢弃帧的单帧检查耗时。
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.bench_fanout import _FakeConnection
+from core.chat_server import ChatServer
+from core.ratelimit import ALLOW, RateLimiter
+
+ROOM = 'lobby'
+
+
+async def run_case(mode, clients, frames):
+    limiter = RateLimiter(strikes=frames + 1) if mode == 'on' else None
+    server = ChatServer(heartbeat_interval=0, queue_size=frames + 1, mailbox_size=0, rate_limiter=limiter)
+    connections = [_FakeConnection(i) for i in range(clients)]
+    for i, connection in enumerate(connections):
+        server.add_connection(connection)
+        server.sessions.add_user(connection, f"user{i}", ROOM)
+    flooder = connections[0]
+    session = server.sessions.get(flooder)
+    raw = json.dumps({'type': 'message', 'room': ROOM, 'content': 'spam ' * 10})
+
+    started = time.perf_counter()
+    for n in range(frames):
+        # what SocketBase.handle_client does with every inbound frame
+        if limiter is not None and limiter.check(session.limits, len(raw), session.username) is not ALLOW:
+            continue
+        await server.handle_message(raw, flooder)
+        if n % 64 == 0:
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+    dropped = limiter.dropped if limiter is not None else 0
+    return {'mode': mode, 'clients': clients, 'frames': frames,
+            'server_ms': round(elapsed * 1000, 1), 'broadcast': frames - dropped, 'dropped': dropped,
+            'us_per_frame': round(elapsed / frames * 1e6, 2)}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='rate limit flood benchmark')
+    parser.add_argument('--clients', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--frames', type=int, default=5000)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for clients in args.clients:
+        for mode in ('off', 'on'):
+            result = await run_case(mode, clients, args.frames)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{mode:>3}  clients={clients:<6} server={result['server_ms']}ms  "
+                      f"broadcast={result['broadcast']}  dropped={result['dropped']}  "
+                      f"per_frame={result['us_per_frame']}us")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,312 @@
+"""
+优雅下线 / 热重启基准测试
+
+    python -m benchmarks.bench_restart
+    python -m benchmarks.bench_restart --messages 1000000 --users 500 --json
+
+startup  往临时目录的消息日志写 --messages 条消息，启动 server.py --log-dir 到端口能连上的时间，
+         以及服务端日志里的 "server ready in" 分段；scan 是没有 .idx 时（崩溃后、旧版本写的日志）逐条扫描，
+         indexed 是正常关闭后从 .idx 载入
+drain    进程内 ChatServer，--connections 个真实 websocket 连接，其中 --stuck 个不再读数据（不回关闭帧）；
+         close() 的耗时：serial 是以前逐个 await close() 的做法（每个卡住的连接等满 close_timeout），
+         concurrent 是 close_connections() 并发关闭、--drain-timeout 到了直接断开
+restart  server.py 带日志运行，--users 个 SDK 用户以 --rate 条/秒发消息，另有一个探测任务每 10ms 新建一个连接；
+         hot 发 SIGHUP（交出监听 socket 和快照），cold 发 SIGTERM 后立刻启动一个新进程。报告：
+         探测被拒绝的次数和最慢的一次连接、从发信号到全部用户 resume 完的时间、不完整的 resume、
+         各用户在各房间收到的 seq 里的缺口和重复、失败的发送、重启后的一轮加入 / 离开通知
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+from benchmarks.bench_workers import REPO_ROOT, _wait_for_port
+from core.chat_server import ChatServer
+from core.message_log import MessageLog
+from core.message_types import JOIN, LEAVE, MESSAGE, RESUME
+from core.sdk import ChatSDK, SDKError
+
+_READY = re.compile(r"server ready in (\d+) ms \(([^)]*)\)")
+
+
+def fill_log(directory, messages, rooms=100):
+    async def fill():
+        message_log = MessageLog(directory, fsync_interval=1.0, fsync_batch=1 << 30)
+        await message_log.start()
+        clock = 1_700_000_000_000
+        for i in range(messages):
+            clock += 7
+            room = f"room{i % rooms}"
+            data = {'type': 'message', 'username': f"user{i % 1000}", 'room': room, 'seq': i // rooms + 1,
+                    'content': f"message {i} with some words in it", 'timestamp': clock}
+            message_log.append(room, json.dumps(data, separators=(',', ':')), clock)
+            if i % 10000 == 0:
+                await asyncio.sleep(0)
+        await message_log.close()
+    asyncio.run(fill())
+
+
+def _server_args(port, directory, users):
+    return [sys.executable, 'server.py', '--port', str(port), '--log-dir', directory, '--rate-limit', '0',
+            '--max-channels', str(max(users, 1)), '--history', '10', '--log-level', 'info',
+            '--drain-timeout', '2', '--reconnect-spread', '0.5']
+
+
+def _spawn(port, directory, users, output):
+    return subprocess.Popen(_server_args(port, directory, users), cwd=REPO_ROOT, stdout=output, stderr=output)
+
+
+def _ready_line(path):
+    # the last "server ready in" line of a server's log output: (total ms, phases)
+    with open(path, errors='replace') as f:
+        found = _READY.findall(f.read())
+    return (int(found[-1][0]), found[-1][1]) if found else (None, '')
+
+
+def _server_pids(port):
+    # server.py processes on this port, including one a hot restart started
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", 'rb') as f:
+                argv = f.read().split(b'\0')
+        except OSError:
+            continue
+        if b'server.py' in argv and str(port).encode() in argv:
+            pids.append(int(entry))
+    return pids
+
+
+def _stop_servers(port, timeout=10.0):
+    for pid in _server_pids(port):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.time() + timeout
+    while _server_pids(port) and time.time() < deadline:
+        time.sleep(0.05)
+
+
+def run_startup(port, messages, directory):
+    results = []
+    for mode in ('scan', 'indexed'):
+        if mode == 'scan':
+            for path in glob.glob(os.path.join(directory, '*.idx')):
+                os.remove(path)
+        with tempfile.NamedTemporaryFile('w+', suffix='.log') as output:
+            started = time.perf_counter()
+            server = _spawn(port, directory, 0, output)
+            try:
+                if not _wait_for_port(port, timeout=120.0):
+                    raise RuntimeError("server did not start")
+                elapsed = time.perf_counter() - started
+            finally:
+                server.terminate()
+                server.wait()
+            ready_ms, phases = _ready_line(output.name)
+        results.append({'mode': mode, 'messages': messages, 'to_port_sec': round(elapsed, 3),
+                        'ready_ms': ready_ms, 'phases': phases,
+                        'idx_files': len(glob.glob(os.path.join(directory, '*.idx')))})
+    return results
+
+
+async def _drain_case(mode, port, connections, stuck, drain_timeout):
+    server = ChatServer('localhost', port, heartbeat_interval=0, mailbox_size=0, drain_timeout=drain_timeout)
+    serving = asyncio.create_task(server.start())
+    await server.ready.wait()
+    clients = []
+    for i in range(connections):
+        client = await websockets.connect(f"ws://localhost:{port}", compression=None)
+        await client.send(json.dumps({'type': 'join', 'username': f"user{i}", 'room': f"room{i % 20}",
+                                      'history': 0}))
+        clients.append(client)
+    # the joins are through once the last one is registered
+    while len(server.sessions) < connections:
+        await asyncio.sleep(0.01)
+    for client in clients[:stuck]:
+        client.transport.pause_reading()
+
+    started = time.perf_counter()
+    if mode == 'serial':
+        # the previous SocketBase.close(), kept here as the baseline
+        for websocket in list(server.sessions.sessions):
+            await websocket.close()
+            server.remove_connection(websocket)
+    await server.close()
+    elapsed = time.perf_counter() - started
+    server.stop()
+    await serving
+    for client in clients:
+        client.transport.abort()
+    return {'mode': mode, 'connections': connections, 'stuck': stuck, 'close_sec': round(elapsed, 3)}
+
+
+async def _prober(port, stats, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            websocket = await websockets.connect(f"ws://localhost:{port}", open_timeout=30)
+        except (OSError, websockets.WebSocketException, asyncio.TimeoutError):
+            stats['refused'] += 1
+        else:
+            stats['max_connect'] = max(stats['max_connect'], time.perf_counter() - started)
+            stats['connects'] += 1
+            await websocket.close()
+        await asyncio.sleep(0.01)
+
+
+async def run_restart(mode, port, directory, args):
+    output = tempfile.NamedTemporaryFile('w+', suffix='.log')
+    server = _spawn(port, directory, args.users, output)
+    if not _wait_for_port(port, timeout=120.0):
+        raise RuntimeError("server did not start")
+    sdk = ChatSDK('localhost', port, connections=args.connections, max_in_flight=256, event_queue_size=100000,
+                  reconnect_delay=0.2, reconnect_max_delay=1.0)
+    await sdk.connect()
+    seqs = {}
+    resumed = {}
+    incomplete = 0
+    presence = 0
+    # events after the signal
+    counting = False
+
+    async def consume():
+        nonlocal incomplete, presence
+        async for event in sdk:
+            if event.user is None:
+                continue
+            if event.type == MESSAGE:
+                seqs.setdefault((event.user.username, event.room), []).append(event.seq)
+            elif counting and event.type == RESUME:
+                resumed[event.user.username] = time.perf_counter()
+                incomplete += not event.data.get('complete', True)
+            elif counting and event.type in (JOIN, LEAVE) and event.username != event.user.username:
+                presence += 1
+
+    consumer = asyncio.create_task(consume())
+    users = [await sdk.join(f"bot{i}", room=f"room{i // 10}") for i in range(args.users)]
+    sent = failed = 0
+    stop = asyncio.Event()
+
+    async def send():
+        nonlocal sent, failed
+        acks = []
+        interval = 1 / args.rate
+        next_send = time.perf_counter()
+        while not stop.is_set():
+            acks.append(await users[sent % len(users)].post(f"message {sent}"))
+            sent += 1
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+        for result in await asyncio.gather(*acks, return_exceptions=True):
+            failed += isinstance(result, (SDKError, asyncio.CancelledError))
+
+    stats = {'refused': 0, 'connects': 0, 'max_connect': 0.0}
+    tasks = [asyncio.create_task(send()), asyncio.create_task(_prober(port, stats, stop))]
+    await asyncio.sleep(1.0)
+
+    signalled = time.perf_counter()
+    counting = True
+    if mode == 'hot':
+        os.kill(server.pid, signal.SIGHUP)
+    else:
+        os.kill(server.pid, signal.SIGTERM)
+        await asyncio.get_running_loop().run_in_executor(None, server.wait)
+        server = _spawn(port, directory, args.users, output)
+    deadline = signalled + 30
+    while len(resumed) < len(users) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    all_resumed = time.perf_counter()
+    await asyncio.sleep(1.0)
+    stop.set()
+    await asyncio.gather(*tasks)
+    await asyncio.sleep(0.5)
+    # closing the connections one by one makes the others see leaves
+    counting = False
+    await sdk.close()
+    consumer.cancel()
+    _stop_servers(port)
+    server.wait()
+    ready_ms, phases = _ready_line(output.name)
+    output.close()
+
+    gaps = duplicates = 0
+    for received in seqs.values():
+        unique = set(received)
+        duplicates += len(received) - len(unique)
+        gaps += max(unique) - min(unique) + 1 - len(unique)
+    return {
+        'mode': mode,
+        'users': len(users),
+        'refused_connects': stats['refused'],
+        'max_connect_ms': round(stats['max_connect'] * 1000, 1),
+        'resumed': len(resumed),
+        'all_resumed_sec': round(all_resumed - signalled, 3),
+        'incomplete_resumes': incomplete,
+        'seq_gaps': gaps,
+        'duplicates': duplicates,
+        'sent': sent,
+        'failed_sends': failed,
+        'presence_events': presence,
+        'new_server_ready_ms': ready_ms,
+        'new_server_phases': phases,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='startup time, drain time and hot vs cold restart')
+    parser.add_argument('--messages', type=int, default=300000, help='messages in the log the server loads')
+    parser.add_argument('--connections', type=int, default=500, help='connections in the drain case')
+    parser.add_argument('--stuck', type=int, default=2, help='of them, clients that stop reading')
+    parser.add_argument('--drain-timeout', type=float, default=2.0)
+    parser.add_argument('--users', type=int, default=200, help='SDK users in the restart cases')
+    parser.add_argument('--sdk-connections', dest='sdk_connections', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=500, help='messages per second sent in the restart cases')
+    parser.add_argument('--port', type=int, default=12397)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+    sdk_args = argparse.Namespace(users=args.users, connections=args.sdk_connections, rate=args.rate)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        fill_log(directory, args.messages)
+        results += [('startup', result) for result in run_startup(args.port, args.messages, directory)]
+        for mode in ('serial', 'concurrent'):
+            results.append(('drain', asyncio.run(_drain_case(mode, args.port, args.connections, args.stuck,
+                                                             args.drain_timeout))))
+        for mode in ('hot', 'cold'):
+            results.append(('restart', asyncio.run(run_restart(mode, args.port, directory, sdk_args))))
+
+    for section, result in results:
+        if args.json:
+            print(json.dumps(dict(result, section=section)))
+        elif section == 'startup':
+            print(f"startup  {result['mode']:<8} {result['messages']} logged messages  "
+                  f"port open after {result['to_port_sec']}s  ready in {result['ready_ms']}ms ({result['phases']})")
+        elif section == 'drain':
+            print(f"drain    {result['mode']:<10} {result['connections']} connections, {result['stuck']} stuck  "
+                  f"close()={result['close_sec']}s")
+        else:
+            print(f"restart  {result['mode']:<4} {result['users']} users  refused={result['refused_connects']} "
+                  f"max connect={result['max_connect_ms']}ms  resumed {result['resumed']} "
+                  f"in {result['all_resumed_sec']}s  incomplete={result['incomplete_resumes']}  "
+                  f"gaps={result['seq_gaps']} duplicates={result['duplicates']}  "
+                  f"failed sends={result['failed_sends']}/{result['sent']}  "
+                  f"join/leave events={result['presence_events']}  "
+                  f"new server ready in {result['new_server_ready_ms']}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+断线续连基准测试（重连风暴）
+
+    python -m benchmarks.bench_resume
+    python -m benchmarks.bench_resume --clients 200 1000 --history 50 --missed 3 --json
+
+一个房间里的 --clients 个客户端同时断线又重连，断线期间房间里多了 --missed 条消息。比较三种重连方式：
+    rejoin    重新 join，回放最近 --history 条历史，并向房间广播 join
+    resume    resume 带上最后看到的 seq，只补发漏掉的 --missed 条；服务端已经发现断线，同样广播 join
+    takeover  resume 时旧连接还没被发现断开，凭令牌接管会话，不广播 join / leave
+报告每个客户端重连时收到的帧数（补发 / 回放加上 resume、join 通知，不算之后别人的 join），
+服务端总共写出的字节数和处理全部重连的耗时。
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.bench_fanout import _FakeConnection
+from core.chat_server import ChatServer
+from core.message_types import MESSAGE, build_message
+from core.socket_base import SocketBase
+
+ROOM = 'bench'
+
+
+async def run_case(mode, clients, history, missed):
+    server = ChatServer(queue_size=history * 2 + 16, heartbeat_interval=0)
+    old = [_FakeConnection(i) for i in range(clients)]
+    for i, connection in enumerate(old):
+        server.add_connection(connection)
+        await server.handle_join({'username': f"user{i}", 'room': ROOM, 'history': 0}, connection)
+    tokens = [server.sessions.get(connection).token for connection in old]
+    for n in range(history):
+        payload = build_message(MESSAGE, username=f"user{n}", room=ROOM,
+                                content=f"message {n} " + 'x' * 40, timestamp=time.time())
+        server.sequence(ROOM, payload)
+        server.history.add(ROOM, payload)
+    seen = server.room_seq(ROOM) - missed
+    if mode != 'takeover':
+        # the server noticed the drops already (and announced the leaves, not timed)
+        for connection in old:
+            session = SocketBase.remove_connection(server, connection)
+            server.presence.remove(session.username)
+
+    new = [_FakeConnection(clients + i) for i in range(clients)]
+    for connection in new:
+        server.add_connection(connection)
+    before = sum(connection.transport.bytes_written for connection in old + new)
+    frames = 0
+    started = time.perf_counter()
+    for i, connection in enumerate(new):
+        if mode == 'rejoin':
+            await server.handle_join({'username': f"user{i}", 'room': ROOM, 'history': history}, connection)
+        else:
+            await server.handle_resume({'username': f"user{i}", 'room': ROOM, 'rooms': {ROOM: seen},
+                                        'epoch': server.epoch, 'token': tokens[i]}, connection)
+        frames += server.sessions.get(connection).queue.sent
+    elapsed = time.perf_counter() - started
+    written = sum(connection.transport.bytes_written for connection in old + new) - before
+    return {
+        'mode': mode,
+        'clients': clients,
+        'history': history,
+        'missed': missed,
+        'frames_per_client': round(frames / clients, 1),
+        'bytes_written': written,
+        'ms_total': round(elapsed * 1000, 1),
+        'us_per_client': round(elapsed / clients * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='reconnect storm: rejoin vs resume')
+    parser.add_argument('--clients', type=int, nargs='+', default=[200, 1000])
+    parser.add_argument('--history', type=int, default=50, help='messages replayed on a plain rejoin')
+    parser.add_argument('--missed', type=int, default=3, help='messages sent while the clients were away')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for clients in args.clients:
+        for mode in ('rejoin', 'resume', 'takeover'):
+            result = asyncio.run(run_case(mode, clients, args.history, args.missed))
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{mode:>8}  clients={clients:>5}  frames/client={result['frames_per_client']:<6} "
+                      f"bytes={result['bytes_written']:<10} total={result['ms_total']}ms "
+                      f"per client={result['us_per_client']}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+房间路由基准测试
+
+    python -m benchmarks.bench_rooms --rooms 1 100 10000 --room-size 10
+
+每个房间 room-size 个用户，测量向单个房间广播一条消息的平均耗时，
+以及加入 / 切换房间的平均耗时。两者都不应随房间总数增长。
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.bench_fanout import _FakeConnection
+from core.chat_server import ChatServer
+
+
+async def run_case(rooms, room_size, messages):
+    server = ChatServer()
+    index = 0
+    for r in range(rooms):
+        for _ in range(room_size):
+            conn = _FakeConnection(index)
+            index += 1
+            server.add_connection(conn)
+            server.sessions.add_user(conn, f"user{index}", f"room{r}")
+    sample = next(iter(server.sessions.get_room_members('room0')))
+
+    started = time.perf_counter()
+    for i in range(messages):
+        await server.broadcast('{"type": "message"}', targets=server.sessions.get_room_members(f"room{i % rooms}"))
+    broadcast_us = (time.perf_counter() - started) / messages * 1e6
+
+    started = time.perf_counter()
+    for i in range(messages):
+        server.sessions.switch_room(sample, server.sessions.get_room(sample), f"room{i % rooms}")
+    switch_us = (time.perf_counter() - started) / messages * 1e6
+
+    return {
+        'rooms': rooms,
+        'room_size': room_size,
+        'broadcast_us': round(broadcast_us, 2),
+        'switch_us': round(switch_us, 2),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='room routing benchmark')
+    parser.add_argument('--rooms', type=int, nargs='+', default=[1, 100, 10000])
+    parser.add_argument('--room-size', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=20000)
+    args = parser.parse_args()
+    for rooms in args.rooms:
+        print(json.dumps(await run_case(rooms, args.room_size, args.messages)))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,122 @@
+"""
+SDK 多路复用基准测试
+
+    python -m benchmarks.bench_sdk
+    python -m benchmarks.bench_sdk --users 1000 --connections 1000 4 1 --json
+
+对每个连接数启动一次 `server.py`（关闭限流），用 ChatSDK 在这么多条连接上 join --users 个用户
+（每 --room-size 个一个房间；连接数等于用户数就是每个用户一条连接），比较：
+    join 耗时，以及服务端进程 join 前后的 VmRSS
+    lockstep   --messages 条消息，每条等到 ack 再发下一条（每个用户一个协程，同时进行）
+    pipelined  同样的消息全部先发出去再等 ack，每条连接最多 --in-flight 个在途
+报告每秒确认的消息数，以及客户端收到的消息帧数：复用时同一房间的广播每条连接只收一份。
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+from benchmarks.bench_files import _memory
+from benchmarks.bench_workers import REPO_ROOT, _wait_for_port
+from core.message_types import MESSAGE
+from core.sdk import ChatSDK
+
+
+async def _lockstep(users, messages):
+    async def run(user, count):
+        for i in range(count):
+            await user.send(f"m{i}")
+    await asyncio.gather(*(run(user, messages // len(users) + (i < messages % len(users)))
+                           for i, user in enumerate(users)))
+
+
+async def _pipelined(users, messages):
+    acks = [await users[i % len(users)].post(f"m{i}") for i in range(messages)]
+    await asyncio.gather(*acks)
+
+
+async def run_case(pid, port, users, connections, room_size, messages, in_flight):
+    sdk = ChatSDK('localhost', port, connections=connections, max_in_flight=in_flight,
+                  event_queue_size=100000, reconnect=False)
+    received = 0
+
+    async def consume():
+        nonlocal received
+        async for event in sdk:
+            if event.type == MESSAGE:
+                received += 1
+
+    rss_before = _memory(pid)['VmRSS']
+    started = time.perf_counter()
+    await sdk.connect()
+    consumer = asyncio.create_task(consume())
+    bots = [await sdk.join(f"bot{i}", room=f"room{i // room_size}") for i in range(users)]
+    join_time = time.perf_counter() - started
+    await asyncio.sleep(0.5)
+    rss_joined = _memory(pid)['VmRSS']
+
+    result = {
+        'users': users,
+        'connections': connections,
+        'join_sec': round(join_time, 2),
+        'server_rss_before_mb': round(rss_before / 1024, 1),
+        'server_rss_joined_mb': round(rss_joined / 1024, 1),
+        'server_kb_per_user': round((rss_joined - rss_before) / users, 1),
+    }
+    for name, send in (('lockstep', _lockstep), ('pipelined', _pipelined)):
+        frames = _received_frames(sdk)
+        started = time.perf_counter()
+        await send(bots, messages)
+        elapsed = time.perf_counter() - started
+        result[f"{name}_acks_per_sec"] = round(messages / elapsed)
+        result[f"{name}_frames"] = _received_frames(sdk) - frames
+    await asyncio.sleep(0.2)
+    result['message_events'] = received
+    await sdk.close()
+    consumer.cancel()
+    return result
+
+
+def _received_frames(sdk):
+    # websocket frames the client took off the wire, over all connections
+    return sum(connection.frames for connection in sdk.connections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='many bot users over many or few multiplexed connections')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--connections', type=int, nargs='+', default=None,
+                        help='connection counts to compare, default: one per user, 4 and 1')
+    parser.add_argument('--room-size', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=5000, help='messages sent in each mode')
+    parser.add_argument('--in-flight', type=int, default=256, help='unacknowledged requests per connection')
+    parser.add_argument('--port', type=int, default=12396)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for connections in args.connections or (args.users, 4, 1):
+        server = subprocess.Popen(
+            [sys.executable, 'server.py', '--port', str(args.port), '--rate-limit', '0',
+             '--max-channels', str(args.users), '--history', '0', '--log-level', 'off'],
+            cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not _wait_for_port(args.port):
+                raise RuntimeError("server did not start")
+            result = asyncio.run(run_case(server.pid, args.port, args.users, connections, args.room_size,
+                                          args.messages, args.in_flight))
+        finally:
+            server.terminate()
+            server.wait()
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{args.users} users / {connections:<5} connections  join={result['join_sec']}s  "
+                  f"server RSS +{result['server_kb_per_user']}KB/user  "
+                  f"lockstep={result['lockstep_acks_per_sec']}/s pipelined={result['pipelined_acks_per_sec']}/s  "
+                  f"frames received={result['pipelined_frames']}  events={result['message_events']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+搜索索引基准测试
+
+    python -m benchmarks.bench_search
+    python -m benchmarks.bench_search --messages 10000000 --json
+
+index      往临时目录的 MessageLog 写 --messages 条合成消息（Zipf 分布的词表，两成带中文），
+           同时建搜索索引；报告每条消息的切词 + 追加耗时、等后台合并结束后的段数和进程 RSS
+query      各类查询各跑 --queries 次（search() + 从日志读出结果），报告 p50 / p99 / 最大耗时：
+           罕见词、高频词、两个高频词、很少同时出现的两个中频词、词 + 房间、词 + 用户、
+           词 + 最近 1% 的时间范围、中文短语（三个 bigram）、深翻页（before 在中间）
+broadcast  一个 10 人房间，ChatServer.handle_chat_message（带日志）在开关搜索时的单次耗时 p50 / p99；
+           开启时切词推迟到这一轮之后，另报告算上切词的每条总耗时
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.bench_fanout import _FakeConnection, _percentile
+from benchmarks.bench_files import _memory
+from core.chat_server import ChatServer
+from core.message_log import MessageLog
+from core.search import SearchIndex, room_term, tokenize, user_term
+
+VOCABULARY = 100000
+USERS = 10000
+ROOMS = 1000
+_HANZI = [chr(0x4e00 + i) for i in range(0, 20000, 10)]  # 2000 characters
+
+
+class _Corpus:
+    # synthetic chat: 3-12 words drawn from a Zipf(1.1) vocabulary, a fifth with one of 1000 chinese phrases
+    def __init__(self, seed=1):
+        self.random = random.Random(seed)
+        self.words = [f"w{i}" for i in range(VOCABULARY)]
+        self.weights = list(itertools.accumulate(1 / (rank + 1) ** 1.1 for rank in range(VOCABULARY)))
+        phrases = random.Random(0)
+        self.phrases = [''.join(phrases.choices(_HANZI, k=4)) for _ in range(1000)]
+        self.phrase_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(1000)))
+
+    def message(self):
+        r = self.random
+        words = r.choices(self.words, cum_weights=self.weights, k=r.randrange(3, 13))
+        if r.random() < 0.2:
+            words.append(r.choices(self.phrases, cum_weights=self.phrase_weights)[0])
+        return {'type': 'message', 'username': f"user{r.randrange(USERS)}", 'room': f"room{r.randrange(ROOMS)}",
+                'content': ' '.join(words)}
+
+
+async def build(directory, messages):
+    message_log = MessageLog(directory, fsync_interval=1.0, fsync_batch=1 << 30)
+    await message_log.start()
+    index = SearchIndex(message_log)
+    await index.start()
+    corpus = _Corpus()
+    clock = 1_700_000_000_000
+    indexing = 0.0
+    for _ in range(0, messages, 1000):
+        batch = []
+        for _ in range(min(1000, messages - message_log.next_cursor + 1)):
+            data = corpus.message()
+            clock += 7
+            data['timestamp'] = clock
+            cursor = message_log.append(data['room'], json.dumps(data, separators=(',', ':')), clock)
+            batch.append((cursor, data))
+        started = time.perf_counter()
+        for cursor, data in batch:
+            index.add(cursor, data['timestamp'], data['room'], data)
+        index._drain()
+        indexing += time.perf_counter() - started
+        # lets the compactions in the thread pool land
+        await asyncio.sleep(0)
+    started = time.perf_counter()
+    while index._next_job() is not None:
+        await asyncio.sleep(0.05)
+    settle = time.perf_counter() - started
+    return message_log, index, corpus, {
+        'messages': messages,
+        'index_us_per_message': round(indexing / messages * 1e6, 2),
+        'compaction_wait_sec': round(settle, 1),
+        'segments': len(index.segments),
+        'compactions': index.compactions,
+        'rss_mb': round(_memory(os.getpid())['VmRSS'] / 1024),
+    }
+
+
+def _queries(index, corpus, kind, count):
+    r = random.Random(kind)
+    words = corpus.words
+    newest = index.memtable.base + len(index.memtable) - 1
+    last_ms = index.locate(newest)[1]
+    first_ms = index.locate(1)[1]
+    for _ in range(count):
+        args = {}
+        if kind == 'rare':
+            terms = [words[r.randrange(20000, VOCABULARY)]]
+        elif kind == 'common':
+            terms = [words[r.randrange(10)]]
+        elif kind == 'two_common':
+            terms = [words[r.randrange(10)], words[r.randrange(10, 30)]]
+        elif kind == 'two_mid':
+            # rarely in the same message: the case the scan budget is for
+            terms = [words[r.randrange(200, 400)], words[r.randrange(400, 800)]]
+        elif kind == 'word_room':
+            terms = [words[r.randrange(100)], room_term(f"room{r.randrange(ROOMS)}")]
+        elif kind == 'word_user':
+            terms = [words[r.randrange(100)], user_term(f"user{r.randrange(USERS)}")]
+        elif kind == 'recent':
+            terms = [words[r.randrange(10)]]
+            args['start'] = last_ms - (last_ms - first_ms) // 100
+        elif kind == 'chinese':
+            # three bigrams that must all match
+            terms = tokenize(corpus.phrases[r.randrange(100)])
+        else:  # deep_page
+            terms = [words[r.randrange(100)]]
+            args['before'] = r.randrange(newest // 4, newest // 2)
+        yield terms, args
+
+
+def run_queries(index, corpus, count):
+    results = {}
+    for kind in ('rare', 'common', 'two_common', 'two_mid', 'word_room', 'word_user', 'recent', 'chinese',
+                 'deep_page'):
+        latencies = []
+        found = 0
+        for terms, args in _queries(index, corpus, kind, count):
+            started = time.perf_counter()
+            cursors, _ = index.search(terms, limit=20, **args)
+            index.read(cursors)
+            latencies.append(time.perf_counter() - started)
+            found += len(cursors)
+        latencies.sort()
+        results[kind] = {
+            'p50_ms': round(_percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(_percentile(latencies, 99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3),
+            'avg_results': round(found / count, 1),
+        }
+    return results
+
+
+async def run_broadcast(search, messages):
+    with tempfile.TemporaryDirectory() as directory:
+        server = ChatServer(heartbeat_interval=0, mailbox_size=0, message_log=MessageLog(directory),
+                            search=search)
+        await server.message_log.start()
+        if server.search_index is not None:
+            await server.search_index.start()
+        members = [_FakeConnection(i) for i in range(10)]
+        for i, connection in enumerate(members):
+            server.add_connection(connection)
+            await server.handle_join({'username': f"user{i}", 'room': 'lobby', 'history': 0}, connection)
+        corpus = _Corpus(2)
+        latencies = []
+        started = time.perf_counter()
+        for i in range(messages):
+            data = {'type': 'message', 'content': corpus.message()['content']}
+            sent = time.perf_counter()
+            await server.handle_chat_message(data, members[i % len(members)])
+            latencies.append(time.perf_counter() - sent)
+            if i % 64 == 0:
+                # the loop rounds where the deferred indexing runs
+                await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        total = time.perf_counter() - started
+        if server.search_index is not None:
+            await server.search_index.close()
+        await server.message_log.close()
+    latencies.sort()
+    return {
+        'search': search,
+        'p50_us': round(_percentile(latencies, 50) * 1e6, 1),
+        'p99_us': round(_percentile(latencies, 99) * 1e6, 1),
+        'total_us_per_message': round(total / messages * 1e6, 1),
+    }
+
+
+async def _index_and_query(args):
+    with tempfile.TemporaryDirectory() as directory:
+        message_log, index, corpus, build_result = await build(directory, args.messages)
+        query_results = run_queries(index, corpus, args.queries)
+        await index.close()
+        await message_log.close()
+    return build_result, query_results
+
+
+async def run(args):
+    build_result, query_results = await _index_and_query(args)
+    # the big index is gone, it would only make the garbage collector slower for both broadcast cases
+    gc.collect()
+    broadcast = [await run_broadcast(search, args.broadcasts) for search in (False, True)]
+    return build_result, query_results, broadcast
+
+
+def main():
+    parser = argparse.ArgumentParser(description='search index build, query latency and broadcast overhead')
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200, help='queries of each kind')
+    parser.add_argument('--broadcasts', type=int, default=20000)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per section')
+    args = parser.parse_args()
+
+    build_result, query_results, broadcast = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(build_result))
+        print(json.dumps(query_results))
+        for result in broadcast:
+            print(json.dumps(result))
+        return
+    print(f"index  {build_result['messages']} messages  {build_result['index_us_per_message']}us/message  "
+          f"segments={build_result['segments']} compactions={build_result['compactions']} "
+          f"(settled in {build_result['compaction_wait_sec']}s)  RSS={build_result['rss_mb']}MB")
+    for kind, result in query_results.items():
+        print(f"query  {kind:<10} p50={result['p50_ms']}ms p99={result['p99_ms']}ms max={result['max_ms']}ms  "
+              f"results={result['avg_results']}")
+    for result in broadcast:
+        print(f"broadcast search={'on ' if result['search'] else 'off'} handle_chat_message "
+              f"p50={result['p50_us']}us p99={result['p99_us']}us  "
+              f"with deferred indexing {result['total_us_per_message']}us/message")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+会话注册表内存基准测试
+
+    python -m benchmarks.bench_sessions
+    python -m benchmarks.bench_sessions --sessions 100000 --json
+
+对 --sessions 个已 join 的假连接（每个人在 --rooms 个房间中的一个），用 tracemalloc 统计：
+    legacy    原来的布局：connected_clients 集合 + outbound_queues / codecs 字典
+              + UserManager 的 {websocket: {'username', 'join_time'(ISO 字符串), 'room'}} 和双向房间索引
+    sessions  core/session.py 的 SessionRegistry：每个连接一个 slotted Session + 用户名 / 房间索引
+两者都包含每个连接的 OutboundQueue（空闲时已不再分配 deque），不包含连接对象本身。
+"""
+import argparse
+import json
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.bench_fanout import _FakeConnection
+from core.chat_server import ChatServer
+from core.outbound import OutboundQueue
+
+
+def _legacy(connections, rooms):
+    # the structures SocketBase and UserManager used to keep per connection
+    connected_clients = set()
+    outbound_queues = {}
+    codecs = {}
+    clients = {}
+    room_members = {}
+    user_rooms = {}
+    for i, connection in enumerate(connections):
+        connected_clients.add(connection)
+        outbound_queues[connection] = OutboundQueue(connection)
+        room = f"room{i % rooms}"
+        clients[connection] = {'username': f"user{i}", 'join_time': datetime.now().isoformat(), 'room': room}
+        room_members.setdefault(room, set()).add(connection)
+        user_rooms.setdefault(connection, set()).add(room)
+    return connected_clients, outbound_queues, codecs, clients, room_members, user_rooms
+
+
+def _sessions(connections, rooms):
+    server = ChatServer(heartbeat_interval=0)
+    for i, connection in enumerate(connections):
+        server.add_connection(connection)
+        server.sessions.add_user(connection, f"user{i}", f"room{i % rooms}")
+    return server
+
+
+def run_case(mode, count, rooms):
+    connections = [_FakeConnection(i) for i in range(count)]
+    build = _legacy if mode == 'legacy' else _sessions
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(connections, rooms)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return {'mode': mode, 'sessions': count, 'rooms': rooms,
+            'total_mb': round(used / 2 ** 20, 1), 'bytes_per_session': round(used / count)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='session registry memory benchmark')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per case')
+    args = parser.parse_args()
+
+    for count in args.sessions:
+        for mode in ('legacy', 'sessions'):
+            result = run_case(mode, count, args.rooms)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{mode:>8}  sessions={count:<7} total={result['total_mb']}MB  "
+                      f"per_session={result['bytes_per_session']}B")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+多核模式负载基准测试
+
+    python -m benchmarks.bench_workers --workers 1 2 4 --clients 400 --rooms 20
+
+对每个 worker 数启动一次 `server.py --workers N`，由多个负载进程（每个进程若干 ChatClient）
+同时发消息，统计全部客户端收到的消息总数 / 耗时，得到 1..N 个 worker 的吞吐变化。
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from core.chat_client import ChatClient
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _CountingClient(ChatClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = 0
+        self.last_received = 0.0
+
+    async def handle_server_message(self, raw_message):
+        if '"type":"message"' in raw_message:
+            self.received += 1
+            self.last_received = time.time()
+
+
+async def _load(port, first_user, clients, rooms, messages, start_at, settle):
+    users = []
+    for i in range(first_user, first_user + clients):
+        client = _CountingClient('localhost', port)
+        client.chatroom_name = f"room{i % rooms}"
+        if await client.connect_to_server(f"user{i}"):
+            users.append(client)
+    listeners = [asyncio.create_task(client.listen_for_messages(client.handle_server_message))
+                 for client in users]
+
+    await asyncio.sleep(max(0.0, start_at - time.time()))
+    started = time.time()
+    for n in range(messages):
+        for client in users:
+            await client.send_chat_message(f"message {n}")
+    # let the tail of the fan-out arrive
+    await asyncio.sleep(settle)
+    received = sum(client.received for client in users)
+    last_received = max((client.last_received for client in users), default=started)
+
+    for task in listeners:
+        task.cancel()
+    for client in users:
+        await client.close()
+    return {'connected': len(users), 'received': received, 'started': started,
+            'last_received': last_received}
+
+
+def _load_process(args, queue):
+    sys.stdout = open(os.devnull, 'w')  # ChatClient prints on every connect
+    queue.put(asyncio.run(_load(*args)))
+
+
+def _wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def run_case(workers, port, clients, rooms, messages, load_processes, settle):
+    server = subprocess.Popen(
+        [sys.executable, 'server.py', '--workers', str(workers), '--port', str(port)],
+        cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not _wait_for_port(port):
+            raise RuntimeError("server did not start")
+        ctx = multiprocessing.get_context('fork')
+        queue = ctx.Queue()
+        per_process = clients // load_processes
+        start_at = time.time() + 2.0 + clients / 500
+        processes = []
+        for p in range(load_processes):
+            args = (port, p * per_process, per_process, rooms, messages, start_at, settle)
+            process = ctx.Process(target=_load_process, args=(args, queue))
+            process.start()
+            processes.append(process)
+        results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    received = sum(r['received'] for r in results)
+    elapsed = max(r['last_received'] for r in results) - min(r['started'] for r in results)
+    connected = sum(r['connected'] for r in results)
+    expected = connected * messages * (connected // rooms)
+    return {
+        'workers': workers,
+        'clients': connected,
+        'rooms': rooms,
+        'messages_sent': connected * messages,
+        'deliveries': received,
+        'expected_deliveries': expected,
+        'deliveries_per_sec': round(received / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='multi-worker throughput benchmark')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--port', type=int, default=12390)
+    parser.add_argument('--clients', type=int, default=400)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=20, help='messages sent by every client')
+    parser.add_argument('--load-processes', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='seconds to wait for deliveries after the last send')
+    args = parser.parse_args()
+
+    print(f"cpu count: {os.cpu_count()}")
+    for workers in args.workers:
+        result = run_case(workers, args.port, args.clients, args.rooms, args.messages,
+                          args.load_processes, args.settle)
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+"""
+负载生成器 / 端到端延迟基准测试
+
+    python -m benchmarks.loadgen --spawn --users 2000 --processes 4 --rooms 20 --rate 1 --duration 20
+    python -m benchmarks.loadgen --port 12345 --server-pid 4242 --users 500 --output run.json
+    python -m benchmarks.loadgen --compare before.json after.json
+
+用 ChatClient 模拟大量用户：按 --ramp（连接/秒）逐步建立连接，分布到 --rooms 个房间
+（uniform 或 zipf 分布），然后每个用户以 --rate 条/秒发消息，持续 --duration 秒。
+每条消息的内容带发送时间，接收方据此计算端到端延迟。
+结果是一个 JSON 对象：连接速率、收发消息数、消息/秒、延迟直方图的 p50 / p99 / p999，
+以及服务器进程（含 worker 子进程）的 RSS。--output 写入文件，--compare 对比两次结果。
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+from core.chat_client import ChatClient
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MARKER = 'lg'  # content prefix of loadgen messages: "lg <sent_at> <seq>"
+
+
+class LatencyHistogram:
+    """对数分桶的延迟直方图（相对误差约 2%），可以跨进程合并"""
+    GROWTH = 1.02
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or {}  # {bucket index: count}, values in microseconds
+        self.count = sum(self.buckets.values())
+
+    def record(self, seconds):
+        micros = max(seconds * 1e6, 1.0)
+        index = int(math.log(micros, self.GROWTH))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+
+    def percentile(self, pct):
+        # upper bound of the bucket holding the pct-th value, in milliseconds
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * pct / 100)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return round(self.GROWTH ** (index + 1) / 1000, 3)
+        return 0.0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'p99_ms': self.percentile(99),
+            'p999_ms': self.percentile(99.9),
+            'max_ms': self.percentile(100),
+        }
+
+
+class LoadClient(ChatClient):
+    # records latency instead of printing every event
+    def __init__(self, *args, histogram=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.histogram = histogram
+        self.received = 0
+        self.last_received = 0.0
+
+    def handle_event(self, message_data):
+        if message_data.get('type') != 'message':
+            return
+        content = message_data.get('content', '')
+        if not content.startswith(MARKER):
+            return
+        now = time.time()
+        self.received += 1
+        self.last_received = now
+        self.histogram.record(now - float(content.split(' ', 2)[1]))
+
+
+def pick_room(index, rooms, distribution, rng):
+    if distribution == 'zipf':
+        # room k gets a share proportional to 1 / (k + 1)
+        weights = [1 / (k + 1) for k in range(rooms)]
+        return f"room{rng.choices(range(rooms), weights)[0]}"
+    return f"room{index % rooms}"
+
+
+async def _send_loop(client, rate, duration, start_at, sent):
+    if rate <= 0:
+        return
+    interval = 1 / rate
+    # spread the users over the first interval so they do not send in lockstep
+    next_at = start_at + random.random() * interval
+    end_at = start_at + duration
+    seq = 0
+    while next_at < end_at:
+        delay = next_at - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await client.send_chat_message(f"{MARKER} {time.time():.6f} {seq}")
+        sent[client.chatroom_name] = sent.get(client.chatroom_name, 0) + 1
+        seq += 1
+        next_at += interval
+
+
+async def _load(config, first_user, users, barrier):
+    rng = random.Random(config['seed'] + first_user)
+    histogram = LatencyHistogram()
+    clients = []
+    members = {}  # {room: connected users of this process}
+    connect_times = []
+    failures = 0
+
+    # ramp: each process opens its share of connections at its share of the rate
+    ramp = config['ramp'] / config['processes']
+    started = time.time()
+    for n in range(users):
+        delay = started + n / ramp - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        client = LoadClient(config['host'], config['port'], codec=config['codec'], histogram=histogram)
+        client.chatroom_name = pick_room(first_user + n, config['rooms'], config['distribution'], rng)
+        t0 = time.time()
+        if await client.connect_to_server(f"user{first_user + n}"):
+            connect_times.append(time.time() - t0)
+            clients.append(client)
+            members[client.chatroom_name] = members.get(client.chatroom_name, 0) + 1
+        else:
+            failures += 1
+    connected_at = time.time()
+    listeners = [asyncio.create_task(client.listen_for_messages(client.handle_server_message))
+                 for client in clients]
+
+    # every process starts sending at the same moment
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, barrier.wait)
+    start_at = time.time() + 0.5
+    sent = {}  # {room: messages sent by this process}
+    await asyncio.gather(*(_send_loop(client, config['rate'], config['duration'], start_at, sent)
+                           for client in clients))
+    # wait for the tail of the fan-out, until nothing arrived for a while
+    deadline = time.time() + config['settle']
+    while time.time() < deadline:
+        last = max((client.last_received for client in clients), default=0.0)
+        if last and time.time() - last > 0.5:
+            break
+        await asyncio.sleep(0.1)
+
+    # the listeners keep reading while closing, or leave notices fill the
+    # receive queue and every close handshake waits for its timeout
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+    for task in listeners:
+        task.cancel()
+    connect_times.sort()
+    return {
+        'connected': len(clients),
+        'failures': failures,
+        'ramp_seconds': connected_at - started,
+        'connect_p99_ms': round(connect_times[int(len(connect_times) * 0.99)] * 1000, 3)
+        if connect_times else 0.0,
+        'members': members,
+        'sent': sent,
+        'received': sum(client.received for client in clients),
+        'start_at': start_at,
+        'last_received': max((client.last_received for client in clients), default=start_at),
+        'histogram': histogram.buckets,
+    }
+
+
+def _load_process(config, first_user, users, barrier, queue):
+    sys.stdout = open(os.devnull, 'w')  # ChatClient prints on every connect
+    try:
+        queue.put(asyncio.run(_load(config, first_user, users, barrier)))
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+def rss_kb(pid):
+    """进程及其子进程（worker）的常驻内存，单位 KB；读不到时返回 None"""
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pending.extend(int(child) for child in f.read().split())
+    except (OSError, ValueError):
+        return total or None
+    return total
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, host='localhost', timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def spawn_server(port, extra_args=()):
+    """在空闲端口上启动 server.py，等到端口可连接后返回进程"""
+    process = subprocess.Popen([sys.executable, 'server.py', '--port', str(port), *extra_args],
+                               cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_port(port):
+        process.kill()
+        raise RuntimeError("server did not start")
+    return process
+
+
+def _version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_load(config, server_pid=None):
+    """按 config 跑一次负载，返回结果 dict（见模块说明）"""
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    processes = config['processes']
+    barrier = ctx.Barrier(processes)
+    per_process = [config['users'] // processes + (1 if p < config['users'] % processes else 0)
+                   for p in range(processes)]
+    workers = []
+    first_user = 0
+    for users in per_process:
+        process = ctx.Process(target=_load_process, args=(config, first_user, users, barrier, queue))
+        process.start()
+        workers.append(process)
+        first_user += users
+
+    rss_start = rss_kb(server_pid) if server_pid else None
+    rss_peak = rss_start
+    results = []
+    while len(results) < processes:
+        try:
+            results.append(queue.get(timeout=0.5))
+        except Exception:
+            if not any(process.is_alive() for process in workers):
+                break
+        if server_pid:
+            rss = rss_kb(server_pid)
+            if rss and (rss_peak is None or rss > rss_peak):
+                rss_peak = rss
+    rss_end = rss_kb(server_pid) if server_pid else None
+    for process in workers:
+        process.join(timeout=5)
+
+    errors = [r['error'] for r in results if 'error' in r]
+    results = [r for r in results if 'error' not in r]
+    if not results:
+        raise RuntimeError(f"load processes failed: {errors}")
+
+    histogram = LatencyHistogram()
+    members = {}
+    sent = {}
+    for r in results:
+        histogram.merge(LatencyHistogram({int(k): v for k, v in r['histogram'].items()}))
+        for room, count in r['members'].items():
+            members[room] = members.get(room, 0) + count
+        for room, count in r['sent'].items():
+            sent[room] = sent.get(room, 0) + count
+    # every message goes to every member of its room, the sender included
+    expected = sum(count * members.get(room, 0) for room, count in sent.items())
+    received = sum(r['received'] for r in results)
+    connected = sum(r['connected'] for r in results)
+    ramp_seconds = max(r['ramp_seconds'] for r in results)
+    elapsed = max(r['last_received'] for r in results) - min(r['start_at'] for r in results)
+    return {
+        'version': _version(),
+        'config': config,
+        'connected': connected,
+        'connect_failures': sum(r['failures'] for r in results),
+        'connects_per_sec': round(connected / ramp_seconds, 1) if ramp_seconds > 0 else None,
+        'connect_p99_ms': max(r['connect_p99_ms'] for r in results),
+        'sent': sum(sent.values()),
+        'received': received,
+        'expected': expected,
+        'delivery_ratio': round(received / expected, 4) if expected else None,
+        'sent_per_sec': round(sum(sent.values()) / config['duration'], 1),
+        'received_per_sec': round(received / elapsed, 1) if elapsed > 0 else None,
+        'latency': histogram.summary(),
+        'server_rss_kb': {'start': rss_start, 'peak': rss_peak, 'end': rss_end},
+        'errors': errors,
+    }
+
+
+def _flatten(result, prefix=''):
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(before_path, after_path):
+    """逐项打印两次结果中数值字段的变化"""
+    with open(before_path) as f:
+        before = _flatten(json.load(f))
+    with open(after_path) as f:
+        after = _flatten(json.load(f))
+    for key in sorted(before.keys() | after.keys()):
+        old, new = before.get(key), after.get(key)
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else ''
+        print(f"{key:<28} {old!s:>14} {new!s:>14} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='chat server load generator')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--spawn', action='store_true',
+                        help='start server.py on a free port for this run')
+    parser.add_argument('--server-args', default='',
+                        help='extra arguments for the spawned server, e.g. "--workers 4"')
+    parser.add_argument('--server-pid', type=int, help='pid of an already running server, for RSS')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--processes', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--ramp', type=float, default=500, help='new connections per second')
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--distribution', choices=('uniform', 'zipf'), default='uniform')
+    parser.add_argument('--rate', type=float, default=1.0, help='messages per second per user')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of sending')
+    parser.add_argument('--settle', type=float, default=10.0,
+                        help='seconds to wait at most for deliveries after the last send')
+    parser.add_argument('--codec', default='json')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the result to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='print the difference between two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    config = {key: getattr(args, key) for key in (
+        'host', 'port', 'users', 'processes', 'ramp', 'rooms', 'distribution',
+        'rate', 'duration', 'settle', 'codec', 'seed')}
+    server = None
+    server_pid = args.server_pid
+    if args.spawn:
+        config['port'] = free_port()
+        config['server_args'] = args.server_args
+        server = spawn_server(config['port'], shlex.split(args.server_args))
+        server_pid = server.pid
+    try:
+        result = run_load(config, server_pid)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    text = json.dumps(result, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,36 @@
+import argparse
 import asyncio
+import os
 from core.chat_client import ChatClient
+from core.codec import CODECS, JSON
+from core.log import LEVELS, setup_logging
 
-async def main():
-    client = ChatClient(server_host='localhost', server_port=12345)
+def parse_args():
+    parser = argparse.ArgumentParser(description='WebSocket 聊天室客户端')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--codec', choices=sorted(CODECS), default=JSON,
+                        help='wire format to offer at join, json is the fallback')
+    parser.add_argument('--compression', action='store_true',
+                        help='offer permessage-deflate, used if the server enables it')
+    parser.add_argument('--no-reconnect', dest='reconnect', action='store_false',
+                        help='exit when the connection drops instead of reconnecting and resuming')
+    parser.add_argument('--token', default=os.environ.get('CHAT_TOKEN'),
+                        help='join token when the server requires one (default: $CHAT_TOKEN)')
+    parser.add_argument('--download-dir', default='.', help='where /get saves files')
+    parser.add_argument('--log-level', choices=LEVELS, default='warning')
+    return parser.parse_args()
+
+async def main(args):
+    client = ChatClient(server_host=args.host, server_port=args.port, codec=args.codec,
+                        compression=args.compression, reconnect=args.reconnect,
+                        download_dir=args.download_dir, auth_token=args.token)
     await client.run()
         
 if __name__ == '__main__':
+    args = parse_args()
+    setup_logging(args.log_level)
     try:
-        asyncio.run(main())
+        asyncio.run(main(args))
     except KeyboardInterrupt:
-        print("\n客户端已退出")
\ No newline at end of file
+        print("\n客户端已退出")
@@ -0,0 +1,205 @@
+"""
+join 认证：HMAC 签名令牌
+
+令牌由登录服务或运维脚本用共享密钥签发，服务端本地校验，不需要回调签发方：
+    base64url({"sub": 用户名, "exp": 过期时间（epoch 秒）}) "." base64url(HMAC-SHA256(secret, 前半段))
+签名和过期时间通过之后再查用户库（UserStore，可替换：全部允许 / 用户名文件 / 自己实现的异步查询），
+不存在或被移除的用户拒绝。用户名以令牌里的为准。
+校验结果按令牌缓存（LRU + TTL，不超过令牌自己的 exp），重连风暴时同一个令牌只完整校验一次；
+用户被移除后最多还能凭缓存再登录 cache_ttl 秒。
+没有命中缓存的校验按来源 IP 限速（令牌桶），伪造令牌的洪水只能占用有限的 CPU 和用户库查询。
+
+签发一个令牌：
+    python -m core.auth --secret-file secret.key --ttl 86400 alice
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from collections import OrderedDict
+
+from core.presence import fold_name
+from core.ratelimit import TokenBucket
+
+
+class AuthError(Exception):
+    pass
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def issue_token(secret, username, ttl=86400, now=None):
+    """签发 username 的令牌，ttl 秒后过期"""
+    expires = int((time.time() if now is None else now) + ttl)
+    body = _b64encode(json.dumps({'sub': username, 'exp': expires}, separators=(',', ':')).encode('utf-8'))
+    signature = hmac.new(secret, body.encode('ascii'), hashlib.sha256).digest()
+    return f"{body}.{_b64encode(signature)}"
+
+
+def verify_token(secret, token, now=None):
+    """校验签名和过期时间，返回 (username, exp)；不通过时抛 AuthError"""
+    body, _, signature = token.partition('.')
+    try:
+        expected = hmac.new(secret, body.encode('ascii'), hashlib.sha256).digest()
+        if not hmac.compare_digest(_b64decode(signature), expected):
+            raise AuthError("Invalid token")
+        claims = json.loads(_b64decode(body))
+        username, expires = claims['sub'], claims['exp']
+    except (ValueError, TypeError, KeyError):
+        # not ascii, not base64, not json, or missing claims
+        raise AuthError("Invalid token") from None
+    if not isinstance(username, str) or not username.strip() or not isinstance(expires, (int, float)):
+        raise AuthError("Invalid token")
+    if expires <= (time.time() if now is None else now):
+        raise AuthError("Token expired")
+    return username, expires
+
+
+class UserStore:
+    """用户库：lookup() 判断令牌里的用户现在是否允许登录；默认全部允许"""
+
+    async def lookup(self, username):
+        return True
+
+
+class FileUserStore(UserStore):
+    # allowed usernames, one per line ('#' comments); the file is read again when it changes
+    def __init__(self, path):
+        self.path = path
+        self.users = frozenset()
+        self._mtime = None
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self._mtime:
+            with open(self.path, encoding='utf-8') as file:
+                lines = (line.split('#', 1)[0].strip() for line in file)
+                self.users = frozenset(fold_name(line) for line in lines if line)
+            self._mtime = mtime
+
+    async def lookup(self, username):
+        self._load()
+        return fold_name(username) in self.users
+
+
+class TokenCache:
+    """校验过的令牌 -> 用户名，LRU，条目在 ttl 秒或令牌过期时失效（取的时候才检查）"""
+
+    def __init__(self, max_size=10000, ttl=300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # {token: (username, expires at)}, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, token, now):
+        entry = self.entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[1] <= now:
+            del self.entries[token]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, token, username, expires, now):
+        if self.max_size <= 0:
+            return
+        if token not in self.entries and len(self.entries) >= self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self.entries[token] = (username, min(now + self.ttl, expires))
+
+
+class Authenticator:
+    def __init__(self, secret, store=None, cache_size=10000, cache_ttl=300.0, ip_limit=(5, 20),
+                 max_ips=10000):
+        if not secret:
+            raise ValueError("auth secret cannot be empty")
+        self.secret = secret
+        self.store = store if store is not None else UserStore()
+        self.cache = TokenCache(cache_size, cache_ttl)
+        # (rate per second, burst) of full verifications per client IP, rate 0 = unlimited
+        self.ip_limit = ip_limit
+        self.max_ips = max_ips
+        self.ips = OrderedDict()  # {ip: TokenBucket}, least recently seen first
+        self.verified = 0
+        self.failures = 0
+        self.throttled = 0
+
+    def _allow(self, ip):
+        rate, burst = self.ip_limit
+        if rate <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self.ips.get(ip)
+        if bucket is None:
+            if len(self.ips) >= self.max_ips:
+                # the least recently seen has most likely refilled anyway
+                self.ips.popitem(last=False)
+            bucket = self.ips[ip] = TokenBucket(rate, burst, now)
+        else:
+            self.ips.move_to_end(ip)
+        return bucket.take(1, now)
+
+    async def authenticate(self, token, ip=None):
+        """返回令牌对应的用户名；令牌无效、用户不允许或该 IP 校验太频繁时抛 AuthError"""
+        if not isinstance(token, str) or not token:
+            self.failures += 1
+            raise AuthError("Authentication required")
+        now = time.time()
+        username = self.cache.get(token, now)
+        if username is not None:
+            return username
+        if not self._allow(ip):
+            self.throttled += 1
+            raise AuthError("Too many authentication attempts, try again later")
+        try:
+            username, expires = verify_token(self.secret, token, now)
+            if not await self.store.lookup(username):
+                raise AuthError("Unknown user")
+        except AuthError:
+            self.failures += 1
+            raise
+        self.verified += 1
+        self.cache.put(token, username, expires, now)
+        return username
+
+    def stats(self):
+        return {'verified': self.verified, 'failures': self.failures, 'throttled': self.throttled,
+                'cache_size': len(self.cache), 'cache_hits': self.cache.hits,
+                'cache_misses': self.cache.misses, 'cache_evictions': self.cache.evictions}
+
+
+def read_secret(path):
+    with open(path, 'rb') as file:
+        return file.read().strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='issue a join token')
+    parser.add_argument('username')
+    parser.add_argument('--secret-file', required=True, help='the server\'s --auth-secret-file')
+    parser.add_argument('--ttl', type=int, default=86400, help='seconds until the token expires')
+    args = parser.parse_args()
+    print(issue_token(read_secret(args.secret_file), args.username, args.ttl))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+广播批量合并（类似 Nagle 算法）
+
+开启后聊天消息不立即广播，而是按房间收集：窗口时间（例如 5 毫秒）到期，
+或者某个房间攒够 max_messages 条时，把这一批合并成一个 batch 帧发给房间成员：
+    {"type": "batch", "room": ..., "messages": [消息, 消息, ...]}
+每个接收者每批只需要一帧、一次写入，用最多一个窗口的延迟换取吞吐。
+"""
+import asyncio
+
+from core.codec import JSON_CODEC, Payload
+from core.message_types import BATCH
+
+
+def build_batch(room, payloads):
+    """把同一房间的多条消息合并成一个 Payload"""
+    if len(payloads) == 1:
+        return payloads[0]
+    data = {'type': BATCH, 'room': room, 'messages': [payload.data for payload in payloads]}
+    # the json form is stitched from the messages' own encodings, which the
+    # log and the history cache need anyway
+    head = JSON_CODEC.encode({'type': BATCH, 'room': room})
+    batch = Payload.from_json(head[:-1] + ',"messages":['
+                              + ','.join(payload.encode(JSON_CODEC) for payload in payloads) + ']}')
+    batch.data = data
+    return batch
+
+
+class Batcher:
+    def __init__(self, send, window=0.005, max_messages=64):
+        self.send = send  # send(room, payload), called with each flushed batch
+        self.window = window
+        self.max_messages = max_messages
+        self.pending = {}  # {room: [payload]}, in arrival order
+        self._timer = None
+        self.batches = 0
+        self.messages = 0
+
+    def add(self, room, payload):
+        batch = self.pending.get(room)
+        if batch is None:
+            batch = self.pending[room] = []
+        batch.append(payload)
+        if len(batch) >= self.max_messages:
+            self.flush_room(room)
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        self.flush()
+
+    def flush_room(self, room):
+        # called before anything else is sent to the room, so ordering holds
+        batch = self.pending.pop(room, None)
+        if batch:
+            self.batches += 1
+            self.messages += len(batch)
+            self.send(room, build_batch(room, batch))
+
+    def flush(self):
+        for room in list(self.pending):
+            self.flush_room(room)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.flush()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'messages': self.messages,
+            'pending': sum(len(batch) for batch in self.pending.values()),
+        }
@@ -0,0 +1,256 @@
+"""
+节点间消息总线
+
+多个 ChatServer 进程（同一台机器上用 SO_REUSEPORT 共享端口，或者分布在多台机器上）
+通过总线互相转发聊天消息和上下线事件。事件是普通 dict：
+    {'node': 发送节点, 'kind': 'broadcast' | 'presence' | 'hello' | 'counts' | 'bye', ...}
+
+InProcessBus  同一进程内多个服务器共享一个 InProcessHub，便于测试
+BrokerBus     连接到 BusBroker（本地 TCP 或 Unix socket），由 broker 转发给其它节点；
+              连接断开后按指数退避重连，断开期间发布的事件丢弃并计数，
+              重连后交给 handler 一个本地的 {'kind': 'reconnected'}，由服务器重新交换房间人数
+BusBroker 给每个节点的写缓冲设高水位（和 OutboundQueue 的 disconnect 策略一样）：
+读得太慢的节点被断开，它重连后重新同步，broker 的内存不会无限增长。
+"""
+import asyncio
+import random
+import struct
+import uuid
+
+from core.codec import JSON_CODEC
+from core.log import get_logger
+
+log = get_logger('bus')
+
+_LENGTH = struct.Struct('!I')
+
+
+class Bus:
+    def __init__(self, node_id=None):
+        self.node_id = node_id or uuid.uuid4().hex[:8]
+        self.handler = None
+        self.disconnects = 0  # times the link to the other nodes was lost
+        self.dropped = 0  # events published while it was down
+
+    async def start(self, handler):
+        # handler(event) is awaited for every event published by another node
+        self.handler = handler
+
+    async def publish(self, event):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class InProcessHub:
+    def __init__(self):
+        self.buses = []
+        # handler tasks in flight, the loop only keeps weak references to tasks
+        self.tasks = set()
+
+    def deliver(self, sender, event):
+        for bus in self.buses:
+            if bus is not sender and bus.handler is not None:
+                task = asyncio.create_task(bus.handler(event))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+
+class InProcessBus(Bus):
+    def __init__(self, hub, node_id=None):
+        super().__init__(node_id)
+        self.hub = hub
+
+    async def start(self, handler):
+        await super().start(handler)
+        self.hub.buses.append(self)
+
+    async def publish(self, event):
+        event['node'] = self.node_id
+        self.hub.deliver(self, event)
+
+    async def close(self):
+        if self in self.hub.buses:
+            self.hub.buses.remove(self)
+            self.hub.deliver(self, {'node': self.node_id, 'kind': 'bye'})
+
+
+async def _read_event(reader):
+    header = await reader.readexactly(_LENGTH.size)
+    body = await reader.readexactly(_LENGTH.unpack(header)[0])
+    return body
+
+
+def _frame(event):
+    body = JSON_CODEC.encode(event).encode('utf-8')
+    return _LENGTH.pack(len(body)) + body
+
+
+class BusBroker:
+    """把每个节点发来的事件转发给其它所有节点"""
+
+    def __init__(self, host='127.0.0.1', port=12399, path=None, max_buffer=16 * 1024 * 1024):
+        self.host = host
+        self.port = port
+        self.path = path  # unix socket path, takes precedence over host/port
+        self.max_buffer = max_buffer  # bytes waiting for one node before it is cut off
+        self.server = None
+        self.writers = {}  # {writer: node_id}
+        self.tasks = set()
+        self.slow_disconnects = 0
+
+    async def start(self):
+        if self.path:
+            self.server = await asyncio.start_unix_server(self._handle_node, self.path)
+        else:
+            self.server = await asyncio.start_server(self._handle_node, self.host, self.port)
+        log.info("bus broker started: %s", self.path or f'{self.host}:{self.port}')
+
+    async def _handle_node(self, reader, writer):
+        self.writers[writer] = None
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            while True:
+                body = await _read_event(reader)
+                if self.writers[writer] is None:
+                    # the first event of every node is its hello
+                    self.writers[writer] = JSON_CODEC.decode(body).get('node')
+                frame = _LENGTH.pack(len(body)) + body
+                for other in self.writers:
+                    if other is not writer:
+                        self._send(other, frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.tasks.discard(task)
+            node_id = self.writers.pop(writer, None)
+            writer.close()
+            if node_id is not None:
+                # tell the others so they forget this node's presence counts
+                frame = _frame({'node': node_id, 'kind': 'bye'})
+                for other in self.writers:
+                    self._send(other, frame)
+
+    def _send(self, writer, frame):
+        # no drain(): one slow node must not hold up the others; past the high-water
+        # mark it is dropped instead, it reconnects and resyncs
+        transport = writer.transport
+        if transport.is_closing():
+            return
+        if transport.get_write_buffer_size() + len(frame) > self.max_buffer:
+            self.slow_disconnects += 1
+            log.warning("bus node %s is not reading, disconnecting it", self.writers.get(writer))
+            transport.abort()
+            return
+        writer.write(frame)
+
+    async def close(self):
+        for writer in list(self.writers):
+            writer.close()
+        # closing the sockets ends every node handler with an incomplete read
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+class BrokerBus(Bus):
+    def __init__(self, host='127.0.0.1', port=12399, path=None, node_id=None, reconnect_delay=0.2,
+                 reconnect_max_delay=10.0):
+        super().__init__(node_id)
+        self.host = host
+        self.port = port
+        self.path = path
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.closing = False
+
+    async def start(self, handler):
+        # the first connection has to work, a wrong address should not look like an outage
+        await super().start(handler)
+        await self._connect()
+        self.reader_task = asyncio.create_task(self._run())
+
+    async def _connect(self):
+        if self.path:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def _run(self):
+        while True:
+            await self._read_loop()
+            writer, self.writer = self.writer, None
+            writer.close()
+            if self.closing:
+                return
+            self.disconnects += 1
+            lost = asyncio.get_running_loop().time()
+            dropped = self.dropped
+            log.warning("bus connection lost, this node is cut off from the others until it reconnects")
+            delay = self.reconnect_delay
+            while True:
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                try:
+                    await self._connect()
+                    break
+                except OSError as e:
+                    log.debug("bus reconnect failed: %s", e)
+                    delay = min(delay * 2, self.reconnect_max_delay)
+            log.warning("bus reconnected after %.1f s, %d events were not published",
+                        asyncio.get_running_loop().time() - lost, self.dropped - dropped)
+            try:
+                await self.handler({'node': self.node_id, 'kind': 'reconnected'})
+            except Exception as e:
+                log.warning("bus handler error: %s", e)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                body = await _read_event(self.reader)
+                try:
+                    await self.handler(JSON_CODEC.decode(body))
+                except Exception as e:
+                    log.warning("bus handler error: %s", e)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.info("bus connection closed")
+
+    async def publish(self, event):
+        if self.writer is None:
+            self.dropped += 1
+            return
+        event['node'] = self.node_id
+        self.writer.write(_frame(event))
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            # the read loop notices too and reconnects
+            pass
+
+    async def close(self):
+        self.closing = True
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+
+def parse_address(address):
+    """
+    总线地址：
+        tcp://127.0.0.1:12399  或  127.0.0.1:12399
+        unix:///tmp/chatroom-bus.sock
+    返回 BusBroker / BrokerBus 的关键字参数
+    """
+    if address.startswith('unix://'):
+        return {'path': address[len('unix://'):]}
+    if address.startswith('tcp://'):
+        address = address[len('tcp://'):]
+    host, _, port = address.rpartition(':')
+    return {'host': host or '127.0.0.1', 'port': int(port)}
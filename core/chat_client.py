@@ -1,16 +1,65 @@
 import asyncio
+import itertools
 import json
+import os
+import random
 import sys
 from datetime import datetime
 from core.socket_base import SocketBase
+from core.message_types import (BATCH, DM, PING, PONG, PRESENCE, RESUME, SWITCH_ROOM, WHO,
+                                FILE_OFFER, FILE_ACK, FILE_GET, FILE, SEARCH, RECONNECT)
+from core.codec import JSON, JSON_CODEC, CODECS, decode_message
+from core.files import CHUNK_PREFIX, FileError, chunk_header, parse_chunk
+
+def format_timestamp(value):
+    # epoch milliseconds, or an ISO string from servers running with --iso-timestamps
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000).strftime('%Y-%m-%d %H:%M:%S')
+    return value
 
 class ChatClient(SocketBase):
-    def __init__(self, server_host='localhost', server_port=12345):
+    def __init__(self, server_host='localhost', server_port=12345, codec=JSON, compression=False,
+                 reconnect=True, reconnect_delay=0.5, reconnect_max_delay=30.0, reconnect_attempts=0,
+                 download_dir='.', auth_token=None):
         super().__init__(server_host, server_port)
+        # join token for servers running with --auth-secret-file, see core/auth.py
+        self.auth_token = auth_token
+        # after a dropped connection, reconnect with exponential backoff and resume
+        # (reconnect_attempts 0 = keep trying until disconnect())
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_attempts = reconnect_attempts
+        # set by the server's reconnect notice: where to (None = ws://host:port) and over how many seconds
+        self.server_uri = None
+        self.reconnect_hint = None
+        # offer permessage-deflate, used only if the server enables it
+        self.compression = compression
+        # codec offered at join; outgoing frames switch to it once the
+        # server answers in that format, json until then
+        self.preferred_codec = codec
+        self.codec = JSON_CODEC
         self.username = None
         self.connected = False
         self.chatroom_num = 0
         self.chatroom_name = f"Chatroom {self.chatroom_num}"
+        # cursor of the last logged message seen, sent on re-join to get only newer history
+        self.last_cursor = None
+        # last seq seen per room, with the server's epoch and resume token
+        self.room_seqs = {}
+        self.epoch = None
+        self.resume_token = None
+        self._reconnected = asyncio.Event()
+        # file transfer: the server's answer to our pending file_offer, upload credit
+        # (acked offset per upload id) and downloads in progress {id: {...}}
+        self.download_dir = download_dir
+        self.file_acks = {}
+        self.downloads = {}
+        self._file_reply = None
+        self._file_lock = asyncio.Lock()
+        self._file_credit = asyncio.Event()
+        # the last search request, '/search' alone asks for its next page
+        self.last_search = None
 
     async def connect_to_server(self, username: str):
         if self.connected:
@@ -23,20 +72,91 @@ class ChatClient(SocketBase):
         self.username = username
 
         # 正确调用 connect_as_client，不赋值
-        if not await self.connect_as_client():
+        if not await self.connect_as_client(compression=self.compression):
             print("[error]: unable to connect to chat server")
             return
 
-        join_message = json.dumps({
+        join_data = {
             'type': 'join',
-            'username': self.username
-        })
+            'username': self.username,
+            'room': self.chatroom_name,
+            'codecs': [self.preferred_codec]
+        }
+        if self.auth_token is not None:
+            join_data['auth'] = self.auth_token
+        if self.last_cursor is not None:
+            join_data['since'] = self.last_cursor
+        join_message = json.dumps(join_data)
         if await self.send(join_message, target_websocket=self.client_websocket):
             print(f"[joining chatroom]: {self.username}")
             self.connected = True
             return True
         return False
 
+    def resume_request(self):
+        request = {
+            'type': RESUME,
+            'username': self.username,
+            'room': self.chatroom_name,
+            'rooms': {self.chatroom_name: self.room_seqs.get(self.chatroom_name)},
+            'epoch': self.epoch,
+            'token': self.resume_token,
+            'codecs': [self.preferred_codec]
+        }
+        if self.auth_token is not None:
+            request['auth'] = self.auth_token
+        return request
+
+    async def resume(self):
+        """断线后按指数退避重连并发送 resume，成功返回 True"""
+        delay = self.reconnect_delay
+        hint, self.reconnect_hint = self.reconnect_hint, None
+        for attempt in itertools.count(1):
+            if self.reconnect_attempts and attempt > self.reconnect_attempts:
+                break
+            # jitter keeps a crowd of dropped clients from reconnecting in lockstep;
+            # a server that announced its shutdown said over how long
+            await asyncio.sleep(random.uniform(0, hint) if hint is not None and attempt == 1
+                                else delay * random.uniform(0.5, 1.0))
+            if not self.connected:
+                # disconnect() while we were waiting
+                return False
+            if await self.connect_as_client(self.server_uri, compression=self.compression):
+                # json until the server answers in the negotiated codec again
+                self.codec = JSON_CODEC
+                if await self.send(json.dumps(self.resume_request()), target_websocket=self.client_websocket):
+                    print(f"[reconnected]: {self.username}")
+                    self._reconnected.set()
+                    return True
+            delay = min(delay * 2, self.reconnect_max_delay)
+        print("[error]: unable to reconnect to chat server")
+        self.connected = False
+        self._reconnected.set()
+        return False
+
+    async def _wait_reconnected(self, websocket):
+        # the connection an upload was using is gone, wait until resume() replaced it
+        while self.connected and self.reconnect and self.client_websocket is websocket:
+            self._reconnected.clear()
+            await self._reconnected.wait()
+        return self.connected and self.client_websocket is not websocket
+
+    async def receive_forever(self, message_callback):
+        # listen_for_messages, resuming after every dropped connection until disconnect()
+        while True:
+            await self.listen_for_messages(message_callback)
+            if not self.connected or not self.reconnect:
+                return
+            # wake uploads waiting for credit, they wait for the new connection instead
+            self._file_credit.set()
+            print("[connection lost]: reconnecting...")
+            if not await self.resume():
+                return
+            for file_id, download in self.downloads.items():
+                # continue interrupted downloads where they stopped
+                await self.send(self.codec.encode({'type': FILE_GET, 'id': file_id, 'offset': download['received']}),
+                                target_websocket=self.client_websocket)
+
     async def send_chat_message(self, content: str):
         if not self.connected:
             print("[error]: join chatroom first")
@@ -45,53 +165,322 @@ class ChatClient(SocketBase):
         message_data = {
             'type': 'message',
             'username': self.username,
+            'room': self.chatroom_name,
             'content': content
         }
-        message = json.dumps(message_data)
+        message = self.codec.encode(message_data)
         # 指定 target_websocket
         await self.send(message, target_websocket=self.client_websocket)
     
+    async def switch_room(self, room: str):
+        if not self.connected:
+            print("[error]: join chatroom first")
+            return
+        room = room.strip()
+        if not room or room == self.chatroom_name:
+            return
+        message = self.codec.encode({
+            'type': SWITCH_ROOM,
+            'room': room
+        })
+        if await self.send(message, target_websocket=self.client_websocket):
+            self.chatroom_name = room
+
+    async def send_dm(self, to: str, content: str):
+        # private message, kept by the server until the user is next online
+        if not self.connected:
+            print("[error]: join chatroom first")
+            return
+        message = self.codec.encode({
+            'type': DM,
+            'to': to,
+            'content': content
+        })
+        await self.send(message, target_websocket=self.client_websocket)
+
+    async def list_users(self, after=None, limit=50, prefix=None, subscribe=None):
+        # ask for one page of online users; subscribe=True also asks for presence diffs
+        if not self.connected:
+            print("[error]: join chatroom first")
+            return
+        request = {'type': WHO, 'limit': limit}
+        if after is not None:
+            request['after'] = after
+        if prefix:
+            request['prefix'] = prefix
+        if subscribe is not None:
+            request['subscribe'] = subscribe
+        await self.send(self.codec.encode(request), target_websocket=self.client_websocket)
+
+    async def search(self, query=None, room=None, username=None, start=None, end=None, before=None, limit=20):
+        # one page of stored messages, newest first; times in epoch ms
+        if not self.connected:
+            print("[error]: join chatroom first")
+            return
+        request = {'type': SEARCH, 'limit': limit}
+        for key, value in (('query', query), ('room', room), ('username', username), ('start', start),
+                           ('end', end), ('before', before)):
+            if value is not None:
+                request[key] = value
+        self.last_search = request
+        await self.send(self.codec.encode(request), target_websocket=self.client_websocket)
+
+    async def _file_request(self, request):
+        # one file_offer at a time, answered by a file_offer (or an error)
+        async with self._file_lock:
+            reply = self._file_reply = asyncio.get_running_loop().create_future()
+            try:
+                if not await self.send(self.codec.encode(request), target_websocket=self.client_websocket):
+                    return None
+                return await asyncio.wait_for(reply, 10)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self._file_reply = None
+
+    async def send_file(self, path, room=None):
+        """上传文件到房间，按服务端给的窗口发送数据帧；断线重连后从服务端已收到的位置继续，返回文件 id"""
+        if not self.connected:
+            print("[error]: join chatroom first")
+            return None
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f"[error]: {e}")
+            return None
+        reply = await self._file_request({'type': FILE_OFFER, 'name': os.path.basename(path), 'size': size,
+                                          'room': room or self.chatroom_name})
+        if reply is None:
+            return None
+        file_id = reply['id']
+        with open(path, 'rb') as file:
+            while True:
+                websocket = self.client_websocket
+                offset, chunk, window = reply['offset'], reply['chunk'], reply['window']
+                self.file_acks[file_id] = offset
+                while offset < size:
+                    while offset - self.file_acks[file_id] >= window and not websocket.closed:
+                        self._file_credit.clear()
+                        await self._file_credit.wait()
+                    file.seek(offset)
+                    data = file.read(min(chunk, size - offset))
+                    if not data or not await self.send(chunk_header(file_id, offset) + data,
+                                                       target_websocket=websocket):
+                        break
+                    offset += len(data)
+                else:
+                    break
+                # connection lost: ask the new one how far the server got
+                reply = None
+                if await self._wait_reconnected(websocket):
+                    reply = await self._file_request({'type': FILE_OFFER, 'id': file_id})
+                if reply is None:
+                    self.file_acks.pop(file_id, None)
+                    print(f"[error]: upload of {path} interrupted")
+                    return None
+        self.file_acks.pop(file_id, None)
+        print(f"[file sent]: {path} ({size} bytes)")
+        return file_id
+
+    async def get_file(self, file_id, offset=0):
+        # the server answers with file_get and then streams the data frames to us only
+        if not self.connected:
+            print("[error]: join chatroom first")
+            return
+        await self.send(self.codec.encode({'type': FILE_GET, 'id': file_id, 'offset': offset}),
+                        target_websocket=self.client_websocket)
+
+    def start_download(self, message_data):
+        file_id = message_data.get('id')
+        offset = message_data.get('offset') or 0
+        download = self.downloads.get(file_id)
+        if download is None:
+            path = os.path.join(self.download_dir, f"{file_id}_{os.path.basename(message_data.get('name') or '')}")
+            download = self.downloads[file_id] = {
+                'path': path,
+                'size': message_data.get('size') or 0,
+                'file': open(path, 'r+b' if offset and os.path.exists(path) else 'wb'),
+            }
+        download['received'] = offset
+        download['file'].seek(offset)
+        download['file'].truncate()
+        self.finish_download(file_id, download)
+
+    def handle_chunk(self, raw_message):
+        # one data frame of a download
+        try:
+            file_id, offset, data = parse_chunk(raw_message)
+        except FileError:
+            return
+        download = self.downloads.get(file_id)
+        if download is None or offset != download['received']:
+            return
+        download['file'].write(data)
+        download['received'] += len(data)
+        self.finish_download(file_id, download)
+
+    def finish_download(self, file_id, download):
+        if download['received'] >= download['size']:
+            download['file'].close()
+            del self.downloads[file_id]
+            print(f"📥 文件已保存: {download['path']} ({download['size']} bytes)")
+
     async def handle_server_message(self, raw_message):
         """处理服务器消息"""
+        if raw_message[:1] == CHUNK_PREFIX:
+            # file data frames carry no message, they are not decoded
+            self.handle_chunk(raw_message)
+            return
         try:
-            message_data = json.loads(raw_message)
+            message_data = decode_message(raw_message)
             message_type = message_data.get('type')
-            
-            if message_type == 'join':
-                username = message_data.get('username')
-                timestamp = message_data.get('timestamp')
-                print(f"✅ [{timestamp}] {username} 加入聊天室")
-                online_count = message_data.get('online_count')
-                print(f"📊 在线人数: {online_count}")
-                
-            elif message_type == 'message':
-                username = message_data.get('username')
-                content = message_data.get('content')
-                timestamp = message_data.get('timestamp')
-                print(f"[{timestamp}] {username}: {content}")
-                
-            elif message_type == 'leave':
-                username = message_data.get('username')
-                timestamp = message_data.get('timestamp')
-                online_count = message_data.get('online_count') or message_data.get('online count')
-                print(f"🔴 [{timestamp}] {username} 离开了聊天室 (在线: {online_count})")
-                
-            elif message_type == 'error':
-                print(f"❌ 错误: {message_data.get('message')}")
-                
-        except json.JSONDecodeError:
-            print(f"收到消息: {raw_message}")
+            if not isinstance(raw_message, str):
+                self.codec = CODECS[self.preferred_codec]
+
+            if message_type == PING:
+                # the server's heartbeat, an idle client that does not answer is disconnected
+                await self.send(self.codec.encode({'type': PONG}), target_websocket=self.client_websocket)
+            elif message_type == BATCH:
+                # several messages of one room coalesced by the server
+                for item in message_data.get('messages', ()):
+                    self.handle_event(item)
+            else:
+                self.handle_event(message_data)
+
+        except ValueError:
+            print(f"收到消息: {raw_message!r}")
         except Exception as e:
             print(f"处理消息时出错: {e}")
+
+    def handle_event(self, message_data):
+        """处理一条已解码的服务器消息"""
+        message_type = message_data.get('type')
+        if message_type == 'join':
+            username = message_data.get('username')
+            timestamp = format_timestamp(message_data.get('timestamp'))
+            room = message_data.get('room')
+            print(f"✅ [{timestamp}] {username} 加入聊天室 {room}")
+            online_count = message_data.get('online_count')
+            print(f"📊 在线人数: {online_count}")
+            
+        elif message_type == 'message':
+            if not self._new_in_room(message_data):
+                return
+            if message_data.get('cursor') is not None:
+                self.last_cursor = message_data['cursor']
+            username = message_data.get('username')
+            content = message_data.get('content')
+            timestamp = format_timestamp(message_data.get('timestamp'))
+            print(f"[{timestamp}] {username}: {content}")
             
+        elif message_type == 'leave':
+            username = message_data.get('username')
+            timestamp = format_timestamp(message_data.get('timestamp'))
+            room = message_data.get('room')
+            online_count = message_data.get('online_count') or message_data.get('online count')
+            print(f"🔴 [{timestamp}] {username} 离开了聊天室 {room} (在线: {online_count})")
+            
+        elif message_type == FILE:
+            if not self._new_in_room(message_data):
+                return
+            timestamp = format_timestamp(message_data.get('timestamp'))
+            print(f"📎 [{timestamp}] {message_data.get('username')} 分享了文件 {message_data.get('name')} "
+                  f"({message_data.get('size')} bytes)，下载: /get {message_data.get('id')}")
+
+        elif message_type == FILE_OFFER:
+            if self._file_reply is not None and not self._file_reply.done():
+                self._file_reply.set_result(message_data)
+
+        elif message_type == FILE_ACK:
+            file_id = message_data.get('id')
+            if file_id in self.file_acks:
+                self.file_acks[file_id] = max(self.file_acks[file_id], message_data.get('offset') or 0)
+                self._file_credit.set()
+
+        elif message_type == FILE_GET:
+            self.start_download(message_data)
+
+        elif message_type == DM:
+            username = message_data.get('username')
+            timestamp = format_timestamp(message_data.get('timestamp'))
+            content = message_data.get('content')
+            if username == self.username:
+                print(f"[{timestamp}] ✉️ -> {message_data.get('to')}: {content}")
+            else:
+                print(f"[{timestamp}] ✉️ {username}: {content}")
+
+        elif message_type == WHO:
+            users = message_data.get('users') or []
+            print(f"👥 在线用户 ({len(users)}/{message_data.get('total')}): {', '.join(users)}")
+            if message_data.get('next') is not None:
+                print(f"   更多: /who {message_data.get('next')}")
+
+        elif message_type == SEARCH:
+            results = message_data.get('results') or []
+            print(f"🔍 \"{message_data.get('query') or ''}\" 找到 {len(results)} 条")
+            for result in results:
+                timestamp = format_timestamp(result.get('timestamp'))
+                text = result.get('content') if result.get('type') != FILE else f"📎 {result.get('name')}"
+                print(f"   [{timestamp}] #{result.get('room')} {result.get('username')}: {text}")
+            if self.last_search is not None:
+                self.last_search['before'] = message_data.get('next')
+            if message_data.get('next') is not None:
+                print("   更多: /search")
+
+        elif message_type == PRESENCE:
+            for username in message_data.get('online') or ():
+                print(f"🟢 {username} 上线")
+            for username in message_data.get('offline') or ():
+                print(f"⚪ {username} 下线")
+
+        elif message_type == RECONNECT:
+            # the server is going away, receive_forever() resumes once it has closed the connection
+            self.reconnect_hint = message_data.get('spread', 0) / 1000
+            if message_data.get('url'):
+                self.server_uri = message_data['url']
+            print("🔄 服务器即将下线，稍后自动重连")
+
+        elif message_type == RESUME:
+            # where we are in each room; after a resume the missed messages follow
+            if message_data.get('epoch') != self.epoch:
+                # the server restarted, its seqs start over
+                self.epoch = message_data.get('epoch')
+                self.room_seqs = {}
+            self.resume_token = message_data.get('token')
+            self.room_seqs.update(message_data.get('rooms') or {})
+            if not message_data.get('complete', True):
+                print("⚠️ 断线期间的部分消息已无法补发")
+
+        elif message_type == 'error':
+            print(f"❌ 错误: {message_data.get('message')}")
+            if self._file_reply is not None and not self._file_reply.done():
+                # errors are not correlated, an offer waiting for its answer takes it as a refusal
+                self._file_reply.set_result(None)
+
+    def _new_in_room(self, message_data):
+        # False for a room message seen before the reconnect
+        seq = message_data.get('seq')
+        if seq is None:
+            return True
+        room = message_data.get('room')
+        if seq <= self.room_seqs.get(room, 0):
+            return False
+        self.room_seqs[room] = seq
+        return True
+
     async def disconnect(self):
         if self.connected:
-            leave_message = json.dumps({
+            leave_message = self.codec.encode({
                 'type': 'leave'
             })
             await self.send(leave_message, target_websocket=self.client_websocket)
             print(f"[leaving chatroom]: {self.username}")
             self.connected = False
+        self._reconnected.set()
+        self._file_credit.set()
+        for download in self.downloads.values():
+            download['file'].close()
+        self.downloads = {}
         await self.close()
     
     async def run(self):
@@ -111,12 +500,15 @@ class ChatClient(SocketBase):
             print("❌ error: unable to connect to chat server")
             return
             
-        print("✅ connected to chat server,type 'exit' to leave")
+        print("✅ connected to chat server,type 'exit' to leave, '/room <name>' to switch room, "
+              "'/who [after]' to list online users, '/dm <user> <text>' for a private message, "
+              "'/send <path>' to share a file, '/get <id>' to download one, "
+              "'/search <words>' to search the history")
         print("-" * 50)
         
         # start listening for messages
         listen_task = asyncio.create_task(
-            self.listen_for_messages(self.handle_server_message)
+            self.receive_forever(self.handle_server_message)
         )
 
         # start handling user input
@@ -149,6 +541,33 @@ class ChatClient(SocketBase):
                 
                 if message.strip() == 'exit':
                     break
+                elif message.strip().startswith('/room '):
+                    await self.switch_room(message.strip()[len('/room '):])
+                elif message.strip().startswith('/dm '):
+                    parts = message.strip().split(None, 2)
+                    if len(parts) == 3:
+                        await self.send_dm(parts[1], parts[2])
+                    else:
+                        print("usage: /dm <user> <text>")
+                elif message.strip().startswith('/send '):
+                    # uploads run alongside the chat
+                    asyncio.create_task(self.send_file(message.strip()[len('/send '):]))
+                elif message.strip().startswith('/get '):
+                    try:
+                        await self.get_file(int(message.strip()[len('/get '):]))
+                    except ValueError:
+                        print("usage: /get <id>")
+                elif message.strip().startswith('/search '):
+                    await self.search(message.strip()[len('/search '):])
+                elif message.strip() == '/search':
+                    # the next page of the last search
+                    if self.last_search is not None and self.last_search.get('before') is not None:
+                        await self.search(**{key: value for key, value in self.last_search.items()
+                                             if key != 'type'})
+                    else:
+                        print("usage: /search <words>")
+                elif message.strip() == '/who' or message.strip().startswith('/who '):
+                    await self.list_users(after=message.strip()[len('/who '):] or None)
                 elif message.strip():
                     await self.send_chat_message(message.strip())
                     
@@ -1,114 +1,1213 @@
 import asyncio
-import json
-from datetime import datetime
+import contextvars
+import hmac
+import itertools
+import secrets
+import time
+from collections import OrderedDict
 from core.socket_base import SocketBase
-from core.user_manager import UserManager
-from core.message_types import JOIN, MESSAGE, LEAVE, ERROR, format_message
-from core.utils import now_iso
+from core.message_types import (JOIN, MESSAGE, LEAVE, ERROR, JOIN_ROOM, LEAVE_ROOM, SWITCH_ROOM,
+                                PING, PONG, WHO, LIST_USERS, DM, RESUME, FILE_OFFER, FILE_ACK, FILE_GET,
+                                FILE, ACK, SEARCH, RECONNECT, PRESENCE, DEFAULT_ROOM, build_message)
+from core.auth import AuthError
+from core.batching import Batcher
+from core.clock import Clock
+from core.codec import JSON_CODEC, Payload, decode_message, negotiate
+from core.files import CHUNK_PREFIX, FileError, FileStore, chunk_header, frame_header, parse_chunk
+from core.history_cache import HistoryCache
+from core.log import get_logger
+from core.mailbox import Mailbox
+from core.metrics import MetricsServer
+from core.outbound import DROP_OLDEST
+from core.presence import PresenceIndex, fold_name
+from core.ratelimit import ALLOW
+from core.search import MAX_QUERY_TERMS, SearchIndex, room_term, tokenize, user_term
+
+log = get_logger('server')
+msg_log = get_logger('messages')  # one record per chat message, sampled by --log-sample
+
+_PONG = Payload({'type': PONG})
+# "ref" of the request being handled on this connection's task, until it is answered
+_REF = contextvars.ContextVar('ref', default=None)
+_CHUNK_HEADER = len(chunk_header(0, 0))
+
+
+def _same_token(token, expected):
+    # a resume token, compared in constant time
+    return isinstance(token, str) and expected is not None and hmac.compare_digest(token, expected)
+
+
+def _count(value):
+    # a non-negative int from a client message; bool is an int too
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
 
 class ChatServer(SocketBase):
-    def __init__(self, host='localhost', port=12345):
-        super().__init__(host, port)
-        # 使用UserManager管理用户
-        self.user_manager = UserManager()
+    def __init__(self, host='localhost', port=12345, queue_size=256, queue_policy=DROP_OLDEST,
+                 bus=None, reuse_port=False, message_log=None, history_limit=20, history_max=1000,
+                 history_cache_size=200, history_cache_bytes=64 * 1024 * 1024,
+                 batch_window=0, batch_max=64, metrics_host='127.0.0.1', metrics_port=None,
+                 heartbeat_interval=20.0, idle_timeout=60.0, mailbox_size=100, mailbox_users=10000,
+                 rate_limiter=None, deflate=None, iso_timestamps=False, file_dir=None,
+                 max_file_size=1 << 30, file_store_bytes=16 << 30, max_downloads=4, auth=None,
+                 max_channels=256, search=False, drain_timeout=5.0, reconnect_url=None, reconnect_spread=1.0,
+                 resume_grace=30.0, max_rooms=100000):
+        super().__init__(host, port, queue_size, queue_policy, heartbeat_interval, idle_timeout,
+                         rate_limiter, deflate)
+        # timestamps: epoch ms read once per loop round, never going back within a room
+        self.clock = Clock(iso=iso_timestamps, max_rooms=max_rooms)
+        # users multiplexed over one connection, see core/mux.py (0 = one user per connection)
+        self.max_channels = max_channels
+        # optional token check on join / resume, see core/auth.py (None = trust the username)
+        self.auth = auth
+        # sorted online list for who / list_users and presence diff subscribers
+        self.presence = PresenceIndex(self._send_presence)
+        # direct messages for offline users, drained on their next join (0 = refuse them)
+        self.mailbox = Mailbox(mailbox_size, mailbox_users) if mailbox_size > 0 else None
+        self._dm_ids = itertools.count(1)
+        # optional pub/sub bus shared with other server processes, see core/bus.py
+        self.bus = bus
+        self.reuse_port = reuse_port
+        # only rooms with members on another node, a count of 0 and the node's bye remove them
+        self.remote_counts = {}  # {room: {node_id: members on that node}}
+        # optional persistent history, see core/message_log.py
+        self.message_log = message_log
+        self.history_limit = history_limit  # replayed on join when the client does not ask
+        self.history_max = history_max  # upper bound for one replay
+        # recent frames per room, already encoded, in front of the log
+        self.history = HistoryCache(history_cache_size, history_cache_bytes, store=message_log)
+        # optional full-text search over what the log stores, see core/search.py
+        if search and message_log is None:
+            raise ValueError("search needs a message log")
+        self.search_index = SearchIndex(message_log) if search else None
+        # per-room sequence numbers of chat messages, what resume counts on; the epoch
+        # is new for every process, seqs handed out by another one cannot be resumed
+        self.epoch = secrets.token_hex(4)
+        # at most max_rooms, the least recently used rooms without local members are forgotten:
+        # their seq comes back from the log, or continues above every forgotten seq (_seq_floor)
+        self.room_seqs = OrderedDict()  # {room: last seq}, least recently used first
+        self.max_rooms = max_rooms
+        self._seq_floor = 0
+        # graceful shutdown: clients are told to reconnect (to reconnect_url, or here again
+        # after a restart) within reconnect_spread seconds, connections still open after
+        # drain_timeout seconds are dropped
+        self.drain_timeout = drain_timeout
+        self.reconnect_url = reconnect_url
+        self.reconnect_spread = reconnect_spread
+        self.draining = False
+        self.restarting = False  # a hot restart is under way, see core/restart.py
+        self.closed = False
+        self._stop = asyncio.Event()
+        self.ready = asyncio.Event()
+        # users online when the previous process handed over, see restore(); their names stay
+        # theirs for resume_grace seconds, a resume with the old token takes the session back
+        self.resume_grace = resume_grace
+        self.restored = {}  # {folded username: (username, token, rooms)}
+        self.drained_sessions = []  # (username, token, rooms) of the users online when drain() began
+        # seconds per startup phase, filled in by whoever starts the server, see start()
+        self.startup = {}
+        self.startup_seconds = None
+        # optional chunked file transfer, see core/files.py; files stay on this node
+        self.files = FileStore(file_dir, max_file_size, file_store_bytes) if file_dir else None
+        self.max_downloads = max_downloads  # per connection
+        self._downloads = {}  # {connection: {file id: task}}
+        if self.files is not None:
+            self.chunk_handler = self.handle_chunk
+        # optional coalescing of chat messages per room, batch_window in seconds (0 = off)
+        self.batcher = Batcher(self._send_room, batch_window, batch_max) if batch_window > 0 else None
+        # local /metrics endpoint, off unless a port is given
+        self.metrics_server = MetricsServer(self.metrics, metrics_host, metrics_port) if metrics_port else None
+        self.metrics.gauge('chat_users', 'joined users', lambda: self.sessions.users)
+        self.metrics.gauge('chat_rooms', 'rooms with at least one local member',
+                           lambda: len(self.sessions.rooms))
+        self.dms = self.metrics.counter('chat_dms_total', 'direct messages sent')
+        self.resumes = self.metrics.counter('chat_resumes_total', 'sessions resumed after a reconnect')
+        self.resume_gaps = self.metrics.counter('chat_resume_gaps_total',
+                                                'resumed rooms whose missed messages were no longer buffered')
+        if self.mailbox is not None:
+            self.metrics.gauge('chat_mailbox_waiting', 'direct messages waiting for offline users',
+                               lambda: len(self.mailbox))
+            self.metrics.computed_counter('chat_mailbox_dropped_total', 'offline direct messages dropped',
+                                          lambda: self.mailbox.dropped)
+        self.metrics.gauge('chat_channels', 'users multiplexed over shared connections',
+                           lambda: sum(1 for session in self.sessions.values() if session.channel is not None))
+        self.metrics.gauge('chat_presence_subscribers', 'connections subscribed to presence diffs',
+                           lambda: len(self.presence.subscribers))
+        self.metrics.gauge('chat_startup_seconds', 'time from process start until the server accepted connections',
+                           lambda: self.startup_seconds or 0)
+        for name in ('hits', 'misses', 'evictions'):
+            self.metrics.computed_counter(f'chat_history_cache_{name}_total', f'history cache {name}',
+                                          lambda name=name: getattr(self.history, name))
+        if self.batcher is not None:
+            self.metrics.computed_counter('chat_batches_total', 'batch frames flushed',
+                                          lambda: self.batcher.batches)
+        if self.auth is not None:
+            for name in ('verified', 'failures', 'throttled'):
+                self.metrics.computed_counter(f'chat_auth_{name}_total', f'join tokens {name}',
+                                              lambda name=name: getattr(self.auth, name))
+            self.metrics.computed_counter('chat_auth_cache_hits_total', 'join tokens found in the cache',
+                                          lambda: self.auth.cache.hits)
+            self.metrics.gauge('chat_auth_cache_size', 'verified tokens cached', lambda: len(self.auth.cache))
+        if self.bus is not None:
+            self.metrics.computed_counter('chat_bus_disconnects_total', 'times the link to the other nodes was lost',
+                                          lambda: self.bus.disconnects)
+            self.metrics.computed_counter('chat_bus_dropped_total', 'events not published while the bus was down',
+                                          lambda: self.bus.dropped)
+        if self.search_index is not None:
+            self.search_seconds = self.metrics.histogram('chat_search_seconds', 'time to answer a search')
+            self.metrics.gauge('chat_search_docs', 'messages in the search index', lambda: self.search_index.docs)
+            self.metrics.gauge('chat_search_segments', 'search index segments',
+                               lambda: len(self.search_index.segments))
+        if self.files is not None:
+            self.metrics.computed_counter('chat_file_bytes_in_total', 'file bytes received',
+                                          lambda: self.files.bytes_in)
+            self.metrics.computed_counter('chat_file_bytes_out_total', 'file bytes sent',
+                                          lambda: self.files.bytes_out)
+            self.metrics.gauge('chat_file_uploads', 'uploads in progress', lambda: len(self.files.uploads))
+            self.metrics.gauge('chat_file_downloads', 'downloads in progress',
+                               lambda: sum(len(tasks) for tasks in self._downloads.values()))
+            self.metrics.gauge('chat_files_stored_bytes', 'bytes of stored and incoming files',
+                               lambda: self.files.total_bytes)
 
     async def handle_message(self, raw_message, websocket):
+        if raw_message[:1] == CHUNK_PREFIX:
+            # a file data frame handle_chunk did not take, past the rate limits by now
+            await self.resync_upload(raw_message, websocket)
+            return
         try:
-            message_data = json.loads(raw_message)
+            message_data = decode_message(raw_message)
             message_type = message_data.get('type')
+            ref = message_data.get('ref')
+            _REF.set(ref)
+            channel_id = message_data.get('ch')
+            if channel_id is not None:
+                # one of the users multiplexed over this connection
+                channel = self.channel(websocket, channel_id, self.max_channels) if self.max_channels else None
+                if channel is None:
+                    await self.send_error("Invalid channel or too many users on this connection", websocket)
+                    return
+                websocket = channel
+                if self.rate_limiter is not None:
+                    # the connection's buckets were charged before parsing, the channel's user is charged here
+                    session = self.sessions.get(channel)
+                    verdict = self.rate_limiter.check_user(session.limits, len(raw_message), session.username)
+                    if verdict is not ALLOW:
+                        self.throttle(channel, verdict)
+                        return
 
             if message_type == MESSAGE:
                 try:
                     await self.handle_chat_message(message_data, websocket)
                 except Exception as e:
-                    print(f"[handle_chat_message error]: {e}, message_data: {message_data}, websocket: {websocket}")
+                    self.errors.inc()
+                    log.warning("handle_chat_message error: %s, message_data: %s, websocket: %s",
+                                e, message_data, websocket.remote_address)
+                    await self.refuse(websocket)
             elif message_type == JOIN:
                 try:
                     await self.handle_join(message_data, websocket)
                 except Exception as e:
-                    print(f"[handle_join error]: {e}")
+                    self.errors.inc()
+                    log.warning("handle_join error: %s", e)
+                    await self.refuse(websocket)
+            elif message_type == RESUME:
+                try:
+                    await self.handle_resume(message_data, websocket)
+                except Exception as e:
+                    self.errors.inc()
+                    log.warning("handle_resume error: %s", e)
+                    await self.refuse(websocket)
             elif message_type == LEAVE:
                 try:
                     await self.handle_leave(message_data, websocket)
                 except Exception as e:
-                    print(f"[handle_leave error]: {e}")
-            elif message_type == ERROR:
+                    self.errors.inc()
+                    log.warning("handle_leave error: %s", e)
+                    await self.refuse(websocket)
+            elif message_type in (JOIN_ROOM, LEAVE_ROOM, SWITCH_ROOM):
+                try:
+                    await self.handle_room_change(message_type, message_data, websocket)
+                except Exception as e:
+                    self.errors.inc()
+                    log.warning("handle_room_change error: %s", e)
+                    await self.refuse(websocket)
+            elif message_type == DM:
+                try:
+                    await self.handle_dm(message_data, websocket)
+                except Exception as e:
+                    self.errors.inc()
+                    log.warning("handle_dm error: %s", e)
+                    await self.refuse(websocket)
+            elif message_type in (FILE_OFFER, FILE_GET):
+                try:
+                    if message_type == FILE_OFFER:
+                        await self.handle_file_offer(message_data, websocket)
+                    else:
+                        await self.handle_file_get(message_data, websocket)
+                except Exception as e:
+                    self.errors.inc()
+                    log.warning("handle_file error: %s", e)
+                    await self.refuse(websocket)
+            elif message_type in (WHO, LIST_USERS):
+                try:
+                    await self.handle_who(message_data, websocket)
+                except Exception as e:
+                    self.errors.inc()
+                    log.warning("handle_who error: %s", e)
+                    await self.refuse(websocket)
+            elif message_type == SEARCH:
+                try:
+                    await self.handle_search(message_data, websocket)
+                except Exception as e:
+                    self.errors.inc()
+                    log.warning("handle_search error: %s", e)
+                    await self.refuse(websocket)
+            elif message_type == PING:
+                self.send_queued(websocket, _PONG)
+            elif message_type in (PONG, ERROR):
+                # a pong only needs to arrive, SocketBase already noted the activity
                 pass
             else:
-                print(f"[unknown message type]: {message_type}")
-        except json.JSONDecodeError:
-            print(f"[invalid message format]: {raw_message}")
+                self.errors.inc()
+                log.info("unknown message type: %s", message_type)
+                await self.refuse(websocket, "Unknown message type")
+            if ref is not None and _REF.get() is not None:
+                # handled and not refused: pipelined clients count on one answer per ref
+                _REF.set(None)
+                self.send_queued(websocket, build_message(ACK, ref=ref))
+        except ValueError:
+            # json.JSONDecodeError and codec.DecodeError
+            self.errors.inc()
+            log.info("invalid message format: %r", raw_message)
             await self.send_error("Invalid message format", websocket)
         except Exception as e:
-            print(f"[handle_message error]: {e}")
+            self.errors.inc()
+            log.warning("handle_message error: %s", e)
+            await self.refuse(websocket)
 
     async def handle_chat_message(self, message_data, websocket):
-        if websocket not in self.connected_clients or not self.user_manager.has_user(websocket):
-            print(f"[client not joined]: {websocket.remote_address}")
+        if not self.sessions.has_user(websocket):
+            log.debug("client not joined: %s", websocket.remote_address)
             await self.send_error("You must join before sending messages", websocket)
             return
-        username = self.user_manager.get_username(websocket)
+        username = self.sessions.get_username(websocket)
         content = message_data.get('content','')
+        room = message_data.get('room') or self.sessions.get_room(websocket)
 
         if not content.strip():
             await self.send_error("Message content cannot be empty", websocket)
             return
+        if not self.sessions.in_room(websocket, room):
+            await self.send_error(f"You are not in room {room}", websocket)
+            return
 
-        broadcast_message = format_message(MESSAGE,
+        broadcast_message = build_message(MESSAGE,
             username=username,
+            room=room,
             content=content,
-            timestamp=now_iso()
+            timestamp=self.clock.stamp(room)
         )
-        await self.broadcast(broadcast_message)
-        print(f"[message from {username}]: {content}")
+        self.sequence(room, broadcast_message)
+        self.persist(room, broadcast_message)
+        self.deliver(room, broadcast_message)
+        self.history.add(room, broadcast_message)
+        ref = _REF.get()
+        if ref is not None:
+            # the ack says where the message landed
+            _REF.set(None)
+            self.send_queued(websocket, build_message(ACK, ref=ref, room=room, seq=broadcast_message.data['seq']))
+        await self.publish({'kind': 'broadcast', 'room': room, 'data': broadcast_message.data})
+        msg_log.debug("message from %s in %s: %s", username, room, content)
 
     async def handle_join(self, message_data, websocket):
-        print("handle join")
-        if self.user_manager.has_user(websocket):
-            print(f"[client already joined]: {websocket.remote_address}")
+        if self.sessions.has_user(websocket):
+            log.debug("client already joined: %s", websocket.remote_address)
+            return
+        username = message_data.get('username', "unknown_user")
+        # checked before anything is registered, a bad join leaves nothing behind
+        replay = await self.history_request(message_data, websocket)
+        if replay is None:
+            return
+        if self.auth is not None:
+            username = await self.authenticate(message_data, websocket)
+            if username is None:
+                return
+        room = message_data.get('room') or DEFAULT_ROOM
+        if self.sessions.find(username) is not None or (self.auth is None and fold_name(username) in self.restored):
+            # names are unique ignoring case, the client may retry with another one
+            await self.send_error(f"Username {username} is already taken", websocket)
+            return
+        codec = negotiate(message_data.get('codecs'))
+        self.flush_room(room)
+        session = self.sessions.add_user(websocket, username, room)
+        if session is None:
+            # the connection was closed while the join was in flight
+            return
+        session.codec = codec
+        self.presence.add(username)
+        restored = self.restored.pop(fold_name(username), None)
+        if restored is not None:
+            # authenticated as a user that was online before the restart, joined afresh instead of resuming
+            await self._announce_leave(restored[0], [name for name in restored[2] if name != room])
+        await self.send_history(websocket, room, replay)
+        self.send_session(websocket, session)
+        await self.send_mailbox(websocket, username)
+        await self.broadcast_presence(JOIN, username, room)
+        log.debug("%s joined %s, %d person in the chat room", username, room, len(self.sessions))
+
+    async def handle_resume(self, message_data, websocket):
+        # a join after a reconnect: replay only what was missed in each room, then join it
+        if self.sessions.has_user(websocket):
             return
         username = message_data.get('username', "unknown_user")
-        self.user_manager.add_user(websocket, username, now_iso())
-        join_message = format_message(JOIN,
+        seqs = message_data.get('rooms')
+        if not isinstance(seqs, dict):
+            seqs = {}
+        room = message_data.get('room') or next(iter(seqs), DEFAULT_ROOM)
+        # the current room last, join_room() makes it the session's room
+        rooms = [name for name in seqs if name != room] + [room]
+        same_epoch = message_data.get('epoch') == self.epoch
+
+        kept = ()
+        connection = self.sessions.find(username)
+        if connection is not None:
+            # still registered when the old socket died unnoticed; the token proves it is the same client
+            if not _same_token(message_data.get('token'), self.sessions.get(connection).token):
+                await self.send_error(f"Username {username} is already taken", websocket)
+                return
+            kept = self._take_over(connection)
+        else:
+            restored = self.restored.get(fold_name(username))
+            owner = restored is not None and _same_token(message_data.get('token'), restored[1])
+            if self.auth is not None and not owner:
+                # nothing to take over, so the resume token proves nothing: authenticate like a join
+                username = await self.authenticate(message_data, websocket)
+                if username is None:
+                    return
+            elif restored is not None and not owner:
+                await self.send_error(f"Username {username} is already taken", websocket)
+                return
+            restored = self.restored.pop(fold_name(username), None)
+            if restored is not None:
+                # online when the previous process handed over, its rooms never saw the user leave
+                kept = restored[2]
+        codec = negotiate(message_data.get('codecs'))
+        session = self.sessions.add_user(websocket, username)
+        if session is None:
+            return
+        session.codec = codec
+        self.presence.add(username)
+
+        points = {}
+        for name in rooms:
+            seq = seqs.get(name)
+            points[name] = self.resume_point(name, seq if same_epoch and isinstance(seq, int) else None)
+        gaps = sum(1 for _, covered in points.values() if not covered)
+        self.resume_gaps.inc(gaps)
+        # sent first: tells the client where each replay starts, in this process' seqs
+        self.send_session(websocket, session, {name: start for name, (start, _) in points.items()},
+                          complete=not gaps)
+        for name in rooms:
+            if not await self.catch_up(websocket, name, points[name][0]):
+                return
+            # no await since catch_up() returned, nothing is missed or sent twice
+            self.sessions.join_room(websocket, name)
+        self.resumes.inc()
+        await self.send_mailbox(websocket, username)
+        # the rooms the old connection was in never saw it leave
+        for name in rooms:
+            if name not in kept:
+                await self.broadcast_presence(JOIN, username, name)
+        for name in kept:
+            if name not in rooms:
+                await self.broadcast_presence(LEAVE, username, name)
+        log.debug("%s resumed in %s", username, ', '.join(rooms))
+
+    async def authenticate(self, message_data, websocket):
+        # the username from the join token, None (and an error sent) when it is refused
+        address = websocket.remote_address
+        try:
+            username = await self.auth.authenticate(message_data.get('auth'), address[0] if address else None)
+        except AuthError as e:
+            await self.send_error(str(e), websocket)
+            return None
+        claimed = message_data.get('username')
+        if claimed is not None and fold_name(claimed) != fold_name(username):
+            await self.send_error("Token does not match username", websocket)
+            return None
+        return username
+
+    def resume_point(self, room, seq):
+        """(补发从哪个 seq 之后开始, 能否补全)；seq 为 None 表示客户端的位置不可用"""
+        last = self.room_seq(room)
+        if seq is None or last - seq > self.history_max:
+            # seqs of another process, or too far behind: the usual recent history
+            return max(0, last - (self.history_limit if seq is None else self.history_max)), False
+        if seq >= last:
+            return last, True
+        first = self.history.first_seq(room)
+        if first is None and self.message_log is not None:
+            # nothing of the room buffered yet, e.g. right after a restart: load its recent messages
+            self.history.recent(room, 1)
+            first = self.history.first_seq(room)
+        return seq, first is not None and first <= seq + 1
+
+    async def catch_up(self, websocket, room, seq):
+        """补发 room 里 seq 之后的消息，返回时没有挂起的 await，调用方可以紧接着加入房间；
+        连接已断开时返回 False"""
+        while True:
+            # pending batches go to the members first, they are in the cache already
+            self.flush_room(room)
+            if seq >= self.room_seq(room):
+                return True
+            payloads = self.history.after_seq(room, seq)
+            if not payloads:
+                return True
+            for payload in payloads:
+                await self.wait_writable(websocket)
+                if not self.send_queued(websocket, payload):
+                    return False
+            # more may have arrived while we waited
+            seq = payloads[-1].data['seq']
+
+    def _take_over(self, connection):
+        # drop the old connection of a resuming user without announcing a leave,
+        # returns the rooms it was in
+        session = super().remove_connection(connection)
+        if session is None:
+            return ()
+        self.presence.unsubscribe(connection)
+        self.presence.remove(session.username)
+        try:
+            connection.fail_connection(1000, "session resumed")
+        except Exception:
+            pass
+        return session.rooms
+
+    def send_session(self, websocket, session, rooms=None, complete=True):
+        # epoch, a fresh resume token and the seq the client is at in each room
+        if rooms is None:
+            # after a join's history: everything sequenced so far is queued for it
+            for room in session.rooms:
+                self.flush_room(room)
+            rooms = {room: self.room_seq(room) for room in session.rooms}
+        session.token = secrets.token_urlsafe(16)
+        self.send_queued(websocket, build_message(RESUME,
+            epoch=self.epoch,
+            token=session.token,
+            rooms=rooms,
+            complete=complete
+        ))
+
+    async def handle_leave(self, message_data, websocket):
+        if websocket not in self.sessions:
+            log.debug("client not connected: %s", websocket.remote_address)
+            return
+        username = self.sessions.get_username(websocket)
+        if self.sessions.has_user(websocket):
+            self.presence.remove(username)
+        rooms = self.sessions.remove_user(websocket)
+        self.remove_connection(websocket)
+        for room in rooms:
+            await self.broadcast_presence(LEAVE, username, room)
+        log.debug("%s left, %d person in the chat room", username, len(self.sessions))
+
+    async def handle_room_change(self, message_type, message_data, websocket):
+        if not self.sessions.has_user(websocket):
+            await self.send_error("You must join before changing rooms", websocket)
+            return
+        username = self.sessions.get_username(websocket)
+        room = message_data.get('room')
+        if not room:
+            await self.send_error("Room name cannot be empty", websocket)
+            return
+        replay = None
+        if message_type != LEAVE_ROOM:
+            replay = await self.history_request(message_data, websocket)
+            if replay is None:
+                return
+
+        self.flush_room(room)
+        if message_type == LEAVE_ROOM:
+            if self.sessions.leave_room(websocket, room):
+                await self.broadcast_presence(LEAVE, username, room)
+            return
+
+        if message_type == SWITCH_ROOM:
+            old_room = self.sessions.get_room(websocket)
+            if old_room == room:
+                return
+            self.flush_room(old_room)
+            self.sessions.switch_room(websocket, old_room, room)
+            if old_room is not None:
+                await self.broadcast_presence(LEAVE, username, old_room)
+        elif self.sessions.in_room(websocket, room):
+            return
+        else:
+            self.sessions.join_room(websocket, room)
+        await self.send_history(websocket, room, replay)
+        await self.broadcast_presence(JOIN, username, room)
+        log.debug("%s joined %s", username, room)
+
+    async def handle_dm(self, message_data, websocket):
+        # routed through the username index, cost does not depend on how many are online
+        if not self.sessions.has_user(websocket):
+            await self.send_error("You must join before sending direct messages", websocket)
+            return
+        username = self.sessions.get_username(websocket)
+        target = message_data.get('to')
+        content = message_data.get('content', '')
+        if not isinstance(target, str) or not target.strip():
+            await self.send_error("Direct message needs a recipient", websocket)
+            return
+        if not content.strip():
+            await self.send_error("Message content cannot be empty", websocket)
+            return
+
+        connection = self.sessions.find(target)
+        if connection is None and self.mailbox is None and self.bus is None:
+            await self.send_error(f"User {target} is not online", websocket)
+            return
+        dm = build_message(DM,
+            id=next(self._dm_ids),
             username=username,
-            timestamp=now_iso(),
-            online_count=len(self.connected_clients)
+            to=target,
+            content=content,
+            timestamp=self.clock.stamp()
         )
-        await self.broadcast(join_message)
-        print(f"[{username} joined] {len(self.connected_clients)} person in the chat room")
+        self.dms.inc()
+        if connection is not None:
+            self.send_queued(connection, dm)
+        else:
+            # keep it until the user joins here, other nodes may have them online
+            if self.mailbox is not None:
+                self.mailbox.put(fold_name(target), dm)
+            await self.publish({'kind': 'dm', 'to': fold_name(target), 'data': dm.data})
+        if connection is not websocket:
+            # the sender's copy, same payload so the frame is encoded once per codec
+            self.send_queued(websocket, dm)
+        msg_log.debug("dm from %s to %s: %s", username, target, content)
 
-    async def handle_leave(self, message_data, websocket):
-        if websocket not in self.connected_clients:
-            print(f"[client not connected]: {websocket.remote_address}")
+    async def send_mailbox(self, websocket, username):
+        # direct messages that arrived while the user was offline, on any node
+        key = fold_name(username)
+        if self.mailbox is not None:
+            for payload in self.mailbox.take(key):
+                await self.wait_writable(websocket)
+                if not self.send_queued(websocket, payload):
+                    return
+        await self.publish({'kind': 'claim', 'to': key})
+
+    async def handle_who(self, message_data, websocket):
+        # one page of online users, optionally (un)subscribing to presence diffs
+        if not self.sessions.has_user(websocket):
+            await self.send_error("You must join before listing users", websocket)
+            return
+        subscribe = message_data.get('subscribe')
+        if subscribe is not None:
+            if subscribe:
+                self.presence.subscribe(websocket)
+            else:
+                self.presence.unsubscribe(websocket)
+        users, next_cursor = self.presence.page(message_data.get('after'),
+                                                message_data.get('limit', 50),
+                                                message_data.get('prefix'))
+        self.send_queued(websocket, build_message(WHO,
+            users=users,
+            next=next_cursor,
+            total=len(self.presence),
+            version=self.presence.version
+        ))
+
+    async def handle_search(self, message_data, websocket):
+        # one page of stored room messages with all the words, newest first
+        if not self.sessions.has_user(websocket):
+            await self.send_error("You must join before searching", websocket)
             return
-        username = self.user_manager.get_username(websocket)
-        leave_message = format_message(LEAVE,
+        if self.search_index is None:
+            await self.send_error("Search is disabled", websocket)
+            return
+        query = message_data.get('query')
+        terms = tokenize(query) if isinstance(query, str) else []
+        room = message_data.get('room')
+        if isinstance(room, str) and room:
+            terms.append(room_term(room))
+        username = message_data.get('username')
+        if isinstance(username, str) and username:
+            terms.append(user_term(username))
+        terms = list(dict.fromkeys(terms))[:MAX_QUERY_TERMS]
+        if not terms:
+            await self.send_error("Search needs words, a room or a username", websocket)
+            return
+        bounds = [message_data.get(key) for key in ('start', 'end', 'before')]
+        if any(value is not None and (type(value) is not int or value < 0) for value in bounds):
+            await self.send_error("Search start, end and before must be integers", websocket)
+            return
+        limit = message_data.get('limit', 20)
+        limit = min(max(limit, 1), 100) if type(limit) is int else 20
+        started = time.perf_counter()
+        cursors, next_cursor = self.search_index.search(terms, *bounds, limit)
+        results = self.search_index.read(cursors)
+        self.search_seconds.observe(time.perf_counter() - started)
+        self.send_queued(websocket, build_message(SEARCH,
+            query=query,
+            results=results,
+            next=next_cursor
+        ))
+
+    async def handle_file_offer(self, message_data, websocket):
+        # a new upload, or with an id the offset to continue an interrupted one from
+        session = self.sessions.get(websocket)
+        if session is None or session.username is None:
+            await self.send_error("You must join before sending files", websocket)
+            return
+        if self.files is None:
+            await self.send_error("File transfer is disabled", websocket)
+            return
+        file_id = message_data.get('id')
+        try:
+            if file_id is not None:
+                upload = self.files.resume(session.username, file_id)
+            else:
+                room = message_data.get('room') or session.room
+                if not self.sessions.in_room(websocket, room):
+                    await self.send_error(f"You are not in room {room}", websocket)
+                    return
+                upload = self.files.offer(session.username, room, message_data.get('name'),
+                                          message_data.get('size'))
+        except FileError as e:
+            await self.send_error(str(e), websocket)
+            return
+        self.send_queued(websocket, build_message(FILE_OFFER,
+            id=upload.id,
+            name=upload.name,
+            size=upload.size,
+            offset=upload.received,
+            chunk=self.files.chunk_size,
+            window=self.files.window
+        ))
+        if upload.received == upload.size:
+            # an empty file has no chunks to wait for
+            self.announce_file(self.files.finish(upload, session.username))
+
+    async def handle_chunk(self, message, websocket):
+        """上传的数据帧；不属于进行中上传的帧返回 False，交回普通消息路径（限流、报错）"""
+        session = self.sessions.get(websocket)
+        if session is None or session.username is None:
+            return False
+        try:
+            file_id, offset, data = parse_chunk(message)
+        except FileError:
+            return False
+        files = self.files
+        upload = files.find_upload(session.username, file_id)
+        if (upload is None or offset != upload.received or len(data) > files.chunk_size
+                or offset - upload.acked >= files.window):
+            # out of order, oversized, or past the credit of the last file_ack (a client that
+            # ignores acks): rate limited like any other frame, then resync_upload()
+            return False
+        try:
+            files.write(upload, offset, data)
+        except FileError as e:
+            await self.send_error(str(e), websocket)
+            return True
+        if upload.received == upload.size:
+            self.announce_file(files.finish(upload, session.username))
+        elif upload.received - upload.acked >= files.window // 2 and upload.granting is None:
+            self._grant_upload(websocket, session, upload)
+        return True
+
+    def _grant_upload(self, websocket, session, upload):
+        # credit for the next half window, once the connection's file byte bucket has paid for
+        # what arrived since the last one: the client cannot get further ahead than that
+        offset = upload.received
+        delay = 0
+        if self.rate_limiter is not None and session.limits is not None:
+            delay = self.rate_limiter.file_delay(session.limits, offset - upload.acked)
+        if delay > 0:
+            upload.granting = asyncio.get_running_loop().call_later(delay, self._send_credit, websocket, upload,
+                                                                    offset)
+        else:
+            self._send_credit(websocket, upload, offset)
+
+    def _send_credit(self, websocket, upload, offset):
+        upload.granting = None
+        # finished, discarded, or resumed from further on meanwhile
+        if self.files.uploads.get(upload.id) is not upload or offset <= upload.acked:
+            return
+        upload.acked = offset
+        self.send_queued(websocket, build_message(FILE_ACK, id=upload.id, offset=offset))
+
+    async def resync_upload(self, message, websocket):
+        # a chunk that is not the next one: tells the client where to continue, once per position,
+        # the rest of a window sent after a lost chunk is dropped quietly
+        session = self.sessions.get(websocket)
+        upload = None
+        if self.files is not None and session is not None and session.username is not None:
+            try:
+                file_id, _, _ = parse_chunk(message)
+            except FileError:
+                file_id = None
+            if file_id is not None:
+                upload = self.files.find_upload(session.username, file_id)
+        if upload is None:
+            self.errors.inc()
+            await self.send_error("File transfer is disabled" if self.files is None
+                                  else "No upload in progress for this file chunk", websocket)
+            return
+        if upload.resynced != upload.received:
+            upload.resynced = upload.received
+            self.send_queued(websocket, build_message(FILE_ACK, id=upload.id, offset=upload.received))
+
+    def announce_file(self, stored):
+        # a finished upload is a room message like any other: seq, log, history, resume
+        room = stored.room
+        payload = build_message(FILE,
+            id=stored.id,
+            name=stored.name,
+            size=stored.size,
+            username=stored.username,
+            room=room,
+            timestamp=self.clock.stamp(room)
+        )
+        self.sequence(room, payload)
+        self.persist(room, payload)
+        self.deliver(room, payload)
+        self.history.add(room, payload)
+        log.info("file %s from %s in %s: %s bytes", stored.id, stored.username, room, stored.size)
+
+    async def handle_file_get(self, message_data, websocket):
+        session = self.sessions.get(websocket)
+        if session is None or session.username is None:
+            await self.send_error("You must join before downloading files", websocket)
+            return
+        if self.files is None:
+            await self.send_error("File transfer is disabled", websocket)
+            return
+        file_id = message_data.get('id')
+        stored = self.files.get(file_id)
+        if stored is None or not self.sessions.in_room(websocket, stored.room):
+            await self.send_error(f"File {file_id} not found", websocket)
+            return
+        offset = message_data.get('offset', 0)
+        if not isinstance(offset, int) or not 0 <= offset <= stored.size:
+            await self.send_error("Invalid file offset", websocket)
+            return
+        downloads = self._downloads.setdefault(websocket, {})
+        previous = downloads.pop(file_id, None)
+        if previous is not None:
+            # asked again, e.g. after a gap: the new request replaces the old one
+            previous.cancel()
+        if len(downloads) >= self.max_downloads:
+            await self.send_error("Too many downloads in progress", websocket)
+            return
+        self.send_queued(websocket, build_message(FILE_GET,
+            id=stored.id,
+            name=stored.name,
+            size=stored.size,
+            offset=offset
+        ))
+        downloads[file_id] = asyncio.create_task(self._serve_file(websocket, session.queue, stored, offset))
+
+    async def _serve_file(self, websocket, queue, stored, offset):
+        # mmap slices straight into the transport, one chunk whenever the connection can take it
+        files = self.files
+        view = files.open(stored)
+        try:
+            while offset < stored.size:
+                # queued chat frames go first, and nothing more while the peer is not reading
+                while not queue.closed and (queue.frames or websocket._paused):
+                    if websocket._paused:
+                        await websocket.drain()
+                    else:
+                        await asyncio.sleep(0.005)
+                transport = websocket.transport
+                if queue.closed or transport.is_closing():
+                    return
+                end = min(offset + files.chunk_size, stored.size)
+                header = frame_header(_CHUNK_HEADER + end - offset) + chunk_header(stored.id, offset)
+                transport.write(header)
+                transport.write(view[offset:end])
+                queue.sent += 1
+                queue.sent_bytes += len(header) + end - offset
+                files.sent(stored, offset, end)
+                offset = end
+                # let the other connections in even when this socket never pushes back
+                await asyncio.sleep(0)
+        except Exception as e:
+            log.debug("file %s download to %s stopped: %s", stored.id, websocket.remote_address, e)
+        finally:
+            files.release(stored)
+            downloads = self._downloads.get(websocket)
+            if downloads is not None and downloads.get(stored.id) is asyncio.current_task():
+                del downloads[stored.id]
+                if not downloads:
+                    del self._downloads[websocket]
+
+    def _cancel_downloads(self, websocket):
+        for task in self._downloads.pop(websocket, {}).values():
+            task.cancel()
+
+    def _send_presence(self, payload, targets):
+        # a newer diff replaces a queued one, the subscriber sees the version jump and asks who again
+        self.broadcast_now(payload, targets=targets, key=PRESENCE)
+
+    def deliver(self, room, payload):
+        # a chat message for the room's members, now or with the next batch
+        if self.batcher is not None:
+            self.batcher.add(room, payload)
+        else:
+            self._send_room(room, payload)
+
+    def _send_room(self, room, payload):
+        self.broadcast_now(payload, targets=self.sessions.get_room_members(room))
+
+    def flush_room(self, room):
+        # pending batched messages go out before presence changes and membership
+        # changes, so members see them in order and newcomers get them as history
+        if self.batcher is not None:
+            self.batcher.flush_room(room)
+
+    def room_seq(self, room):
+        # last seq of the room; a room seen for the first time (or forgotten) continues from its
+        # newest stored message, and above every forgotten seq: messages from other nodes are
+        # not in our log, so a forgotten room can have had seqs above its newest stored one
+        seq = self.room_seqs.get(room)
+        if seq is None:
+            newest = self.history.recent(room, 1)
+            seq = (newest[-1].data.get('seq') or 0) if newest else 0
+            seq = self.room_seqs[room] = max(seq, self._seq_floor)
+            if len(self.room_seqs) > self.max_rooms:
+                self._forget_rooms()
+        return seq
+
+    def sequence(self, room, payload):
+        # stamped before the message is logged, cached and sent
+        seq = self.room_seqs[room] = self.room_seq(room) + 1
+        self.room_seqs.move_to_end(room)
+        payload.data['seq'] = seq
+
+    def _forget_rooms(self):
+        # least recently used first, rooms with local members are kept
+        seqs = self.room_seqs
+        for _ in range(len(seqs)):
+            if len(seqs) <= self.max_rooms:
+                return
+            room = next(iter(seqs))
+            if self.sessions.get_room_members(room):
+                seqs.move_to_end(room)
+                continue
+            seq = seqs.pop(room)
+            if seq > self._seq_floor:
+                self._seq_floor = seq
+
+    def persist(self, room, payload):
+        # stamp the log cursor into the message and append its json form
+        if self.message_log is None:
+            return
+        payload.data['cursor'] = self.message_log.next_cursor
+        now = self.clock.now_ms()
+        cursor = self.message_log.append(room, payload.encode(JSON_CODEC), now)
+        if self.search_index is not None:
+            self.search_index.add(cursor, now, room, payload.data)
+
+    async def history_request(self, message_data, websocket):
+        """join / join_room 里的回放参数 -> (since, 条数)；不是非负整数时回报错误并返回 None"""
+        since = message_data.get('since')
+        limit = message_data.get('history', self.history_limit)
+        if since is not None and not _count(since) or not _count(limit):
+            await self.send_error("history and since must be non-negative integers", websocket)
+            return None
+        return since, min(limit, self.history_max)
+
+    async def send_history(self, websocket, room, replay):
+        # replay the last N messages, or everything after the client's cursor
+        since, limit = replay
+        if since is not None:
+            payloads = self.history.since(room, since, self.history_max)
+        else:
+            payloads = self.history.recent(room, limit)
+        for payload in payloads:
+            await self.wait_writable(websocket)
+            if not self.send_queued(websocket, payload):
+                return
+
+    async def broadcast_presence(self, message_type, username, room):
+        # join/leave notice to the members of one room, on every node
+        self.flush_room(room)
+        members = self.sessions.get_room_members(room)
+        presence_message = build_message(message_type,
             username=username,
-            timestamp=now_iso(),
-            online_count=len(self.connected_clients) - 1
+            room=room,
+            timestamp=self.clock.stamp(room),
+            online_count=self.cluster_count(room)
         )
-        await self.broadcast(leave_message)
-        self.connected_clients.discard(websocket)
-        self.user_manager.remove_user(websocket)
-        print(f"[{username} left] {len(self.connected_clients)} person in the chat room")
+        # a slow member only needs the latest notice about this user in this room
+        await self.broadcast(presence_message, targets=members, key=(PRESENCE, room, fold_name(username)))
+        await self.publish({'kind': 'presence', 'room': room, 'count': len(members),
+                            'data': presence_message.data})
+
+    def cluster_count(self, room):
+        # members of the room across all nodes on the bus
+        count = len(self.sessions.get_room_members(room))
+        remote = self.remote_counts.get(room)
+        if remote:
+            count += sum(remote.values())
+        return count
+
+    def _set_remote_count(self, node_id, room, count):
+        remote = self.remote_counts.setdefault(room, {})
+        if count:
+            remote[node_id] = count
+        else:
+            remote.pop(node_id, None)
+            if not remote:
+                del self.remote_counts[room]
+
+    async def publish(self, event):
+        if self.bus is None:
+            return
+        try:
+            await self.bus.publish(event)
+        except Exception as e:
+            log.warning("bus publish error: %s", e)
+
+    async def handle_bus_event(self, event):
+        # events published by the other nodes
+        kind = event.get('kind')
+        node_id = event.get('node')
+        if kind == 'broadcast':
+            room = event['room']
+            # only the originating node logs the message, here it gets this node's seq and is
+            # cached; stamped again as well, so the room's timestamps follow its seqs. The cursor
+            # points into the origin's log, not ours
+            payload = Payload(dict(event['data']))
+            payload.data.pop('cursor', None)
+            payload.data['timestamp'] = self.clock.stamp(room)
+            self.sequence(room, payload)
+            self.deliver(room, payload)
+            self.history.add(room, payload)
+        elif kind == 'presence':
+            room = event['room']
+            self._set_remote_count(node_id, room, event['count'])
+            self.flush_room(room)
+            data = event['data']
+            await self.broadcast(Payload(data), targets=self.sessions.get_room_members(room),
+                                 key=(PRESENCE, room, fold_name(data.get('username') or '')))
+        elif kind == 'dm':
+            connection = self.sessions.names.get(event['to'])
+            if connection is not None:
+                self.send_queued(connection, Payload(dict(event['data'])))
+                await self.publish({'kind': 'dm_ack', 'origin': node_id, 'to': event['to'],
+                                    'id': event['data'].get('id')})
+        elif kind == 'dm_ack':
+            # delivered on another node, drop our offline copy
+            if self.mailbox is not None and event['origin'] == self.bus.node_id:
+                self.mailbox.discard(event['to'], event['id'])
+        elif kind == 'claim':
+            # the user joined on another node, hand over what we kept for them
+            if self.mailbox is not None:
+                for payload in self.mailbox.take(event['to']):
+                    await self.publish({'kind': 'dm', 'to': event['to'], 'data': payload.data})
+        elif kind == 'hello':
+            # a node just came up, tell it our room sizes
+            counts = {room: len(members) for room, members in self.sessions.rooms.items()}
+            await self.publish({'kind': 'counts', 'counts': counts})
+        elif kind == 'counts':
+            for room, count in event['counts'].items():
+                self._set_remote_count(node_id, room, count)
+        elif kind == 'bye':
+            for room in list(self.remote_counts):
+                self._set_remote_count(node_id, room, 0)
+        elif kind == 'reconnected':
+            # from our own bus after an outage: the others dropped our room sizes and ours of
+            # them are stale; hello makes them send theirs again
+            self.remote_counts.clear()
+            await self.publish({'kind': 'hello'})
+            counts = {room: len(members) for room, members in self.sessions.rooms.items()}
+            await self.publish({'kind': 'counts', 'counts': counts})
+
+    def remove_connection(self, websocket):
+        # the registry drops the session and its room entries in one go; when the
+        # socket died without a leave, let the rooms (and the other nodes) know
+        session = super().remove_connection(websocket)
+        if session is None:
+            return None
+        if session.channels:
+            # the users multiplexed over it go with the connection
+            for channel in list(session.channels.values()):
+                self.remove_connection(channel)
+        self._cancel_downloads(websocket)
+        self.presence.unsubscribe(websocket)
+        if session.username is not None:
+            self.presence.remove(session.username)
+        if session.rooms and not self.draining:
+            # while draining everyone goes; after a restart they resume without a join notice either
+            self.spawn(self._announce_leave(session.username, session.rooms))
+        return session
+
+    async def _announce_leave(self, username, rooms):
+        for room in rooms:
+            await self.broadcast_presence(LEAVE, username, room)
+
+    async def refuse(self, websocket, error_message="Internal server error"):
+        # a request with a ref that failed still gets its one answer
+        if _REF.get() is not None:
+            await self.send_error(error_message, websocket)
 
     async def send_error(self, error_message, websocket):
-        error_data = format_message(ERROR,
+        error_data = build_message(ERROR,
             message=error_message,
-            timestamp=now_iso()
+            timestamp=self.clock.stamp()
         )
-        if websocket and not websocket.closed:
-            await websocket.send(error_data)
+        ref = _REF.get()
+        if ref is not None:
+            # the answer to that request, no ack follows
+            _REF.set(None)
+            error_data.data['ref'] = ref
+        if websocket in self.sessions:
+            self.send_queued(websocket, error_data)
+        elif websocket and not websocket.closed:
+            await websocket.send(error_data.encode(JSON_CODEC))
         else:
-            print(f"[error sending to {websocket.remote_address}]: {error_message}")
+            log.debug("error sending to %s: %s", websocket.remote_address, error_message)
 
-    async def start(self):
-        await self.start_server(self.handle_message)
+    async def start(self, sock=None, started=None):
+        """启动并一直服务到 stop() 或 close()；started 是启动开始时的 time.monotonic()（默认现在），
+        从它到开始接受连接的时间连同 self.startup 里各阶段的耗时一起记日志"""
+        if started is None:
+            started = time.monotonic()
+        if self.message_log is not None:
+            await self.message_log.start()
+        if self.search_index is not None:
+            await self.search_index.start()
+        if self.files is not None:
+            # after restore(): what a hot restart handed over stays
+            self.files.sweep()
+        if self.bus is not None:
+            await self.bus.start(self.handle_bus_event)
+            await self.publish({'kind': 'hello'})
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        listen = time.monotonic()
+        await self.start_server(self.handle_message, reuse_port=self.reuse_port, sock=sock)
+        self.startup['listen'] = time.monotonic() - listen
+        self.startup_seconds = time.monotonic() - started
+        log.info("server ready in %.0f ms (%s)", self.startup_seconds * 1000,
+                 ', '.join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in self.startup.items()))
+        self.ready.set()
+        if self.restored:
+            asyncio.get_running_loop().call_later(self.resume_grace, self._expire_restored)
         try:
-            await asyncio.Future()
-        except KeyboardInterrupt:
-            print("[server stopped by user]")
+            await self._stop.wait()
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # Ctrl-C under asyncio.run() without a signal handler cancels this task
+            log.info("server stopped by user")
             await self.close()
+            raise
+        await self.close()
+
+    def stop(self):
+        # start() closes the server and returns; safe to call from a signal handler, or again
+        self._stop.set()
+
+    async def drain(self, restart=False):
+        """优雅下线：停止 accept，通知每个连接重连（重启时回到这里，否则去 reconnect_url），
+        并发关闭，drain_timeout 秒后还开着的直接断开；返回 (正常关闭数, 强制断开数)"""
+        self.draining = True
+        self.stop_accepting()
+        if self.batcher is not None:
+            self.batcher.close()
+        self.drained_sessions = [(session.username, session.token, session.rooms)
+                                 for session in self.sessions.values() if session.username is not None]
+        started = time.monotonic()
+        notice = build_message(RECONNECT, spread=round(self.reconnect_spread * 1000))
+        if self.reconnect_url and not restart:
+            notice.data['url'] = self.reconnect_url
+        # once per physical connection, the users multiplexed over it reconnect with it
+        self.broadcast_now(notice, targets=[websocket for websocket, session in self.sessions.sessions.items()
+                                            if session.channel is None])
+        # 1012 service restart, 1001 going away
+        closed, dropped = await self.close_connections(1012 if restart else 1001,
+                                                       "server restarting" if restart else "server shutting down",
+                                                       self.drain_timeout)
+        log.info("drained %d connections (%d users) in %.0f ms, %d dropped at the deadline",
+                 closed + dropped, len(self.drained_sessions), (time.monotonic() - started) * 1000, dropped)
+        return closed, dropped
+
+    async def close(self, restart=False):
+        if self.closed:
+            return
+        self.closed = True
+        await self.drain(restart)
+        self.presence.close()
+        for websocket in list(self._downloads):
+            self._cancel_downloads(websocket)
+        await super().close()
+        if self.files is not None:
+            self.files.close(keep=restart)
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.bus is not None:
+            await self.bus.close()
+        if self.search_index is not None:
+            await self.search_index.close()
+        if self.message_log is not None:
+            await self.message_log.close()
+
+    def snapshot(self):
+        """交给重启后进程的状态（可 JSON 序列化），在 close() 之后取：epoch 和各房间 seq（续连补发靠它们）、
+        下线时在线用户的续连令牌和房间、离线私信、已存文件和上传进度；没有消息日志时还有各房间缓存的最近消息"""
+        users = [list(user) for user in self.drained_sessions if user[1] is not None]
+        users += [list(user) for user in self.restored.values()]
+        state = {
+            'epoch': self.epoch,
+            'room_seqs': self.room_seqs,
+            'seq_floor': self._seq_floor,
+            # restore() checks the log did not move on since
+            'log_cursor': self.message_log.next_cursor if self.message_log is not None else None,
+            'users': users,
+            'dm_id': next(self._dm_ids),
+        }
+        if self.mailbox is not None:
+            state['mailbox'] = {key: [payload.data for payload in box] for key, box in self.mailbox.boxes.items()}
+        if self.files is not None:
+            # stored files and uploads in progress stay in --file-dir
+            state['files'] = self.files.snapshot()
+        if self.message_log is None:
+            # the cache is the only copy, otherwise it is refilled from the log as rooms are used
+            state['history'] = {room: self.history.snapshot(room) for room in self.history.rooms}
+        return state
+
+    def restore(self, state):
+        """装回 snapshot()，在 start() 之前调用"""
+        cursor = self.message_log.next_cursor if self.message_log is not None else None
+        if state.get('log_cursor') == cursor:
+            # same history as when the snapshot was taken: clients resume where they were
+            self.epoch = state['epoch']
+            self.room_seqs.update(state['room_seqs'])
+            self._seq_floor = state.get('seq_floor', 0)
+            for room, entries in state.get('history', {}).items():
+                self.history.restore(room, entries)
+        else:
+            log.warning("message log moved on since the snapshot, sequence numbers start a new epoch")
+        for username, token, rooms in state.get('users', ()):
+            self.restored[fold_name(username)] = (username, token, tuple(rooms))
+        if self.mailbox is not None:
+            for key, messages in state.get('mailbox', {}).items():
+                for data in messages:
+                    self.mailbox.put(key, Payload(data))
+        self._dm_ids = itertools.count(state.get('dm_id', 1))
+        if self.files is not None and 'files' in state:
+            self.files.restore(state['files'])
+        log.info("restored %d users, %d rooms and %d offline messages from the snapshot", len(self.restored),
+                 len(self.room_seqs), len(self.mailbox) if self.mailbox is not None else 0)
+
+    def _expire_restored(self):
+        # users that did not come back after a restart: now their rooms see them leave
+        restored, self.restored = self.restored, {}
+        for username, _, rooms in restored.values():
+            self.spawn(self._announce_leave(username, rooms))
 
 # 只保留一份 main 和入口
 async def main():
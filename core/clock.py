@@ -0,0 +1,65 @@
+"""
+时间戳服务
+
+消息里的 timestamp 默认是整数毫秒（Unix epoch），由客户端自己格式化；
+旧客户端可以让服务端改发 ISO 字符串（--iso-timestamps），同一毫秒内的格式化结果直接复用。
+时钟按事件循环的轮次缓存：一轮里第一次读取时取一次系统时间，并用 call_soon 安排在下一轮失效，
+同一轮处理的所有消息共用这个值，空闲时没有任何定时器。
+同一房间内的时间戳不会倒退：系统时间被往回调时沿用该房间上一条消息的时间。
+每个房间的上一个时间戳按 LRU 最多保留 max_rooms 个，被淘汰的房间从淘汰过的最大时间戳往后算，同样不倒退。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+class Clock:
+    def __init__(self, iso=False, max_rooms=100000):
+        self.iso = iso
+        self.last = OrderedDict()  # {room: last stamp in ms}, least recently stamped first
+        self.max_rooms = max_rooms
+        self._floor = 0  # latest stamp of a forgotten room
+        self.reads = 0  # system clock reads, at most one per loop round
+        self._ms = None  # cached for the current loop round
+        self._iso_ms = None
+        self._iso_text = None
+
+    def now_ms(self):
+        ms = self._ms
+        if ms is None:
+            ms = time.time_ns() // 1000000
+            self.reads += 1
+            try:
+                asyncio.get_running_loop().call_soon(self._expire)
+            except RuntimeError:
+                # no running loop to expire the cache, so do not keep it
+                return ms
+            self._ms = ms
+        return ms
+
+    def _expire(self):
+        self._ms = None
+
+    def stamp(self, room=None):
+        """一条消息的 timestamp 字段；给了 room 时保证在该房间内不倒退"""
+        ms = self.now_ms()
+        if room is not None:
+            last = self.last.get(room, self._floor)
+            if ms < last:
+                ms = last
+            else:
+                self.last[room] = ms
+                self.last.move_to_end(room)
+                if len(self.last) > self.max_rooms:
+                    _, forgotten = self.last.popitem(last=False)
+                    if forgotten > self._floor:
+                        self._floor = forgotten
+        return self.format(ms) if self.iso else ms
+
+    def format(self, ms):
+        # ISO form for old clients, the same text for every message of that millisecond
+        if ms != self._iso_ms:
+            self._iso_text = datetime.fromtimestamp(ms / 1000).isoformat(timespec='milliseconds')
+            self._iso_ms = ms
+        return self._iso_text
@@ -0,0 +1,318 @@
+"""
+消息编解码
+
+json    文本帧，默认与兜底格式
+binary  二进制帧：固定头 + 长度前缀字段，常用类型名和字段名压缩成 1 字节 id
+zjson   二进制帧：JSON 用 raw deflate 压缩，预置一份共享字典（_ZDICT，服务端现在发的消息的骨架），
+        每条消息独立压缩，短消息也能压得动；和 json 一样每条广播只编码一次
+
+客户端在 join 里用 codecs 字段列出支持的格式（按偏好排序），
+服务端选第一个支持的格式给这个连接发消息。
+收到的帧按 WebSocket 帧类型解码：str 走 json，bytes 按首字节走 binary 或 zjson，所以几种格式可以混用。
+首字节 0xC6 留给文件数据帧（core/files.py），不经过这里。
+"""
+import json
+import struct
+import zlib
+
+JSON = 'json'
+BINARY = 'binary'
+ZJSON = 'zjson'
+
+# first byte of every binary-codec frame
+BINARY_MAGIC = 0xC4
+ZJSON_MAGIC = 0xC5
+# largest decompressed zjson frame, guards against deflate bombs
+ZJSON_MAX_SIZE = 1 << 20
+
+# preset deflate dictionary of the zjson codec, part of the wire format: both ends must hold
+# the same bytes. Built from the frames the server sends now (epoch-ms timestamps, seq,
+# resume, ack). Most frequent skeletons last, deflate prefers close matches.
+_ZDICT = (b'{"type":"presence","version":,"online":[],"offline":[]}'
+          b'{"type":"who","users":[],"next":null,"total":,"version":}'
+          b'{"type":"error","message":"You must join before ","timestamp":17'
+          b'{"type":"resume","epoch":"","token":"","rooms":{"Chatroom 0":},"complete":true}'
+          b'{"type":"ack","ref":,"room":"Chatroom 0","seq":}'
+          b'{"type":"dm","id":,"username":"","to":"","content":"","timestamp":17'
+          b'{"type":"batch","room":"","messages":['
+          b'{"type":"leave","username":"","room":"Chatroom 0","timestamp":17,"online_count":}'
+          b'{"type":"join","username":"","room":"Chatroom 0","timestamp":17,"online_count":}'
+          b'{"type":"message","username":"","room":"Chatroom 0","content":"","timestamp":17'
+          b',"seq":,"cursor":}')
+
+# append-only tables: ids are part of the wire format
+_TYPE_IDS = ['join', 'message', 'leave', 'error', 'join_room', 'leave_room', 'switch_room',
+             'batch', 'ping', 'pong', 'who', 'list_users', 'presence', 'dm', 'resume',
+             'file_offer', 'file_ack', 'file_get', 'file', 'ack', 'search', 'reconnect']
+_KEY_IDS = ['username', 'content', 'timestamp', 'room', 'online_count', 'message', 'codecs',
+            'cursor', 'since', 'history', 'messages', 'users', 'after', 'limit', 'prefix', 'next',
+            'total', 'version', 'subscribe', 'online', 'offline', 'to', 'id', 'seq', 'epoch',
+            'rooms', 'token', 'complete', 'name', 'size', 'offset', 'chunk', 'window', 'auth', 'ref',
+            'ch', 'query', 'results', 'start', 'end', 'before', 'url', 'spread']
+
+_TYPE_TO_ID = {name: i + 1 for i, name in enumerate(_TYPE_IDS)}
+_ID_TO_TYPE = {i + 1: name for i, name in enumerate(_TYPE_IDS)}
+_KEY_TO_ID = {name: i + 1 for i, name in enumerate(_KEY_IDS)}
+_ID_TO_KEY = {i + 1: name for i, name in enumerate(_KEY_IDS)}
+
+_pack_B = struct.Struct('!B').pack
+_pack_I = struct.Struct('!I').pack
+_pack_i = struct.Struct('!i').pack
+_pack_q = struct.Struct('!q').pack
+_pack_d = struct.Struct('!d').pack
+_unpack_I = struct.Struct('!I').unpack_from
+_unpack_i = struct.Struct('!i').unpack_from
+_unpack_q = struct.Struct('!q').unpack_from
+_unpack_d = struct.Struct('!d').unpack_from
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class JsonCodec:
+    name = JSON
+
+    def __init__(self):
+        # built once, json.dumps() with keyword arguments builds one per call;
+        # non-serializable values fall back to str() in the same pass
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=str)
+
+    def encode(self, data):
+        return self._encoder.encode(data)
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+
+class BinaryCodec:
+    name = BINARY
+
+    def encode(self, data):
+        parts = [b'\xc4']
+        msg_type = data.get('type')
+        type_id = _TYPE_TO_ID.get(msg_type, 0)
+        parts.append(_pack_B(type_id))
+        for key, value in data.items():
+            if key == 'type' and type_id:
+                continue
+            key_id = _KEY_TO_ID.get(key)
+            if key_id is None:
+                raw_key = key.encode('utf-8')
+                parts.append(b'\x00')
+                parts.append(_pack_B(len(raw_key)))
+                parts.append(raw_key)
+            else:
+                parts.append(_pack_B(key_id))
+            _encode_value(value, parts)
+        return b''.join(parts)
+
+    def decode(self, raw):
+        view = memoryview(raw)
+        if len(view) < 2 or view[0] != BINARY_MAGIC:
+            raise DecodeError("not a binary codec frame")
+        data = {}
+        type_id = view[1]
+        if type_id:
+            if type_id not in _ID_TO_TYPE:
+                raise DecodeError(f"unknown type id {type_id}")
+            data['type'] = _ID_TO_TYPE[type_id]
+        offset = 2
+        end = len(view)
+        try:
+            while offset < end:
+                key_id = view[offset]
+                offset += 1
+                if key_id:
+                    key = _ID_TO_KEY.get(key_id)
+                    if key is None:
+                        raise DecodeError(f"unknown key id {key_id}")
+                else:
+                    length = view[offset]
+                    key = str(view[offset + 1:offset + 1 + length], 'utf-8')
+                    offset += 1 + length
+                data[key], offset = _decode_value(view, offset)
+        except (IndexError, struct.error, UnicodeDecodeError) as e:
+            raise DecodeError(f"truncated binary frame: {e}")
+        return data
+
+
+class ZJsonCodec:
+    name = ZJSON
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def encode(self, data):
+        raw = JSON_CODEC.encode(data).encode('utf-8')
+        # a fresh stream per message, every frame decodes on its own
+        encoder = zlib.compressobj(self.level, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, _ZDICT)
+        return b'\xc5' + encoder.compress(raw) + encoder.flush()
+
+    def decode(self, raw):
+        view = memoryview(raw)
+        if len(view) < 1 or view[0] != ZJSON_MAGIC:
+            raise DecodeError("not a zjson frame")
+        decoder = zlib.decompressobj(-15, _ZDICT)
+        try:
+            text = decoder.decompress(view[1:], ZJSON_MAX_SIZE)
+        except zlib.error as e:
+            raise DecodeError(f"bad zjson frame: {e}")
+        if decoder.unconsumed_tail:
+            raise DecodeError("zjson frame too large")
+        return json.loads(text)
+
+
+def _encode_value(value, parts):
+    if isinstance(value, str):
+        raw = value.encode('utf-8')
+        if len(raw) < 256:
+            parts.append(b's')
+            parts.append(_pack_B(len(raw)))
+        else:
+            parts.append(b'S')
+            parts.append(_pack_I(len(raw)))
+        parts.append(raw)
+    elif value is None:
+        parts.append(b'n')
+    elif value is True:
+        parts.append(b'T')
+    elif value is False:
+        parts.append(b'F')
+    elif isinstance(value, int):
+        if -0x80000000 <= value <= 0x7FFFFFFF:
+            parts.append(b'i')
+            parts.append(_pack_i(value))
+        else:
+            parts.append(b'q')
+            parts.append(_pack_q(value))
+    elif isinstance(value, float):
+        parts.append(b'd')
+        parts.append(_pack_d(value))
+    elif isinstance(value, (list, tuple)):
+        parts.append(b'l')
+        parts.append(_pack_I(len(value)))
+        for item in value:
+            _encode_value(item, parts)
+    elif isinstance(value, dict):
+        parts.append(b'm')
+        parts.append(_pack_I(len(value)))
+        for key, item in value.items():
+            _encode_value(str(key), parts)
+            _encode_value(item, parts)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(b'b')
+        parts.append(_pack_I(len(value)))
+        parts.append(bytes(value))
+    else:
+        _encode_value(str(value), parts)
+
+
+def _decode_value(view, offset):
+    tag = view[offset]
+    offset += 1
+    if tag == 0x73:  # s
+        length = view[offset]
+        offset += 1
+        return str(view[offset:offset + length], 'utf-8'), offset + length
+    if tag == 0x53:  # S
+        length = _unpack_I(view, offset)[0]
+        offset += 4
+        return str(view[offset:offset + length], 'utf-8'), offset + length
+    if tag == 0x69:  # i
+        return _unpack_i(view, offset)[0], offset + 4
+    if tag == 0x6E:  # n
+        return None, offset
+    if tag == 0x54:  # T
+        return True, offset
+    if tag == 0x46:  # F
+        return False, offset
+    if tag == 0x71:  # q
+        return _unpack_q(view, offset)[0], offset + 8
+    if tag == 0x64:  # d
+        return _unpack_d(view, offset)[0], offset + 8
+    if tag == 0x6C:  # l
+        count = _unpack_I(view, offset)[0]
+        offset += 4
+        items = []
+        for _ in range(count):
+            item, offset = _decode_value(view, offset)
+            items.append(item)
+        return items, offset
+    if tag == 0x6D:  # m
+        count = _unpack_I(view, offset)[0]
+        offset += 4
+        items = {}
+        for _ in range(count):
+            key, offset = _decode_value(view, offset)
+            items[key], offset = _decode_value(view, offset)
+        return items, offset
+    if tag == 0x62:  # b
+        length = _unpack_I(view, offset)[0]
+        offset += 4
+        return bytes(view[offset:offset + length]), offset + length
+    raise DecodeError(f"unknown value tag {tag}")
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+ZJSON_CODEC = ZJsonCodec()
+CODECS = {JSON: JSON_CODEC, BINARY: BINARY_CODEC, ZJSON: ZJSON_CODEC}
+
+
+def negotiate(offered):
+    # first codec the client offered that we support, json otherwise
+    if isinstance(offered, (list, tuple)):
+        for name in offered:
+            codec = CODECS.get(name)
+            if codec is not None:
+                return codec
+    return JSON_CODEC
+
+
+def decode_message(raw):
+    # text frames are json, binary frames are told apart by their first byte
+    if isinstance(raw, str):
+        return JSON_CODEC.decode(raw)
+    if raw and raw[0] == ZJSON_MAGIC:
+        return ZJSON_CODEC.decode(raw)
+    return BINARY_CODEC.decode(raw)
+
+
+class Payload:
+    """一条待发送的消息，每种编码只编码一次"""
+    __slots__ = ('_data', '_encoded', 'frames')
+
+    def __init__(self, data):
+        self._data = data
+        self._encoded = {}
+        # {codec name or (codec name, deflate window): (encoded, websocket frame bytes)},
+        # filled in by fanout
+        self.frames = {}
+
+    @classmethod
+    def from_json(cls, text, frame=None):
+        # an already encoded json frame, e.g. read back from the message log, and optionally
+        # its websocket frame; it is only decoded if a connection needs another codec or a field is read
+        payload = cls(None)
+        payload._encoded[JSON] = text
+        if frame is not None:
+            payload.frames[JSON] = (text, frame)
+        return payload
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = JSON_CODEC.decode(self._encoded[JSON])
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    def encode(self, codec):
+        encoded = self._encoded.get(codec.name)
+        if encoded is None:
+            encoded = codec.encode(self.data)
+            self._encoded[codec.name] = encoded
+        return encoded
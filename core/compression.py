@@ -0,0 +1,70 @@
+"""
+permessage-deflate（RFC 7692），每条广播只压缩一次
+
+默认关闭。开启后服务端在握手时接受客户端提出的 permessage-deflate，但总是回 server_no_context_takeover：
+服务端发出的每条消息独立压缩、不依赖之前的消息，所以同一条消息对所有窗口大小相同的连接
+压缩结果逐字节相同。扇出时每个 (编码, 窗口大小) 只压缩、成帧一次，缓存在 Payload.frames 上复用，
+而不是像 websockets 默认那样每个连接各压一遍。
+小于 min_size 的消息压缩得不偿失，按协议允许的方式直接以未压缩帧发送（RSV1 = 0）。
+客户端发给服务端的帧仍由 websockets 逐连接解压。
+"""
+import zlib
+
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import Frame, Opcode
+
+DEFAULT_LEVEL = 6
+DEFAULT_MIN_SIZE = 128
+# deflate ends every flushed block with this, the extension strips it from the wire
+_FLUSH_TAIL = b'\x00\x00\xff\xff'
+
+
+class Deflate:
+    """压缩参数：级别、服务端窗口大小、最小压缩长度，以及压缩计数"""
+
+    def __init__(self, level=DEFAULT_LEVEL, window_bits=15, min_size=DEFAULT_MIN_SIZE, mem_level=8):
+        self.level = level
+        self.window_bits = window_bits
+        self.min_size = min_size
+        self.mem_level = mem_level
+        self.compressed = 0  # messages compressed, once per (codec, window)
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def server_extension(self):
+        # the handshake side: no context takeover so the output can be shared
+        return ServerPerMessageDeflateFactory(
+            server_no_context_takeover=True,
+            server_max_window_bits=self.window_bits,
+            compress_settings={'memLevel': self.mem_level},
+        )
+
+    def window_of(self, websocket):
+        """连接协商好的服务端窗口大小；没有协商 permessage-deflate 时为 None"""
+        for extension in websocket.extensions:
+            if isinstance(extension, PerMessageDeflate) and extension.local_no_context_takeover:
+                return extension.local_max_window_bits
+        return None
+
+    def frame(self, message, window_bits):
+        """一条消息（str / bytes）的完整服务端帧，够大时压缩"""
+        if isinstance(message, str):
+            opcode, data = Opcode.TEXT, message.encode('utf-8')
+        else:
+            opcode, data = Opcode.BINARY, bytes(message)
+        if len(data) < self.min_size:
+            return Frame(opcode, data).serialize(mask=False)
+        encoder = zlib.compressobj(self.level, zlib.DEFLATED, -window_bits, self.mem_level)
+        compressed = encoder.compress(data) + encoder.flush(zlib.Z_SYNC_FLUSH)
+        if compressed.endswith(_FLUSH_TAIL):
+            compressed = compressed[:-4]
+        self.compressed += 1
+        self.bytes_before += len(data)
+        self.bytes_after += len(compressed)
+        if len(compressed) >= len(data):
+            # incompressible, e.g. already compressed binary
+            return Frame(opcode, data).serialize(mask=False)
+        frame = bytearray(Frame(opcode, compressed).serialize(mask=False))
+        # RSV1 marks a compressed message; Frame.serialize only allows it via an extension object
+        frame[0] |= 0x40
+        return bytes(frame)
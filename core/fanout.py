@@ -0,0 +1,85 @@
+"""
+广播扇出引擎：一次编码，多次写入
+
+服务端发出的 WebSocket 帧不加掩码，所以同一条消息对所有接收者来说字节完全相同。
+这里只构造一次帧，然后直接写进每个连接的 transport 缓冲区，
+不为每个接收者创建协程，也不等待慢连接 drain。
+慢连接的积压由各自会话上的 OutboundQueue 处理（见 core/outbound.py、core/session.py）。
+"""
+from websockets.connection import State
+from websockets.frames import Frame, Opcode
+
+from core.codec import JSON_CODEC, Payload
+
+
+def encode_frame(message) -> bytes:
+    # build one unmasked server -> client data frame
+    if isinstance(message, str):
+        frame = Frame(Opcode.TEXT, message.encode('utf-8'))
+    else:
+        frame = Frame(Opcode.BINARY, bytes(message))
+    return frame.serialize(mask=False)
+
+
+def fanout(message, targets, sessions, exclude=None, key=None, deflate=None):
+    """
+    把 message 交给 targets 中每个连接的发送队列，立即返回。
+    sessions 是 {连接: Session}，不在其中的连接直接写 transport。
+    协商了 permessage-deflate 的连接由 deflate（core/compression.py）按窗口大小各压缩一次。
+    message 是 str / bytes 时所有连接收到相同的帧；
+    是 Payload 时按每个连接协商的编码分组，每种编码只编码、成帧一次，
+    帧缓存在 Payload 上，之后再发给别的连接直接复用。
+    多路复用的 channel（core/mux.py）共用物理连接的队列，同一次调用里每个队列只写一份。
+    返回 (已投递数量, 失效连接列表)，由调用方负责清理失效连接。
+    """
+    if isinstance(message, Payload):
+        frames = message.frames
+    else:
+        frames = None
+        data = message
+        plain_frame = frame_bytes = encode_frame(message)
+        compressed = {}  # {window bits: frame bytes}, for this call only
+    sent = 0
+    dead = []
+    shared = None  # queues of multiplexed connections written to in this call
+    for websocket in targets:
+        if websocket is exclude:
+            continue
+        if websocket.state is not State.OPEN:
+            dead.append(websocket)
+            continue
+        session = sessions.get(websocket)
+        if session is not None and session.channel is not None:
+            # one copy per physical connection, the client hands it to its users in the room
+            if shared is None:
+                shared = set()
+            elif session.queue in shared:
+                sent += 1
+                continue
+            shared.add(session.queue)
+        window = session.deflate if session is not None and deflate is not None else None
+        if frames is not None:
+            codec = session.codec if session is not None else JSON_CODEC
+            name = codec.name if window is None else (codec.name, window)
+            entry = frames.get(name)
+            if entry is None:
+                encoded = message.encode(codec)
+                frame = encode_frame(encoded) if window is None else deflate.frame(encoded, window)
+                entry = frames[name] = (encoded, frame)
+            data, frame_bytes = entry
+        elif window is not None:
+            frame_bytes = compressed.get(window)
+            if frame_bytes is None:
+                frame_bytes = compressed[window] = deflate.frame(message, window)
+        else:
+            frame_bytes = plain_frame
+        try:
+            if session is None:
+                websocket.transport.write(frame_bytes)
+            elif not session.queue.put(data, frame_bytes, key):
+                dead.append(websocket)
+                continue
+            sent += 1
+        except Exception:
+            dead.append(websocket)
+    return sent, dead
@@ -0,0 +1,317 @@
+"""
+分块文件传输
+
+文件不走聊天消息的 JSON 广播：数据放在二进制帧里，每帧一块，帧头固定 13 字节：
+    0xC6 | file id (uint32) | offset (uint64) | 数据
+上传：
+    -> {"type": "file_offer", "name": "a.zip", "size": N, "room": "..."}
+    <- {"type": "file_offer", "id": 7, "offset": 0, "chunk": 65536, "window": 1048576}
+    -> 数据帧 ...                         客户端最多领先最近一次 file_ack window 字节
+    <- {"type": "file_ack", "id": 7, "offset": M}
+断线后 {"type": "file_offer", "id": 7} 取回服务端已经收到的 offset，从那里接着传。
+收完后房间里收到一条 {"type": "file", "id": 7, "name": ..., "size": ...}（带 seq，和聊天消息一样可以补发）。
+下载按需、只发给请求的连接：
+    -> {"type": "file_get", "id": 7, "offset": 0}
+    <- {"type": "file_get", "id": 7, "name": ..., "size": N, "offset": 0}，然后是数据帧
+服务端边收边顺序写进磁盘文件（file_dir 下以 id 命名），不在内存里攒整个文件；
+文件的元数据只在内存里：普通启动时 sweep() 删掉目录里上次留下的文件，
+热重启时 snapshot() / restore() 把已存的文件和上传到一半的位置交给新进程，文件原地保留。
+下载时 mmap 整个文件，直接把 mmap 的切片写进 transport，发完的页用 madvise 交还，
+所以传 1 GB 的文件时服务端内存保持平稳。
+正好接在已收到部分后面、在窗口之内的数据帧不受聊天限流约束，服务端按连接的文件字节桶推迟 file_ack；
+错位的、超出窗口的数据帧（重传、过期的窗口、不等 file_ack 的客户端）不写盘，
+按普通帧扣连接的条数和字节令牌，每个位置最多回一次 file_ack。
+"""
+import mmap
+import os
+import re
+import secrets
+import struct
+import time
+from collections import OrderedDict
+
+from core.presence import fold_name
+
+CHUNK_MAGIC = 0xC6
+CHUNK_PREFIX = b'\xc6'
+CHUNK_SIZE = 64 * 1024
+WINDOW = 1024 * 1024
+
+_CHUNK = struct.Struct('!BIQ')  # magic, file id, offset
+_FILE_NAME = re.compile(r'^\d+(\.part)?$')
+_PAGE = mmap.PAGESIZE
+
+
+class FileError(Exception):
+    pass
+
+
+def chunk_header(file_id, offset):
+    return _CHUNK.pack(CHUNK_MAGIC, file_id, offset)
+
+
+def parse_chunk(raw):
+    """数据帧 -> (file id, offset, 数据的 memoryview)"""
+    view = memoryview(raw)
+    if len(view) < _CHUNK.size or view[0] != CHUNK_MAGIC:
+        raise FileError("Invalid file chunk")
+    _, file_id, offset = _CHUNK.unpack_from(view)
+    return file_id, offset, view[_CHUNK.size:]
+
+
+def frame_header(length):
+    # header of an unmasked binary websocket frame, the chunk itself is written separately
+    if length < 126:
+        return bytes((0x82, length))
+    if length < 65536:
+        return b'\x82\x7e' + length.to_bytes(2, 'big')
+    return b'\x82\x7f' + length.to_bytes(8, 'big')
+
+
+class Upload:
+    __slots__ = ('id', 'name', 'size', 'room', 'owner', 'path', 'file', 'received', 'acked', 'resynced',
+                 'granting', 'touched')
+
+    def __init__(self, file_id, name, size, room, owner, path, received=0):
+        self.id = file_id
+        self.name = name
+        self.size = size
+        self.room = room
+        self.owner = owner  # folded username, an upload survives reconnects
+        self.path = path
+        if received:
+            # continued after a hot restart, anything past what was acknowledged is dropped
+            self.file = open(path, 'r+b')
+            self.file.truncate(received)
+            self.file.seek(received)
+        else:
+            self.file = open(path, 'wb')
+        self.received = received
+        self.acked = received
+        self.resynced = None  # offset the last file_ack for an out-of-order chunk named
+        self.granting = None  # timer of a file_ack held back by the file byte limit
+        self.touched = time.monotonic()
+
+
+class StoredFile:
+    __slots__ = ('id', 'name', 'size', 'room', 'username', 'path', 'map', 'view', 'readers')
+
+    def __init__(self, file_id, name, size, room, username, path):
+        self.id = file_id
+        self.name = name
+        self.size = size
+        self.room = room
+        self.username = username
+        self.path = path
+        self.map = None  # mmap while someone is downloading
+        self.view = None
+        self.readers = 0
+
+
+class FileStore:
+    def __init__(self, directory, max_file_size=1 << 30, max_bytes=16 << 30, max_uploads=4,
+                 chunk_size=CHUNK_SIZE, window=WINDOW, upload_timeout=600.0):
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.max_bytes = max_bytes  # uploads in progress count with their offered size
+        self.max_uploads = max_uploads  # per user
+        self.chunk_size = chunk_size
+        self.window = window
+        self.upload_timeout = upload_timeout
+        self.uploads = {}  # {id: Upload}
+        self.files = OrderedDict()  # {id: StoredFile}, oldest first
+        self.total_bytes = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.completed = 0
+        self.evicted = 0
+        # ids of a previous run may still be in the history, start somewhere else
+        self._next_id = secrets.randbelow(1 << 31) + 1
+        os.makedirs(directory, exist_ok=True)
+
+    def sweep(self):
+        # files of a previous run that were not restored have no metadata any more
+        for name in os.listdir(self.directory):
+            if not _FILE_NAME.match(name):
+                continue
+            file_id = int(name.split('.')[0])
+            if file_id not in (self.uploads if name.endswith('.part') else self.files):
+                os.remove(os.path.join(self.directory, name))
+
+    def snapshot(self):
+        """交给热重启后进程的元数据（可 JSON 序列化），在 close(keep=True) 之后取"""
+        return {
+            'next_id': self._next_id,
+            'files': [[stored.id, stored.name, stored.size, stored.room, stored.username]
+                      for stored in self.files.values()],
+            'uploads': [[upload.id, upload.name, upload.size, upload.room, upload.owner, upload.received]
+                        for upload in self.uploads.values()],
+        }
+
+    def restore(self, state):
+        """装回 snapshot()，在 sweep() 之前调用；磁盘上对不上的文件跳过"""
+        self._next_id = state['next_id']
+        for file_id, name, size, room, username in state['files']:
+            path = os.path.join(self.directory, str(file_id))
+            if os.path.isfile(path) and os.path.getsize(path) == size:
+                self.files[file_id] = StoredFile(file_id, name, size, room, username, path)
+                self.total_bytes += size
+        for file_id, name, size, room, owner, received in state['uploads']:
+            try:
+                upload = Upload(file_id, name, size, room, owner, os.path.join(self.directory, f"{file_id}.part"),
+                                received)
+            except OSError:
+                continue
+            self.uploads[file_id] = upload
+            self.total_bytes += size
+
+    # uploads
+
+    def offer(self, username, room, name, size):
+        if not isinstance(name, str) or not os.path.basename(name).strip():
+            raise FileError("File name cannot be empty")
+        if not isinstance(size, int) or size < 0:
+            raise FileError("File size must be a non-negative integer")
+        if size > self.max_file_size:
+            raise FileError(f"File is larger than {self.max_file_size} bytes")
+        owner = fold_name(username)
+        self._expire()
+        if sum(1 for upload in self.uploads.values() if upload.owner == owner) >= self.max_uploads:
+            raise FileError("Too many uploads in progress")
+        self._make_room(size)
+        file_id = self._next_id
+        self._next_id += 1
+        upload = Upload(file_id, os.path.basename(name), size, room, owner,
+                        os.path.join(self.directory, f"{file_id}.part"))
+        self.uploads[file_id] = upload
+        self.total_bytes += size
+        return upload
+
+    def find_upload(self, username, file_id):
+        # the user's upload in progress, None when there is no such upload
+        upload = self.uploads.get(file_id)
+        if upload is None or upload.owner != fold_name(username):
+            return None
+        return upload
+
+    def resume(self, username, file_id):
+        upload = self.find_upload(username, file_id)
+        if upload is None:
+            raise FileError(f"Upload {file_id} not found")
+        upload.touched = time.monotonic()
+        upload.acked = upload.received
+        return upload
+
+    def write(self, upload, offset, data):
+        """写入一块，返回是否写入；只接受正好接在已收到部分后面的块"""
+        if offset != upload.received:
+            return False
+        if offset + len(data) > upload.size:
+            self.discard(upload)
+            raise FileError(f"Upload {upload.id} is larger than offered")
+        upload.file.write(data)
+        upload.received += len(data)
+        upload.touched = time.monotonic()
+        self.bytes_in += len(data)
+        return True
+
+    def finish(self, upload, username):
+        # the last chunk arrived: close, rename and keep it for downloads
+        upload.file.close()
+        del self.uploads[upload.id]
+        stored = StoredFile(upload.id, upload.name, upload.size, upload.room, username,
+                            upload.path[:-len('.part')])
+        os.replace(upload.path, stored.path)
+        self.files[stored.id] = stored
+        self.completed += 1
+        return stored
+
+    def discard(self, upload):
+        upload.file.close()
+        self.uploads.pop(upload.id, None)
+        self.total_bytes -= upload.size
+        try:
+            os.remove(upload.path)
+        except OSError:
+            pass
+
+    def _expire(self):
+        deadline = time.monotonic() - self.upload_timeout
+        for upload in [upload for upload in self.uploads.values() if upload.touched < deadline]:
+            self.discard(upload)
+
+    def _make_room(self, size):
+        # oldest finished files go first, never one that is being downloaded
+        if self.total_bytes + size <= self.max_bytes:
+            return
+        for stored in list(self.files.values()):
+            if stored.readers == 0:
+                self.remove(stored.id)
+                self.evicted += 1
+                if self.total_bytes + size <= self.max_bytes:
+                    return
+        raise FileError("File storage is full, try again later")
+
+    # downloads
+
+    def get(self, file_id):
+        return self.files.get(file_id)
+
+    def open(self, stored):
+        """下载开始：返回整个文件的 memoryview，用完调用 release()"""
+        if stored.readers == 0 and stored.size:
+            with open(stored.path, 'rb') as file:
+                stored.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            stored.view = memoryview(stored.map)
+        stored.readers += 1
+        return stored.view
+
+    def sent(self, stored, start, end):
+        # pages already written to the transport go back to the page cache, not our RSS
+        self.bytes_out += end - start
+        if stored.map is not None and hasattr(stored.map, 'madvise'):
+            start -= start % _PAGE
+            end -= end % _PAGE
+            if end > start:
+                stored.map.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def release(self, stored):
+        stored.readers -= 1
+        if stored.readers == 0:
+            self._unmap(stored)
+
+    def _unmap(self, stored):
+        if stored.map is None:
+            return
+        try:
+            stored.view.release()
+            stored.map.close()
+        except (BufferError, ValueError):
+            # a transport buffer still holds a slice, the map goes when that is collected
+            pass
+        stored.view = stored.map = None
+
+    def remove(self, file_id):
+        stored = self.files.pop(file_id, None)
+        if stored is None:
+            return
+        self.total_bytes -= stored.size
+        try:
+            os.remove(stored.path)
+        except OSError:
+            pass
+
+    def stats(self):
+        return {'uploads': len(self.uploads), 'files': len(self.files), 'bytes': self.total_bytes,
+                'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'completed': self.completed, 'evicted': self.evicted}
+
+    def close(self, keep=False):
+        # keep: a hot restart, the uploads in progress are continued by the next process
+        for upload in list(self.uploads.values()):
+            if keep:
+                upload.file.close()
+            else:
+                self.discard(upload)
+        for stored in self.files.values():
+            self._unmap(stored)
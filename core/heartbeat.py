@@ -0,0 +1,114 @@
+"""
+心跳与空闲连接回收
+
+所有连接共用一个时间轮和一个后台任务，而不是每个连接一个定时器任务：
+    - 收到任何帧都算活动，只记录一下时间（touch，一次字典赋值）
+    - 时间轮上某个连接到期时才检查它：空闲超过 interval 发一个应用层 ping，
+      空闲超过 timeout 判定为死连接，交给 on_timeout 回收
+    - 没到期的重新放回时间轮
+时间精度是一个 tick（默认 1 秒），对心跳来说足够。
+"""
+import asyncio
+import math
+import time
+
+
+class TimingWheel:
+    """哈希时间轮：slots 个槽，每槽 tick 秒；超过一圈的条目记下还要转几圈"""
+
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # {key: remaining rounds}
+        self.where = {}  # {key: slot index}
+        self.current = 0
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, delay):
+        # (re)schedule key to expire after delay seconds, rounded up to whole ticks
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self.current + ticks) % len(self.slots)
+        self.slots[slot][key] = (ticks - 1) // len(self.slots)
+        self.where[key] = slot
+
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def advance(self):
+        """前进一个 tick，返回这一槽里到期的 key"""
+        self.current = (self.current + 1) % len(self.slots)
+        bucket = self.slots[self.current]
+        expired = []
+        for key, rounds in list(bucket.items()):
+            if rounds:
+                bucket[key] = rounds - 1
+            else:
+                del bucket[key]
+                del self.where[key]
+                expired.append(key)
+        return expired
+
+
+class Heartbeat:
+    def __init__(self, interval=20.0, timeout=60.0, on_ping=None, on_timeout=None, tick=1.0):
+        self.interval = interval  # idle seconds before a ping is sent
+        self.timeout = timeout  # idle seconds before the connection is reaped
+        self.on_ping = on_ping  # on_ping(key)
+        self.on_timeout = on_timeout  # on_timeout(key), key is already forgotten
+        self.tick = tick
+        self.wheel = TimingWheel(tick, slots=max(8, math.ceil(interval / tick) + 1))
+        self.last_seen = {}  # {key: monotonic time of the last inbound frame}
+        self.now = time.monotonic()  # refreshed every tick, precise enough for touch
+        self.pings = 0
+        self.reaped = 0
+        self._task = None
+
+    def add(self, key):
+        self.last_seen[key] = self.now
+        self.wheel.schedule(key, self.interval)
+
+    def touch(self, key):
+        if key in self.last_seen:
+            self.last_seen[key] = self.now
+
+    def remove(self, key):
+        if self.last_seen.pop(key, None) is not None:
+            self.wheel.cancel(key)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.now = time.monotonic()
+            for key in self.wheel.advance():
+                self._check(key)
+
+    def _check(self, key):
+        idle = self.now - self.last_seen[key]
+        if idle >= self.timeout:
+            del self.last_seen[key]
+            self.reaped += 1
+            if self.on_timeout is not None:
+                self.on_timeout(key)
+            return
+        if idle >= self.interval:
+            self.pings += 1
+            if self.on_ping is not None:
+                self.on_ping(key)
+            # check again when the next ping or the timeout is due
+            delay = min(self.interval, self.timeout - idle)
+        else:
+            delay = self.interval - idle
+        self.wheel.schedule(key, delay)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,172 @@
+"""
+最近历史的内存缓存
+
+每个房间一个有界环形缓冲区，保存最近广播过的消息的 JSON 文本和它的 WebSocket 帧，
+回放时 JSON 连接直接写缓存的帧，不需要重新编码；其他编码（binary、zjson、压缩）回放时现编，用完就丢，
+所以内存上限按文本加帧的长度算得准，不会被每种编码各一份的帧撑大。
+所有房间共享一个总内存上限，超出时按 LRU 淘汰最久没有读写的房间。
+
+缓存放在持久化存储（MessageLog）前面：缓存里的数据足够时命中，
+不够时从存储读取，并用读到的最新一段重新填满该房间的缓冲区。
+断线续连（resume）只从缓存读：after_seq() 从最新一条往回找到客户端看到的 seq 为止，
+代价只和漏掉的条数有关；更早的已经被淘汰的部分不再补发。
+"""
+from collections import OrderedDict, deque
+
+from core.codec import JSON, JSON_CODEC, Payload
+from core.fanout import encode_frame
+
+
+class _RoomBuffer:
+    __slots__ = ('entries', 'bytes')
+
+    def __init__(self):
+        self.entries = deque()  # (cursor, seq, json text, json frame)
+        self.bytes = 0
+
+
+class HistoryCache:
+    def __init__(self, per_room=200, max_bytes=64 * 1024 * 1024, store=None):
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self.store = store
+        self.rooms = OrderedDict()  # {room: _RoomBuffer}, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _buffer(self, room):
+        buffer = self.rooms.get(room)
+        if buffer is None:
+            buffer = self.rooms[room] = _RoomBuffer()
+        else:
+            self.rooms.move_to_end(room)
+        return buffer
+
+    def add(self, room, payload):
+        # only the json text and frame are kept, not the frames of other codecs on the payload
+        text = payload.encode(JSON_CODEC)
+        entry = payload.frames.get(JSON)
+        data = payload.data
+        self._append(self._buffer(room), data.get('cursor'), data.get('seq'), text,
+                     entry[1] if entry is not None else None)
+        self._evict(keep=room)
+
+    def _append(self, buffer, cursor, seq, text, frame=None):
+        if frame is None:
+            frame = encode_frame(text)
+        size = len(text) + len(frame)
+        buffer.entries.append((cursor, seq, text, frame))
+        buffer.bytes += size
+        self.total_bytes += size
+        if len(buffer.entries) > self.per_room:
+            _, _, old_text, old_frame = buffer.entries.popleft()
+            buffer.bytes -= len(old_text) + len(old_frame)
+            self.total_bytes -= len(old_text) + len(old_frame)
+
+    def _evict(self, keep=None):
+        while self.total_bytes > self.max_bytes and self.rooms:
+            room = next(iter(self.rooms))
+            if room == keep:
+                if len(self.rooms) == 1:
+                    break
+                self.rooms.move_to_end(room)
+                continue
+            buffer = self.rooms.pop(room)
+            self.total_bytes -= buffer.bytes
+            self.evictions += 1
+
+    def _fill(self, room, payloads):
+        # replace the room's buffer with the newest payloads read from the store
+        old = self.rooms.pop(room, None)
+        if old is not None:
+            self.total_bytes -= old.bytes
+        for payload in payloads[-self.per_room:]:
+            self.add(room, payload)
+
+    def recent(self, room, limit):
+        """该房间最近 limit 条消息的 Payload，按时间顺序"""
+        if limit <= 0:
+            return []
+        buffer = self.rooms.get(room)
+        entries = buffer.entries if buffer is not None else ()
+        stored = self.store.count(room) if self.store is not None else len(entries)
+        if len(entries) >= min(limit, stored):
+            self.hits += 1
+            if buffer is not None:
+                self.rooms.move_to_end(room)
+            return [Payload.from_json(text, frame) for _, _, text, frame in list(entries)[-limit:]]
+        self.misses += 1
+        records = self.store.read_recent(room, max(limit, self.per_room))
+        payloads = [Payload.from_json(text) for _, _, text in records]
+        self._fill(room, payloads)
+        return payloads[-limit:]
+
+    def since(self, room, cursor, limit):
+        """cursor 之后的消息（最多 limit 条），缓存覆盖不到时从存储读取"""
+        buffer = self.rooms.get(room)
+        entries = buffer.entries if buffer is not None else ()
+        # the buffer is a contiguous tail of the room, so it covers everything
+        # after the cursor if it reaches back to it or holds the whole room
+        covered = self.store is None or (entries and (
+            entries[0][0] is not None and entries[0][0] <= cursor
+            or self.store.count(room) == len(entries)))
+        if covered:
+            self.hits += 1
+            if buffer is not None:
+                self.rooms.move_to_end(room)
+            result = []
+            for entry_cursor, _, text, frame in entries:
+                if entry_cursor is None or entry_cursor > cursor:
+                    result.append(Payload.from_json(text, frame))
+                    if len(result) >= limit:
+                        break
+            return result
+        self.misses += 1
+        return [Payload.from_json(text) for _, _, text in self.store.read_since(room, cursor, limit)]
+
+    def first_seq(self, room):
+        # seq of the oldest buffered message, None when nothing of the room is buffered
+        buffer = self.rooms.get(room)
+        if buffer is None or not buffer.entries:
+            return None
+        return buffer.entries[0][1]
+
+    def after_seq(self, room, seq):
+        """缓存里 seq 之后的消息，按时间顺序"""
+        buffer = self.rooms.get(room)
+        if buffer is None:
+            self.misses += 1
+            return []
+        self.hits += 1
+        self.rooms.move_to_end(room)
+        missed = []
+        # seqs grow along the buffer, walk back from the newest
+        for _, entry_seq, text, frame in reversed(buffer.entries):
+            if entry_seq is None or entry_seq <= seq:
+                break
+            missed.append(Payload.from_json(text, frame))
+        missed.reverse()
+        return missed
+
+    def snapshot(self, room):
+        # the room's buffered messages as [seq, json text], oldest first, for a restart snapshot
+        buffer = self.rooms.get(room)
+        return [[seq, text] for _, seq, text, _ in buffer.entries] if buffer is not None else []
+
+    def restore(self, room, entries):
+        # snapshot() of the previous process, only without a store (so no cursors)
+        buffer = self._buffer(room)
+        for seq, text in entries[-self.per_room:]:
+            self._append(buffer, None, seq, text)
+        self._evict(keep=room)
+
+    def stats(self):
+        return {
+            'rooms': len(self.rooms),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
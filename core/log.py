@@ -0,0 +1,245 @@
+"""
+日志
+
+所有模块通过 get_logger() 拿到 'chatroom' 下的 logger，按级别过滤：
+    debug    每条消息、每次连接都记录（会带上消息内容）
+    info     启动、停止、加入 / 离开等事件
+    warning  异常情况
+    off      完全关闭
+
+setup_logging() 之后，事件循环里每条日志只把参数插进模板（参数之后再变也不影响）再入队，
+时间戳、格式化和写文件都不在事件循环里：
+    LogPipeline      后台线程批量取出记录，格式化后一次 write + flush；
+                     队列满时丢弃并计数，绝不阻塞调用方
+    RateLimitFilter  同一条 warning / error（logger + 模板 + 级别）每个时间窗口最多输出 burst 条，
+                     其余的只计数，下一次输出时附上 "N similar messages suppressed"
+    SampleFilter     'chatroom.messages' 下的逐条消息日志只保留每 N 条中的一条
+没有调用 setup_logging() 时（例如作为库使用），只有 warning 以上会输出到 stderr。
+"""
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+LOGGER_NAME = 'chatroom'
+MESSAGES_LOGGER = f"{LOGGER_NAME}.messages"  # per-message records, subject to sampling
+LEVELS = ('debug', 'info', 'warning', 'error', 'off')
+
+_pipeline = None
+_config = None  # arguments of the last setup_logging call
+
+
+def get_logger(name=None):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+
+class LogPipeline:
+    """有界队列 + 后台写线程；记录按批格式化、写出"""
+    _STOP = object()
+
+    def __init__(self, stream=None, formatter=None, max_queue=10000, batch_size=256, flush_interval=0.05):
+        self.stream = stream or sys.stderr
+        self.formatter = formatter or logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self.queue = queue.Queue(max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='chatroom-log', daemon=True)
+        self._thread.start()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _format(self, record):
+        # runs on the writer thread: timestamp, level and name, the message is final already
+        try:
+            line = self.formatter.format(record)
+        except Exception:
+            line = f"unformattable log record: {record.msg!r}"
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            line += f" ({suppressed} similar messages suppressed)"
+        return line
+
+    def _run(self):
+        reported = 0
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            lines = []
+            for n, record in enumerate(batch, 1):
+                if record is self._STOP:
+                    stop = True
+                else:
+                    lines.append(self._format(record))
+                if n % 32 == 0:
+                    # hand the GIL back now and then, the event loop never waits long for it
+                    time.sleep(0)
+            if self.dropped != reported:
+                lines.append(f"{self.dropped - reported} log records dropped, queue full")
+                reported = self.dropped
+            if lines:
+                try:
+                    self.stream.write('\n'.join(lines) + '\n')
+                    self.stream.flush()
+                except Exception:
+                    pass
+                self.written += len(lines)
+                self.batches += 1
+            if stop:
+                return
+            if len(batch) < self.batch_size:
+                # let records pile up: while this thread sleeps instead of waiting
+                # on the queue, enqueueing does not wake it for every record
+                time.sleep(self.flush_interval)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        # the sentinel waits for room, so everything queued before it is written
+        self.queue.put(self._STOP)
+        self._thread.join(timeout=5)
+        self._thread = None
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'written': self.written,
+                'batches': self.batches, 'dropped': self.dropped}
+
+
+class _PipelineHandler(logging.Handler):
+    def __init__(self, pipeline):
+        super().__init__()
+        self.pipeline = pipeline
+
+    def handle(self, record):
+        # the pipeline's queue is thread safe, no need for the handler lock
+        if self.filter(record):
+            self.pipeline.enqueue(self.prepare(record))
+        return record
+
+    def emit(self, record):
+        self.pipeline.enqueue(self.prepare(record))
+
+    @staticmethod
+    def prepare(record):
+        # like QueueHandler.prepare(): the args are interpolated on the calling thread,
+        # a mutable one the loop changes later is logged as it was
+        try:
+            record.msg = record.getMessage()
+        except Exception:
+            record.msg = f"unformattable log record: {record.msg!r} {record.args!r}"
+        record.args = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """同一条 warning / error 每 interval 秒最多放行 burst 条"""
+
+    def __init__(self, burst=10, interval=1.0, level=logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.level = level  # lower levels are gated by sampling instead
+        self.windows = {}  # {(name, template, level): [window start, passed, suppressed]}
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.msg, record.levelno)
+        now = record.created
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if window is None and len(self.windows) >= 10000:
+                # templates are few, this only guards against pre-formatted messages
+                self.windows.clear()
+            self.windows[key] = [now, 1, 0]
+            if window is not None and window[2]:
+                record.suppressed = window[2]
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class SampleFilter(logging.Filter):
+    """逐条消息日志（MESSAGES_LOGGER）每 every 条保留一条，其它日志不受影响"""
+
+    def __init__(self, every=1):
+        super().__init__()
+        self.every = every
+        self.seen = 0
+
+    def filter(self, record):
+        if self.every <= 1 or record.name != MESSAGES_LOGGER:
+            return True
+        self.seen += 1
+        return self.seen % self.every == 1
+
+
+def _stop_pipeline():
+    global _pipeline
+    if _pipeline is not None:
+        _pipeline.stop()
+        _pipeline = None
+
+
+atexit.register(_stop_pipeline)
+
+
+def setup_logging(level='info', stream=None, sample=1, burst=10, interval=1.0,
+                  max_queue=10000, batch_size=256):
+    """
+    配置 'chatroom' logger。level 为 LEVELS 之一，'off' 关闭全部日志；
+    sample 为逐条消息日志的采样间隔，burst / interval 为重复日志的限流参数。
+    返回 LogPipeline（关闭时为 None）。
+    """
+    global _pipeline, _config
+    _config = (level, stream, sample, burst, interval, max_queue, batch_size)
+    root = get_logger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    _stop_pipeline()
+    # our own handlers only, never the root logger's
+    root.propagate = False
+    if level == 'off':
+        root.setLevel(logging.CRITICAL + 1)
+        root.addHandler(logging.NullHandler())
+        return None
+
+    _pipeline = LogPipeline(stream, max_queue=max_queue, batch_size=batch_size)
+    handler = _PipelineHandler(_pipeline)
+    handler.addFilter(SampleFilter(sample))
+    handler.addFilter(RateLimitFilter(burst, interval))
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    _pipeline.start()
+    return _pipeline
+
+
+def _after_fork():
+    # the writer thread does not survive fork, worker processes start their own
+    global _pipeline
+    if _pipeline is not None:
+        _pipeline = None
+        setup_logging(*_config)
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,64 @@
+"""
+离线私信信箱
+
+目标用户不在线时，私信（dm）暂存在以规范化用户名（fold_name）为键的信箱里，
+用户下次 join 时一次取出并按原顺序投递。两层上限：
+    per_user   每个信箱最多保存的条数，满了丢弃最旧的
+    max_users  信箱总数，超出时按 LRU 丢弃最久没有收到私信的整个信箱
+多节点模式下每个节点只保存自己收到的私信，并记下转发时的 id，
+其它节点投递成功（dm_ack）后用 discard() 删掉对应的那条。
+"""
+from collections import OrderedDict, deque
+
+
+class Mailbox:
+    def __init__(self, per_user=100, max_users=10000):
+        self.per_user = per_user
+        self.max_users = max_users
+        self.boxes = OrderedDict()  # {folded username: deque(payload)}, least recently written first
+        self.stored = 0
+        self.dropped = 0
+        self.delivered = 0
+
+    def __len__(self):
+        # messages waiting across all boxes
+        return sum(len(box) for box in self.boxes.values())
+
+    def put(self, key, payload):
+        box = self.boxes.get(key)
+        if box is None:
+            if len(self.boxes) >= self.max_users:
+                _, oldest = self.boxes.popitem(last=False)
+                self.dropped += len(oldest)
+            box = self.boxes[key] = deque()
+        else:
+            self.boxes.move_to_end(key)
+        if len(box) >= self.per_user:
+            box.popleft()
+            self.dropped += 1
+        box.append(payload)
+        self.stored += 1
+
+    def take(self, key):
+        """取出并清空 key 的信箱，按收到的顺序"""
+        box = self.boxes.pop(key, None)
+        if not box:
+            return []
+        self.delivered += len(box)
+        return list(box)
+
+    def discard(self, key, message_id):
+        # the message was delivered elsewhere
+        box = self.boxes.get(key)
+        if box is None:
+            return
+        for payload in box:
+            if payload.data.get('id') == message_id:
+                box.remove(payload)
+                break
+        if not box:
+            del self.boxes[key]
+
+    def stats(self):
+        return {'boxes': len(self.boxes), 'waiting': len(self), 'stored': self.stored,
+                'dropped': self.dropped, 'delivered': self.delivered}
@@ -0,0 +1,375 @@
+"""
+持久化消息日志
+
+只追加、分段存储：目录下的 00000000.log, 00000001.log ...，单个段写满后切到下一个段。
+每条记录：
+    header  !IQqH  payload 长度, cursor, 时间戳(毫秒), room 长度
+    room    utf-8
+    payload 消息的 JSON 文本（就是发给 JSON 客户端的那一帧）
+cursor 是全局递增的记录编号，客户端可以带着它重新 join，只取之后的消息。
+
+写入先进文件缓冲区，后台任务按时间间隔 / 条数批量 flush + fsync（fsync 在线程池里执行）。
+写满的段交给同一个后台任务，在线程池里 fsync、关闭并写 .idx；段文件只由它关闭，不会 fsync 一个已关闭（或被复用）的 fd。
+内存里按房间保存 (cursor, 时间戳, 段号, 偏移) 的紧凑数组索引，读取通过 mmap 段文件完成，
+回放历史时不会把整个日志读进堆内存。
+
+段写满切换时（以及正常关闭时的当前段）把该段的索引数组写进同名的 .idx 文件：
+    header  4s Q I  magic（含字节序）, 覆盖的段文件字节数, 房间数
+    每个房间 !HI 名字长度, 条数；名字 utf-8；cursor / 时间戳 / 偏移三个数组的原始字节
+启动时段文件大小和 .idx 对得上、最后一条记录也在 .idx 说的位置，就直接载入数组，
+不再逐条扫描（100 万条从几秒降到几十毫秒）；对不上（崩溃后、旧版本写的日志）就照旧扫描。
+"""
+import asyncio
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+_HEADER = struct.Struct('!IQqH')
+_SEGMENT_SUFFIX = '.log'
+_INDEX_SUFFIX = '.idx'
+# the arrays are written in native byte order, an index from another machine is scanned over
+_INDEX_MAGIC = b'CIX' + sys.byteorder[:1].encode()
+_INDEX_HEADER = struct.Struct('!4sQI')
+_INDEX_ROOM = struct.Struct('!HI')
+
+
+class _RoomIndex:
+    __slots__ = ('cursors', 'timestamps', 'segments', 'offsets')
+
+    def __init__(self):
+        self.cursors = array('Q')
+        self.timestamps = array('q')
+        self.segments = array('I')
+        self.offsets = array('Q')
+
+    def add(self, cursor, timestamp, segment, offset):
+        self.cursors.append(cursor)
+        self.timestamps.append(timestamp)
+        self.segments.append(segment)
+        self.offsets.append(offset)
+
+
+class MessageLog:
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, fsync_interval=0.05, fsync_batch=256):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.rooms = {}  # {room: _RoomIndex}
+        self.next_cursor = 1
+        self._segment = 0  # active segment number
+        self._file = None
+        self._size = 0  # bytes written to the active segment
+        self._flushed = 0  # bytes of the active segment visible to readers
+        self._pending = 0  # records written since the last fsync
+        self._maps = {}  # {segment: mmap}
+        self._wakeup = None
+        self._flusher = None
+        self._sealing = deque()  # (file, segment, .idx parts) of full segments, for the flusher
+        self._closing = False
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}{_SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        return sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(_SEGMENT_SUFFIX) and name[:-len(_SEGMENT_SUFFIX)].isdigit())
+
+    def _index_path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}{_INDEX_SUFFIX}")
+
+    def _load(self):
+        # rebuild the in-memory index from the segments on disk
+        segments = self._segments()
+        for segment in segments:
+            size = os.path.getsize(self._path(segment))
+            if self._load_index(segment, size):
+                valid = size
+            else:
+                valid = self._scan(segment)
+                if valid and segment != segments[-1]:
+                    # sealed, the next start will not have to scan it
+                    self._save_index(segment, self._index_parts(segment, valid))
+            if size != valid:
+                # torn write at the tail after a crash
+                os.truncate(self._path(segment), valid)
+            self._segment = segment
+        self._file = open(self._path(self._segment), 'ab')
+        self._size = self._flushed = self._file.tell()
+
+    def _scan(self, segment):
+        path = self._path(segment)
+        size = os.path.getsize(path)
+        if size == 0:
+            return 0
+        offset = 0
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            while offset + _HEADER.size <= size:
+                length, cursor, timestamp, room_len = _HEADER.unpack_from(view, offset)
+                end = offset + _HEADER.size + room_len + length
+                if end > size:
+                    break
+                room = str(view[offset + _HEADER.size:offset + _HEADER.size + room_len], 'utf-8')
+                self._index(room).add(cursor, timestamp, segment, offset)
+                self.next_cursor = max(self.next_cursor, cursor + 1)
+                offset = end
+        return offset
+
+    def _index_parts(self, segment, size):
+        # the segment's slice of every room's arrays, taken on the loop while appends go on
+        parts = []
+        rooms = 0
+        for room, index in self.rooms.items():
+            # segment numbers only grow along a room's arrays
+            start = bisect_left(index.segments, segment)
+            stop = bisect_right(index.segments, segment, start)
+            if start == stop:
+                continue
+            raw_room = room.encode('utf-8')
+            parts += (_INDEX_ROOM.pack(len(raw_room), stop - start), raw_room, index.cursors[start:stop].tobytes(),
+                      index.timestamps[start:stop].tobytes(), index.offsets[start:stop].tobytes())
+            rooms += 1
+        return [_INDEX_HEADER.pack(_INDEX_MAGIC, size, rooms)] + parts
+
+    def _save_index(self, segment, parts):
+        # written aside and renamed, a torn file is never read
+        path = self._index_path(segment)
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                f.writelines(parts)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            # only a slower next start
+            pass
+
+    def _seal(self, file, segment, parts):
+        # a finished segment for good: fsync, close, then its .idx; runs in the thread pool
+        try:
+            os.fsync(file.fileno())
+        finally:
+            file.close()
+        if parts is not None:
+            self._save_index(segment, parts)
+
+    def _load_index(self, segment, size):
+        # False when the segment has no .idx matching what is on disk, it is scanned instead
+        try:
+            with open(self._index_path(segment), 'rb') as f:
+                view = memoryview(f.read())
+        except OSError:
+            return False
+        loaded = []
+        last_offset, last_cursor = -1, 0
+        try:
+            magic, indexed_size, rooms = _INDEX_HEADER.unpack_from(view, 0)
+            if magic != _INDEX_MAGIC or indexed_size != size or not size:
+                return False
+            position = _INDEX_HEADER.size
+            for _ in range(rooms):
+                name_len, count = _INDEX_ROOM.unpack_from(view, position)
+                position += _INDEX_ROOM.size
+                room = str(view[position:position + name_len], 'utf-8')
+                position += name_len
+                arrays = []
+                for typecode in 'QqQ':
+                    values = array(typecode)
+                    values.frombytes(view[position:position + count * values.itemsize])
+                    position += count * values.itemsize
+                    arrays.append(values)
+                if not count or len(arrays[2]) != count:
+                    return False
+                loaded.append((room, arrays))
+                if arrays[2][-1] > last_offset:
+                    last_offset, last_cursor = arrays[2][-1], arrays[0][-1]
+            if position != len(view):
+                return False
+            # the last record must be where the index says, and end the segment
+            with open(self._path(segment), 'rb') as f:
+                f.seek(last_offset)
+                length, cursor, _, room_len = _HEADER.unpack(f.read(_HEADER.size))
+        except (struct.error, UnicodeDecodeError, ValueError):
+            return False
+        if cursor != last_cursor or last_offset + _HEADER.size + room_len + length != size:
+            return False
+        for room, (cursors, timestamps, offsets) in loaded:
+            index = self._index(room)
+            index.cursors += cursors
+            index.timestamps += timestamps
+            index.offsets += offsets
+            index.segments += array('I', [segment]) * len(cursors)
+        self.next_cursor = max(self.next_cursor, last_cursor + 1)
+        return True
+
+    def _index(self, room):
+        index = self.rooms.get(room)
+        if index is None:
+            index = self.rooms[room] = _RoomIndex()
+        return index
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    def append(self, room, payload, timestamp):
+        """追加一条记录，payload 是 JSON 文本，timestamp 为毫秒。返回记录的 cursor。"""
+        if self._size >= self.segment_size:
+            self._rotate()
+        cursor = self.next_cursor
+        self.next_cursor += 1
+        raw_room = room.encode('utf-8')
+        raw_payload = payload.encode('utf-8')
+        index = self._index(room)
+        if index.timestamps and timestamp < index.timestamps[-1]:
+            # keep each room's timestamps sorted even if the wall clock steps back
+            timestamp = index.timestamps[-1]
+        offset = self._size
+        self._file.write(_HEADER.pack(len(raw_payload), cursor, timestamp, len(raw_room)))
+        self._file.write(raw_room)
+        self._file.write(raw_payload)
+        self._size += _HEADER.size + len(raw_room) + len(raw_payload)
+        index.add(cursor, timestamp, self._segment, offset)
+        self._pending += 1
+        if self._pending >= self.fsync_batch and self._wakeup is not None:
+            self._wakeup.set()
+        return cursor
+
+    def _rotate(self):
+        # the full segment goes to the flusher, appends go on in the next one meanwhile
+        self._file.flush()
+        sealed = (self._file, self._segment, self._index_parts(self._segment, self._size))
+        self._segment += 1
+        self._file = open(self._path(self._segment), 'ab')
+        self._size = self._flushed = 0
+        self._pending = 0
+        if self._flusher is None:
+            self._seal(*sealed)
+        else:
+            self._sealing.append(sealed)
+            self._wakeup.set()
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.fsync_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._sealing:
+                # one at a time and only here, never alongside the fsync below
+                await loop.run_in_executor(None, self._seal, *self._sealing.popleft())
+            if self._closing:
+                return
+            if not self._pending:
+                continue
+            self._pending = 0
+            self._file.flush()
+            self._flushed = self._size
+            # fsync blocks on the disk, keep it off the event loop; a rotation meanwhile
+            # only queues this file, it stays open until the flusher seals it
+            await loop.run_in_executor(None, os.fsync, self._file.fileno())
+
+    def _map(self, segment, needed):
+        view = self._maps.get(segment)
+        if view is not None and len(view) >= needed:
+            return view
+        if segment == self._segment and self._flushed < needed:
+            # reading something still sitting in the write buffer
+            self._file.flush()
+            self._flushed = self._size
+        if view is not None:
+            view.close()
+        with open(self._path(segment), 'rb') as f:
+            view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[segment] = view
+        return view
+
+    def _read(self, segment, offset):
+        # returns (cursor, timestamp, payload text)
+        view = self._map(segment, offset + _HEADER.size)
+        length, cursor, timestamp, room_len = _HEADER.unpack_from(view, offset)
+        start = offset + _HEADER.size + room_len
+        view = self._map(segment, start + length)
+        return cursor, timestamp, str(view[start:start + length], 'utf-8')
+
+    def _read_positions(self, index, start, stop):
+        return [self._read(index.segments[i], index.offsets[i]) for i in range(start, stop)]
+
+    def read_cursor(self, room, cursor):
+        # the record with this cursor, None if the room has none
+        index = self.rooms.get(room)
+        if index is None:
+            return None
+        i = bisect_left(index.cursors, cursor)
+        if i == len(index.cursors) or index.cursors[i] != cursor:
+            return None
+        return self._read(index.segments[i], index.offsets[i])
+
+    def scan(self, stop_cursor):
+        """按写入顺序逐条给出 cursor < stop_cursor 的记录 (cursor, 时间戳, room, payload 文本)。
+        自己打开段文件、不碰写入状态，可以在线程池里运行（用于重建搜索索引）。"""
+        for segment in self._segments():
+            with open(self._path(segment), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                    offset = 0
+                    while offset + _HEADER.size <= size:
+                        length, cursor, timestamp, room_len = _HEADER.unpack_from(view, offset)
+                        end = offset + _HEADER.size + room_len + length
+                        if end > size or cursor >= stop_cursor:
+                            return
+                        start = offset + _HEADER.size
+                        yield (cursor, timestamp, str(view[start:start + room_len], 'utf-8'),
+                               str(view[start + room_len:end], 'utf-8'))
+                        offset = end
+
+    def count(self, room):
+        index = self.rooms.get(room)
+        return len(index.cursors) if index is not None else 0
+
+    def read_recent(self, room, limit):
+        index = self.rooms.get(room)
+        if index is None or limit <= 0:
+            return []
+        count = len(index.cursors)
+        return self._read_positions(index, max(0, count - limit), count)
+
+    def read_since(self, room, cursor, limit):
+        # records with a cursor greater than the given one, oldest first
+        index = self.rooms.get(room)
+        if index is None:
+            return []
+        start = bisect_right(index.cursors, cursor)
+        return self._read_positions(index, start, min(len(index.cursors), start + limit))
+
+    def read_between(self, room, start_ms, end_ms, limit):
+        # records with start_ms <= timestamp < end_ms, oldest first
+        index = self.rooms.get(room)
+        if index is None:
+            return []
+        start = bisect_left(index.timestamps, start_ms)
+        stop = min(bisect_left(index.timestamps, end_ms), start + limit)
+        return self._read_positions(index, start, stop)
+
+    async def close(self):
+        if self._flusher is not None:
+            # not cancel(): on 3.11 wait_for can swallow a cancel that races the wakeup, close() would hang
+            self._closing = True
+            self._wakeup.set()
+            await self._flusher
+            self._flusher = None
+        self._file.flush()
+        # appending again makes the .idx stale, then the next start scans this segment
+        parts = self._index_parts(self._segment, self._size) if self._size else None
+        await asyncio.get_running_loop().run_in_executor(None, self._seal, self._file, self._segment, parts)
+        for view in self._maps.values():
+            view.close()
+        self._maps.clear()
@@ -1,19 +1,42 @@
+from core.codec import Payload
+
 JOIN = 'join'
 MESSAGE = 'message'
 LEAVE = 'leave'
 ERROR = 'error'
+JOIN_ROOM = 'join_room'
+LEAVE_ROOM = 'leave_room'
+SWITCH_ROOM = 'switch_room'
+# several chat messages of one room sent as a single frame, see core/batching.py
+BATCH = 'batch'
+# application-level heartbeat, either side answers a ping with a pong
+PING = 'ping'
+PONG = 'pong'
+# online users, paginated, and the diffs sent to subscribers, see core/presence.py
+WHO = 'who'
+LIST_USERS = 'list_users'  # same as who
+PRESENCE = 'presence'
+# private message to one user, kept in a mailbox while they are offline
+DM = 'dm'
+# reconnect with the last seq seen per room, also the session info sent after every join
+RESUME = 'resume'
+# chunked file transfer, the data goes in binary frames, see core/files.py
+FILE_OFFER = 'file_offer'
+FILE_ACK = 'file_ack'
+FILE_GET = 'file_get'
+FILE = 'file'  # a finished upload, announced to the room
+# a request that carried a "ref" was handled; a refused one gets an error with that ref instead
+ACK = 'ack'
+# full-text search over the stored history, newest first, paginated, see core/search.py
+SEARCH = 'search'
+# the server is going away: reconnect at a random point within "spread" ms, to "url" if given
+RECONNECT = 'reconnect'
 
-def format_message(msg_type, **kwargs):
-    import json
-    data = {'type': str(msg_type)}
-    for k, v in kwargs.items():
-        try:
-            json.dumps({k: v})
-            data[k] = v
-        except Exception:
-            data[k] = str(v)
-    return json.dumps(data, ensure_ascii=False)
+# room used when a join or message does not name one
+DEFAULT_ROOM = 'Chatroom 0'
 
-# 检查此文件没有问题，[error]: unable to connect to chat server 不是由本文件引起的。
-# 请检查 server 是否已启动、端口是否一致、依赖是否安装、网络是否正常。
-# 如果需要定位连接问题，请查看 server.py 和 socket_base.py 的启动与监听日志。
+def build_message(msg_type, **kwargs):
+    # encoded lazily, once per codec in use
+    data = {'type': str(msg_type)}
+    data.update(kwargs)
+    return Payload(data)
@@ -0,0 +1,183 @@
+"""
+运行指标
+
+Registry 保存计数器、直方图和按需计算的指标（读取时调用一个函数），
+render() 输出 Prometheus 文本格式，MetricsServer 在本地 HTTP 端口上提供 /metrics：
+    curl http://127.0.0.1:9100/metrics
+热路径上只做整数加法和一次 bisect，不分配对象、不加锁。
+"""
+import asyncio
+from bisect import bisect_left
+
+from core.log import get_logger
+
+log = get_logger('metrics')
+
+# seconds, from 10us to 1s
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class Counter:
+    __slots__ = ('name', 'help', 'value')
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Histogram:
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}}', cumulative
+        yield f'{self.name}_bucket{{le="+Inf"}}', self.count
+        yield f'{self.name}_sum', self.sum
+        yield f'{self.name}_count', self.count
+
+
+class Computed:
+    """读取时才计算的指标，例如当前连接数，或者从各个发送队列汇总的计数"""
+    __slots__ = ('name', 'help', 'kind', 'func')
+
+    def __init__(self, name, help, func, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.func = func
+
+    @property
+    def value(self):
+        return self.func()
+
+    def samples(self):
+        yield self.name, self.func()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}  # {name: metric}, in registration order
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"metric already registered: {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, func):
+        return self._register(Computed(name, help, func))
+
+    def computed_counter(self, name, help, func):
+        return self._register(Computed(name, help, func, kind='counter'))
+
+    def render(self):
+        # prometheus text exposition format 0.0.4
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        # plain dict, histograms as {'count', 'sum', 'buckets'}
+        result = {}
+        for name, metric in self.metrics.items():
+            if isinstance(metric, Histogram):
+                result[name] = {'count': metric.count, 'sum': metric.sum,
+                                'buckets': dict(zip(metric.bounds + ('+Inf',), metric.counts))}
+            else:
+                result[name] = metric.value
+        return result
+
+
+class MetricsServer:
+    """只响应 GET /metrics 的最小 HTTP 服务，和聊天服务共用事件循环"""
+
+    def __init__(self, registry, host='127.0.0.1', port=9100, read_timeout=5.0, max_header=8192):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.read_timeout = read_timeout  # for the whole request head
+        self.max_header = max_header  # bytes of request line plus headers
+        self.server = None
+
+    async def start(self):
+        # limit caps a single line: a longer one makes readline raise ValueError
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, limit=self.max_header)
+        log.info("metrics endpoint: http://%s:%s/metrics", self.host, self.port)
+
+    async def _read_head(self, reader):
+        # request line; headers are read and skipped, up to max_header bytes in all
+        request_line = await reader.readline()
+        size = len(request_line)
+        while True:
+            line = await reader.readline()
+            size += len(line)
+            if size > self.max_header:
+                raise ValueError("request head too large")
+            if not line.strip():
+                return request_line
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                request_line = await asyncio.wait_for(self._read_head(reader), self.read_timeout)
+            except (asyncio.TimeoutError, ValueError) as e:
+                # slow or oversized request: close without an answer
+                log.debug("metrics request dropped: %s", e or 'read timed out')
+                return
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                body = self.registry.render().encode('utf-8')
+                status = '200 OK'
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                body = b'not found\n'
+                status = '404 Not Found'
+                content_type = 'text/plain'
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
@@ -0,0 +1,63 @@
+"""
+一条连接上的多个用户（多路复用）
+
+机器人、桥接要用几百个身份，不必每个身份一条 WebSocket：客户端发出的帧带 "ch"（连接内的 channel 号），
+服务端为每个 channel 建一个 Channel，在会话注册表里它就是一个普通连接，join / 消息 / 私信 / resume
+等处理函数不需要区分。所有 channel 共用物理连接的发送队列、限流状态和压缩参数：
+    只发给某个 channel 的帧（错误、ack、历史回放、私信、who）带上它的 "ch"，见 SocketBase.send_queued
+    房间广播每条物理连接只写一份、不带 "ch"，由客户端按房间分发给这条连接上在该房间的用户，见 core/fanout.py
+物理连接断开时它的所有 channel 一起离开；一个 channel leave 只去掉这一个用户，连接保持。
+"""
+
+
+class Channel:
+    __slots__ = ('connection', 'id')
+
+    def __init__(self, connection, channel_id):
+        self.connection = connection  # the physical websocket
+        self.id = channel_id
+
+    def __repr__(self):
+        return f"<Channel {self.id} of {self.connection.remote_address}>"
+
+    # what the handlers and fanout read from a connection comes from the physical one
+
+    @property
+    def state(self):
+        return self.connection.state
+
+    @property
+    def closed(self):
+        return self.connection.closed
+
+    @property
+    def transport(self):
+        return self.connection.transport
+
+    @property
+    def _paused(self):
+        return self.connection._paused
+
+    @property
+    def extensions(self):
+        return self.connection.extensions
+
+    @property
+    def remote_address(self):
+        return self.connection.remote_address
+
+    async def drain(self):
+        await self.connection.drain()
+
+    def write_frame_sync(self, fin, opcode, data):
+        self.connection.write_frame_sync(fin, opcode, data)
+
+    async def send(self, message):
+        await self.connection.send(message)
+
+    def fail_connection(self, code=1006, reason=''):
+        # the user goes (its session is already removed), the connection and its other users stay
+        pass
+
+    async def close(self, code=1000, reason=''):
+        pass
@@ -0,0 +1,160 @@
+"""
+每个连接的有界发送队列
+
+transport 可写时直接写入（不排队、不建任务）；一旦 transport 因对端读得慢而暂停写入，
+后续帧进入有界队列，由该连接的 writer 任务在 drain 之后继续写出。
+队列满时按策略处理：
+    drop_oldest  丢弃最旧的帧
+    drop_newest  丢弃新来的帧
+    coalesce     用新帧替换队列中 key 相同的旧帧，没有相同 key 时退化为 drop_oldest
+    disconnect   达到高水位直接断开这个慢连接
+"""
+import asyncio
+from collections import deque
+
+from websockets.frames import Opcode
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE, DISCONNECT)
+
+# an empty deque is ~760 bytes, idle connections share this instead
+_NO_FRAMES = ()
+
+
+class OutboundQueue:
+    __slots__ = ('websocket', 'max_size', 'policy', 'frames', 'queued_bytes', 'peak_depth', 'sent',
+                 'sent_bytes', 'dropped', 'coalesced', 'closed', '_writer')
+
+    def __init__(self, websocket, max_size=256, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy: {policy}")
+        self.websocket = websocket
+        self.max_size = max_size  # also the high-water mark for the disconnect policy
+        self.policy = policy
+        self.frames = _NO_FRAMES  # deque of [frame_bytes, message, key] while backed up
+        self.queued_bytes = 0
+        self.peak_depth = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+        self._writer = None
+
+    def put(self, message, frame_bytes=None, key=None):
+        """
+        发送一条消息。frame_bytes 是预先编码好的帧（无扩展连接可共用），
+        key 用于 coalesce 策略。连接已失效时返回 False。
+        """
+        if self.closed:
+            return False
+        websocket = self.websocket
+        if not self.frames and not websocket._paused:
+            # fast path: nothing queued and the transport is accepting writes
+            self._write(frame_bytes, message)
+            return True
+
+        if len(self.frames) >= self.max_size:
+            if not self._make_room(frame_bytes, message, key):
+                return not self.closed
+
+        if self.frames is _NO_FRAMES:
+            self.frames = deque()
+        self.frames.append([frame_bytes, message, key])
+        self.queued_bytes += self._size(frame_bytes, message)
+        if len(self.frames) > self.peak_depth:
+            self.peak_depth = len(self.frames)
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._drain())
+        return True
+
+    def _make_room(self, frame_bytes, message, key):
+        # returns True when the new frame should still be appended
+        if self.policy == DROP_NEWEST:
+            self.dropped += 1
+            return False
+        if self.policy == DISCONNECT:
+            self.dropped += 1 + len(self.frames)
+            self.close()
+            try:
+                self.websocket.fail_connection(1008, "slow consumer")
+            except Exception:
+                pass
+            return False
+        if self.policy == COALESCE and key is not None:
+            for item in self.frames:
+                if item[2] == key:
+                    self.queued_bytes += self._size(frame_bytes, message) - self._size(item[0], item[1])
+                    item[0] = frame_bytes
+                    item[1] = message
+                    self.coalesced += 1
+                    return False
+        old_frame, old_message, _ = self.frames.popleft()
+        self.queued_bytes -= self._size(old_frame, old_message)
+        self.dropped += 1
+        return True
+
+    async def _drain(self):
+        websocket = self.websocket
+        try:
+            while self.frames:
+                # wait until the transport drops below its own high-water mark
+                await websocket.drain()
+                while self.frames and not websocket._paused:
+                    frame_bytes, message, _ = self.frames.popleft()
+                    self.queued_bytes -= self._size(frame_bytes, message)
+                    self._write(frame_bytes, message)
+        except Exception:
+            self._discard()
+        finally:
+            self._writer = None
+            if not self.frames:
+                self.frames = _NO_FRAMES
+
+    def _write(self, frame_bytes, message):
+        websocket = self.websocket
+        if frame_bytes is not None:
+            # built by fanout for this connection's extensions (an uncompressed
+            # frame is always valid, permessage-deflate compression is per message)
+            websocket.transport.write(frame_bytes)
+            self.sent_bytes += len(frame_bytes)
+        elif isinstance(message, str):
+            # no prebuilt frame, websockets frames it and applies extensions
+            data = message.encode('utf-8')
+            websocket.write_frame_sync(True, Opcode.TEXT, data)
+            self.sent_bytes += len(data)
+        else:
+            websocket.write_frame_sync(True, Opcode.BINARY, bytes(message))
+            self.sent_bytes += len(message)
+        self.sent += 1
+
+    @staticmethod
+    def _size(frame_bytes, message):
+        return len(frame_bytes) if frame_bytes is not None else len(message)
+
+    def _discard(self):
+        self.closed = True
+        self.frames = _NO_FRAMES
+        self.queued_bytes = 0
+
+    def close(self):
+        self._discard()
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+
+    def stats(self):
+        return {
+            'depth': len(self.frames),
+            'peak_depth': self.peak_depth,
+            'queued_bytes': self.queued_bytes,
+            'sent': self.sent,
+            'sent_bytes': self.sent_bytes,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'policy': self.policy,
+        }
@@ -0,0 +1,110 @@
+"""
+在线用户索引
+
+用户名按 fold_name() 规范化（NFKC + casefold）后唯一："Alice" 和 "ALICE" 是同一个名字，
+占用由 SessionRegistry.add_user() 检查（见 core/session.py）。
+PresenceIndex 维护一份按规范化名字排序的在线列表，join / leave 时用 bisect 增量插入删除，
+who 请求按游标分页直接切片，不扫描全部会话：
+    {"type": "who", "after": <上一页的 next>, "limit": 50, "prefix": "al", "subscribe": true}
+    -> {"type": "who", "users": [...], "next": <游标或 null>, "total": N, "version": V}
+subscribe 为 true 的连接之后只收到增量：
+    {"type": "presence", "version": V, "online": [...], "offline": [...]}
+同一轮事件循环里的变化合并成一帧（先上线又下线的互相抵消），每帧只编码一次再扇出。
+version 每帧加一，订阅者发现跳号时重新 who 一次即可。
+索引只覆盖本进程（或本节点）的用户，多节点之间不做全局唯一。
+"""
+import asyncio
+import unicodedata
+from bisect import bisect_left, bisect_right, insort
+
+from core.message_types import PRESENCE, build_message
+
+PAGE_MAX = 500
+
+
+def fold_name(username):
+    # the comparison key for usernames, also the sort order of listings
+    return unicodedata.normalize('NFKC', username).casefold()
+
+
+class PresenceIndex:
+    def __init__(self, send):
+        self.send = send  # send(payload, targets), used for the diffs
+        self.keys = []  # sorted folded names
+        self.display = {}  # {folded name: username as given at join}
+        self.subscribers = set()  # connections that get presence diffs
+        self.version = 0
+        self._pending = {}  # {username: True online / False offline} until the next flush
+        self._flush_handle = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, username):
+        key = fold_name(username)
+        if key in self.display:
+            return
+        insort(self.keys, key)
+        self.display[key] = username
+        self._changed(username, True)
+
+    def remove(self, username):
+        key = fold_name(username)
+        if self.display.pop(key, None) is None:
+            return
+        del self.keys[bisect_left(self.keys, key)]
+        self._changed(username, False)
+
+    def page(self, after=None, limit=50, prefix=None):
+        """返回 (用户名列表, 下一页游标)；游标是本页最后一个名字的规范化形式"""
+        limit = max(1, min(int(limit), PAGE_MAX))
+        keys = self.keys
+        start, stop = 0, len(keys)
+        if prefix:
+            prefix = fold_name(prefix)
+            start = bisect_left(keys, prefix)
+            stop = bisect_left(keys, prefix + '\U0010ffff', start)
+        if after is not None:
+            # keyset pagination, stable while users come and go
+            start = max(start, bisect_right(keys, fold_name(str(after))))
+        end = min(start + limit, stop)
+        selected = keys[start:end]
+        return [self.display[key] for key in selected], (selected[-1] if end < stop else None)
+
+    # diff subscriptions
+
+    def subscribe(self, connection):
+        self.subscribers.add(connection)
+
+    def unsubscribe(self, connection):
+        self.subscribers.discard(connection)
+
+    def _changed(self, username, online):
+        if not self.subscribers:
+            return
+        if self._pending.get(username) is (not online):
+            # went the other way within the same round, nothing to report
+            del self._pending[username]
+        else:
+            self._pending[username] = online
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self._flush_handle = None
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = {}
+        self.version += 1
+        diff = build_message(PRESENCE,
+            version=self.version,
+            online=[name for name, online in pending.items() if online],
+            offline=[name for name, online in pending.items() if not online]
+        )
+        self.send(diff, self.subscribers)
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
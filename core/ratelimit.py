@@ -0,0 +1,174 @@
+"""
+按连接 / 按用户的令牌桶限流
+
+每收到一帧，在解析 JSON 之前按帧的条数和字节数各扣一次令牌：
+    连接级  每个连接自己的桶（消息 / 秒、字节 / 秒）
+    用户级  按规范化用户名的桶，join 之后才生效；同一用户断开重连不会重置，
+            闲置的用户桶按 LRU 淘汰（淘汰一个已经回满的桶不影响结果）；
+            多路复用连接上的用户（core/mux.py）在解析出 "ch" 之后由 check_user() 另扣
+任何一个桶不够时这一帧被丢弃，并且每秒最多回一次错误。
+每次超限还会扣一个"违规"桶（strikes 个令牌，每秒恢复 strike_rate 个），
+持续超限到违规桶也扣空时断开连接。
+文件上传的数据帧另有一个按连接的字节桶，不丢帧：服务端按它推迟给下一个窗口的 file_ack，
+不等 file_ack 超出窗口的数据帧才走上面的普通限流。
+速率为 0 的限制不生效。
+"""
+import time
+from collections import OrderedDict
+
+from core.presence import fold_name
+
+ALLOW = 'allow'
+DROP = 'drop'  # drop the frame silently
+REPLY = 'reply'  # drop the frame and tell the client, at most once per second
+DISCONNECT = 'disconnect'
+
+
+def parse_limit(text):
+    """'RATE' 或 'RATE/BURST' -> (rate, burst)；默认突发为两秒的量"""
+    rate, _, burst = str(text).partition('/')
+    rate = float(rate)
+    return rate, float(burst) if burst else rate * 2
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, amount, now):
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.updated = now
+        if tokens < amount:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - amount
+        return True
+
+    def charge(self, amount, now):
+        # always taken, possibly into debt; returns the seconds until the debt is paid off
+        self.take(0, now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class _Buckets:
+    # message and byte buckets of one connection or one user
+    __slots__ = ('messages', 'bytes')
+
+    def __init__(self, limits, now):
+        message_limit, byte_limit = limits
+        self.messages = TokenBucket(*message_limit, now) if message_limit[0] > 0 else None
+        self.bytes = TokenBucket(*byte_limit, now) if byte_limit[0] > 0 else None
+
+    def take(self, size, now):
+        # both are charged only when both have room
+        messages = self.messages
+        if messages is not None and not messages.take(1, now):
+            return False
+        if self.bytes is not None and not self.bytes.take(size, now):
+            if messages is not None:
+                messages.tokens += 1
+            return False
+        return True
+
+
+class ConnectionLimits:
+    """一个连接的限流状态，挂在 Session.limits 上"""
+    __slots__ = ('buckets', 'user', 'strikes', 'last_reply', 'files')
+
+    def __init__(self, buckets, strikes, files=None):
+        self.buckets = buckets
+        self.user = None  # the user's _Buckets once joined
+        self.strikes = strikes
+        self.last_reply = 0.0
+        self.files = files  # file upload bytes, paced rather than dropped
+
+
+class RateLimiter:
+    def __init__(self, message_limit=(20, 40), byte_limit=(64 * 1024, 256 * 1024),
+                 user_message_limit=(0, 0), user_byte_limit=(0, 0), strikes=50, strike_rate=1.0,
+                 max_users=100000, file_byte_limit=(0, 0)):
+        # each limit is (rate per second, burst)
+        self.connection_limits = (message_limit, byte_limit)
+        self.file_limit = file_byte_limit
+        self.user_limits = (user_message_limit, user_byte_limit)
+        self.per_user = user_message_limit[0] > 0 or user_byte_limit[0] > 0
+        self.strikes = strikes
+        self.strike_rate = strike_rate
+        self.max_users = max_users
+        self.users = OrderedDict()  # {folded username: _Buckets}, least recently joined first
+        self.dropped = 0
+        self.disconnects = 0
+
+    def connect(self):
+        now = time.monotonic()
+        files = TokenBucket(*self.file_limit, now) if self.file_limit[0] > 0 else None
+        return ConnectionLimits(_Buckets(self.connection_limits, now),
+                                TokenBucket(self.strike_rate, self.strikes, now), files)
+
+    def file_delay(self, limits, size):
+        """上传收到 size 字节之后，下一个 file_ack 要推迟的秒数"""
+        if limits.files is None:
+            return 0.0
+        return limits.files.charge(size, time.monotonic())
+
+    def share(self, limits):
+        # a channel's limits: the physical connection's buckets, its own user
+        return ConnectionLimits(limits.buckets, limits.strikes, limits.files)
+
+    def widen(self, limits, connections):
+        # a connection multiplexing several users gets what that many connections would
+        for bucket, (rate, burst) in zip((limits.buckets.messages, limits.buckets.bytes), self.connection_limits):
+            if bucket is not None:
+                bucket.rate = rate * connections
+                bucket.burst = burst * connections
+
+    def _user(self, username, now):
+        key = fold_name(username)
+        buckets = self.users.get(key)
+        if buckets is None:
+            if len(self.users) >= self.max_users:
+                self.users.popitem(last=False)
+            buckets = self.users[key] = _Buckets(self.user_limits, now)
+        else:
+            self.users.move_to_end(key)
+        return buckets
+
+    def check(self, limits, size, username=None):
+        """一帧 size 字节进来时调用，返回 ALLOW / DROP / REPLY / DISCONNECT"""
+        now = time.monotonic()
+        if limits.buckets.take(size, now) and self._take_user(limits, size, username, now):
+            return ALLOW
+        return self._refuse(limits, now)
+
+    def check_user(self, limits, size, username):
+        """多路复用连接上发给某个 channel 的一帧：连接级已经在 check() 扣过，这里只扣这个用户的桶"""
+        if not self.per_user:
+            return ALLOW
+        now = time.monotonic()
+        if self._take_user(limits, size, username, now):
+            return ALLOW
+        return self._refuse(limits, now)
+
+    def _take_user(self, limits, size, username, now):
+        user = limits.user
+        if user is None and username is not None and self.per_user:
+            user = limits.user = self._user(username, now)
+        return user is None or user.take(size, now)
+
+    def _refuse(self, limits, now):
+        self.dropped += 1
+        if not limits.strikes.take(1, now):
+            self.disconnects += 1
+            return DISCONNECT
+        if now - limits.last_reply >= 1.0:
+            limits.last_reply = now
+            return REPLY
+        return DROP
@@ -0,0 +1,232 @@
+"""
+优雅下线和热重启
+
+server.py 收到 SIGTERM / SIGINT 时 ChatServer.stop()：停止 accept，给每个连接发 reconnect 通知，
+并发关闭（最多等 --drain-timeout 秒），然后关闭日志等。
+
+收到 SIGHUP 时 hot_restart() 把监听 socket 和状态交给一个新进程，端口始终在监听：
+    1. 在私有临时目录的 Unix socket 上等新进程，用原来的命令行加 --takeover <该 socket> 启动它
+    2. 新进程导入、解析完参数后连上来报 ready；起不来或超时就杀掉它，这个进程照常服务
+    3. 复制监听 socket 的 fd，然后 close(restart=True)：停止 accept（新连接在内核的 backlog 里等着）、
+       通知客户端重连（close code 1012）、并发关闭连接、关闭消息日志（写出当前段的 .idx）
+    4. 快照写进同一个目录，监听 socket 用 SCM_RIGHTS 和快照路径一起发给新进程
+    5. 新进程（Takeover）载入日志、装回快照、在收到的 socket 上开始 accept，回报 serving，这个进程退出
+客户端连不上的时间只有 3-5 步，backlog 里的连接只是晚一点被 accept，不会被拒绝；
+续连令牌、epoch 和各房间的 seq 都在快照里，客户端 resume 后从断点补发，房间里也看不到一轮离开 / 加入；
+--file-dir 里的文件原地保留，元数据和上传进度也在快照里，上传重连后接着传。
+
+快照文件：magic 一行，接着是 zlib 压缩的 JSON（ChatServer.snapshot()）。
+"""
+import asyncio
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+from core.log import get_logger
+
+log = get_logger('restart')
+
+_MAGIC = b'chatroom-snapshot 1\n'
+_MAX_SOCKETS = 16
+# restarts started from the signal handler, the loop only keeps weak references to tasks
+_tasks = set()
+
+
+def write_snapshot(path, state):
+    # written aside and renamed, returns the file size
+    raw = zlib.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'), 1)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(_MAGIC)
+        f.write(raw)
+    os.replace(path + '.tmp', path)
+    return len(_MAGIC) + len(raw)
+
+
+def read_snapshot(path):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if not raw.startswith(_MAGIC):
+        raise ValueError(f"{path} is not a chat server snapshot")
+    return json.loads(zlib.decompress(raw[len(_MAGIC):]))
+
+
+def install_signal_handlers(server, argv=None):
+    """SIGTERM / SIGINT 优雅下线；给了 argv（新进程的命令行，不含解释器）时 SIGHUP 热重启"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, server.stop)
+    if argv is not None:
+        loop.add_signal_handler(signal.SIGHUP, _start_restart, server, argv)
+
+
+def _start_restart(server, argv):
+    task = asyncio.create_task(_restart(server, argv))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def _restart(server, argv):
+    # one takeover at a time: a second SIGHUP while the first is under way is ignored
+    if server.draining or server.restarting:
+        log.info("hot restart already under way, SIGHUP ignored")
+        return
+    server.restarting = True
+    try:
+        handed_over = await hot_restart(server, argv)
+    except Exception as e:
+        server.restarting = False
+        log.error("hot restart failed (%s), this server keeps serving", e)
+        return
+    if handed_over:
+        server.stop()
+    else:
+        server.restarting = False
+
+
+def _without_takeover(argv):
+    # this process may have been started by a takeover itself
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--takeover':
+            skip = True
+        elif not arg.startswith('--takeover='):
+            result.append(arg)
+    return result
+
+
+async def _read_line(loop, connection, timeout):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = await asyncio.wait_for(loop.sock_recv(connection, 256), timeout)
+        if not chunk:
+            raise ConnectionError("the other process went away")
+        data += chunk
+    return data.decode().strip()
+
+
+async def _accept(loop, listener, process, timeout):
+    # the new process' connection; fails early when it exits instead (bad arguments, a broken update)
+    accept = asyncio.ensure_future(loop.sock_accept(listener))
+    deadline = loop.time() + timeout
+    while not accept.done():
+        if process.poll() is not None or loop.time() > deadline:
+            accept.cancel()
+            raise ConnectionError(f"exit status {process.returncode}" if process.returncode is not None
+                                  else "timeout")
+        await asyncio.wait([accept], timeout=0.1)
+    return accept.result()
+
+
+async def _readable(loop, connection, timeout):
+    # recv_fds() has no asyncio counterpart: wait until it will not block
+    future = loop.create_future()
+    loop.add_reader(connection.fileno(), lambda: future.done() or future.set_result(None))
+    try:
+        await asyncio.wait_for(future, timeout)
+    finally:
+        loop.remove_reader(connection.fileno())
+
+
+async def hot_restart(server, argv, timeout=30.0):
+    """启动新进程并把监听 socket 和状态交给它。交出去了返回 True（这个进程已关闭，该退出了）；
+    新进程没起来返回 False，这个进程继续服务"""
+    loop = asyncio.get_running_loop()
+    directory = tempfile.mkdtemp(prefix='chatroom-restart-')
+    path = os.path.join(directory, 'handover.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection = None
+    try:
+        listener.bind(path)
+        listener.listen(1)
+        listener.setblocking(False)
+        started = time.monotonic()
+        process = subprocess.Popen([sys.executable, *_without_takeover(argv), '--takeover', path])
+        try:
+            connection, _ = await _accept(loop, listener, process, timeout)
+            if await _read_line(loop, connection, timeout) != 'ready':
+                raise ConnectionError("unexpected handshake")
+        except (OSError, asyncio.TimeoutError) as e:
+            log.error("hot restart: the new server did not come up (%s), this one keeps serving", e or 'timeout')
+            process.kill()
+            process.wait()
+            return False
+        log.info("hot restart: new server %d is ready after %.0f ms, handing over", process.pid,
+                 (time.monotonic() - started) * 1000)
+
+        # duplicates keep the sockets listening while close() closes ours
+        fds = [os.dup(sock.fileno()) for sock in server.listening_sockets()]
+        stopped = time.monotonic()
+        await server.close(restart=True)
+        snapshot = os.path.join(directory, 'state.snapshot')
+        size = write_snapshot(snapshot, server.snapshot())
+        try:
+            socket.send_fds(connection, [snapshot.encode()], fds)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        try:
+            reply = await _read_line(loop, connection, timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.error("hot restart: no answer from the new server %d (%s)", process.pid, e or 'timeout')
+            return True
+        log.info("hot restart: %s; not accepting for %.0f ms, snapshot %d bytes", reply,
+                 (time.monotonic() - stopped) * 1000, size)
+        return True
+    finally:
+        if connection is not None:
+            connection.close()
+        listener.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class Takeover:
+    """新进程这边：连上旧进程报 ready，等它下线后交来的监听 socket 和快照
+
+        takeover = await Takeover.connect(path)
+        sockets, state = await takeover.receive()
+        ...  # 载入日志、server.restore(state)，然后在 sockets 上 start()
+        await takeover.confirm(server)
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @classmethod
+    async def connect(cls, path):
+        loop = asyncio.get_running_loop()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.setblocking(False)
+        await loop.sock_connect(connection, path)
+        await loop.sock_sendall(connection, b'ready\n')
+        return cls(connection)
+
+    async def receive(self, timeout=60.0):
+        # the old server drains its clients meanwhile
+        await _readable(asyncio.get_running_loop(), self.connection, timeout)
+        message, fds, _, _ = socket.recv_fds(self.connection, 4096, _MAX_SOCKETS)
+        if not fds:
+            raise ConnectionError("the old server went away without handing over its sockets")
+        sockets = [socket.socket(fileno=fd) for fd in fds]
+        for sock in sockets:
+            sock.setblocking(False)
+        return sockets, read_snapshot(message.decode())
+
+    async def confirm(self, server):
+        # after start() began accepting: the old process logs it and exits
+        await server.ready.wait()
+        try:
+            await asyncio.get_running_loop().sock_sendall(
+                self.connection, f"new server ready, startup {server.startup_seconds * 1000:.0f} ms\n".encode())
+        except OSError:
+            pass
+        self.connection.close()
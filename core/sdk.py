@@ -0,0 +1,396 @@
+"""
+无界面的异步客户端 SDK（机器人、桥接）
+
+和 ChatClient 不同：不读 stdin、不打印，收到的消息是 Event 对象，用 async for 取。
+一个 ChatSDK 在一条或几条连接上承载任意多个用户（多路复用，服务端见 core/mux.py）：
+每个用户是连接上的一个 channel，发出的帧带 "ch"；服务端只发给某个用户的帧（错误、ack、历史回放、私信）
+同样带 "ch"，房间广播每条连接只收一份，由 SDK 分发给这条连接上在该房间的每个用户。
+请求是流水线式的：每个请求带一个 ref 立即发出，不等前一个的回复；服务端处理完回 ack
+（被拒绝时回带 ref 的 error），请求的 future 在那时完成。背压：
+    每条连接一个有界发送队列（queue_size），满了 post() 等待
+    每条连接最多 max_in_flight 个没有回复的请求，到了上限 post() 等待
+    收到的事件进有界队列（event_queue_size），消费不过来时停止读取，由 TCP 和服务端的发送队列承担积压
+    （ack 也由这个读取任务处理：事件队列满着时 ack 同样停住，等 ack 的代码要有别的任务在消费事件）
+连接断开后按指数退避重连，每个用户发 resume 从各房间最后看到的 seq 补发；断开时还没回复的请求以 SDKError 失败。
+服务端下线前发的 reconnect 通知（也作为 Event 交给调用方）决定第一次重连的时机，带 url 时改连那里。
+
+    sdk = ChatSDK('localhost', 12345, connections=2)
+    await sdk.connect()
+    bots = [await sdk.join(f"bot{i}", room='lobby') for i in range(200)]
+    ack = await bots[0].send("hello")                     # 等服务端确认，ack['seq']
+    pending = [await bot.post("hi") for bot in bots]      # 流水线：先全部发出
+    await asyncio.gather(*pending)                        # 再等确认
+    async for event in sdk:
+        if event.type == MESSAGE and event.user is bots[1]:
+            ...
+    await sdk.close()
+"""
+import asyncio
+import functools
+import itertools
+import random
+
+import websockets
+
+from core.codec import CODECS, JSON, JSON_CODEC, decode_message
+from core.files import CHUNK_PREFIX
+from core.log import get_logger
+from core.message_types import (ACK, BATCH, DEFAULT_ROOM, DM, ERROR, JOIN, JOIN_ROOM, LEAVE, LEAVE_ROOM,
+                                MESSAGE, PING, PONG, RECONNECT, RESUME, SWITCH_ROOM)
+
+log = get_logger('sdk')
+
+_PONG = {'type': PONG}
+
+
+class SDKError(Exception):
+    """服务端拒绝了请求（带 ref 的 error），或者连接在回复之前断开"""
+
+
+class Event:
+    """收到的一条消息：收到它的本地用户 user（连接级的帧为 None）、type、room 和解码后的全部字段 data"""
+    __slots__ = ('type', 'user', 'room', 'data')
+
+    def __init__(self, user, data):
+        self.type = data.get('type')
+        self.user = user
+        self.room = data.get('room')
+        self.data = data
+
+    @property
+    def username(self):
+        return self.data.get('username')
+
+    @property
+    def content(self):
+        return self.data.get('content')
+
+    @property
+    def seq(self):
+        return self.data.get('seq')
+
+    @property
+    def timestamp(self):
+        return self.data.get('timestamp')
+
+    def __repr__(self):
+        user = self.user.username if self.user is not None else None
+        return f"<Event {self.type} for {user} in {self.room}: {self.data!r}>"
+
+
+class User:
+    """连接上的一个身份。post() 把请求放进发送队列并返回 future，send() 等等方法直接等到 ack"""
+    __slots__ = ('username', 'channel', 'connection', 'room', 'rooms', 'epoch', 'token', 'auth')
+
+    def __init__(self, username, channel, connection, room, auth=None):
+        self.username = username
+        self.channel = channel
+        self.connection = connection
+        self.room = room  # current room, messages that do not name one go here
+        self.rooms = {room: 0}  # {room: last seq seen}, untagged room frames are routed by it
+        self.epoch = None
+        self.token = None  # resume token
+        self.auth = auth
+
+    def __repr__(self):
+        return f"<User {self.username} ch={self.channel}>"
+
+    async def request(self, data):
+        """发送任意请求（会被加上 ch 和 ref），返回在服务端回复时完成的 future"""
+        data['ch'] = self.channel
+        return await self.connection.request(data)
+
+    async def post(self, content, room=None):
+        # pipelined: returns once queued, the future holds the ack (room, seq)
+        return await self.request({'type': MESSAGE, 'room': room or self.room, 'content': content})
+
+    async def send(self, content, room=None):
+        return await (await self.post(content, room))
+
+    async def dm(self, to, content):
+        return await (await self.request({'type': DM, 'to': to, 'content': content}))
+
+    async def join_room(self, room):
+        await self._change_room(JOIN_ROOM, room, {**self.rooms, room: self.rooms.get(room, 0)}, room)
+
+    async def switch_room(self, room):
+        rooms = {name: seq for name, seq in self.rooms.items() if name != self.room}
+        rooms[room] = self.rooms.get(room, 0)
+        await self._change_room(SWITCH_ROOM, room, rooms, room)
+
+    async def leave_room(self, room):
+        rooms = {name: seq for name, seq in self.rooms.items() if name != room}
+        await self._change_room(LEAVE_ROOM, room, rooms, self.room if self.room != room else next(iter(rooms), None))
+
+    async def _change_room(self, message_type, room, rooms, current):
+        # routed to the new rooms right away, the server's replay and broadcasts are deduplicated by seq
+        previous = self.rooms, self.room
+        self.rooms, self.room = rooms, current
+        try:
+            await (await self.request({'type': message_type, 'room': room}))
+        except SDKError:
+            self.rooms, self.room = previous
+            raise
+
+    async def leave(self):
+        # the user goes, the connection and its other users stay
+        try:
+            await (await self.request({'type': LEAVE}))
+        finally:
+            self.connection.users.pop(self.channel, None)
+
+
+class _Connection:
+    def __init__(self, sdk):
+        self.sdk = sdk
+        self.websocket = None
+        self.codec = JSON_CODEC  # the preferred codec once the server answers in it
+        self.users = {}  # {channel: User}
+        self.pending = {}  # {ref: future}, requests waiting for their ack / error
+        self._refs = itertools.count(1)
+        self._channels = itertools.count(1)
+        self.outbox = asyncio.Queue(sdk.queue_size)
+        self.window = asyncio.Semaphore(sdk.max_in_flight)
+        self.online = asyncio.Event()
+        self.tasks = ()
+        self.frames = 0  # received
+        self.reconnect_hint = None  # seconds to spread the next reconnect over, from a reconnect notice
+
+    async def open(self):
+        self.websocket = await websockets.connect(self.sdk.uri, compression='deflate' if self.sdk.compression else None)
+        self.online.set()
+        self.tasks = (asyncio.create_task(self._write()), asyncio.create_task(self._run()))
+
+    async def request(self, data):
+        await self.window.acquire()
+        ref = data['ref'] = next(self._refs)
+        future = self.pending[ref] = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda _: self.window.release())
+        await self.outbox.put(data)
+        return future
+
+    async def _write(self):
+        while True:
+            data = await self.outbox.get()
+            await self.online.wait()
+            if data['ref'] not in self.pending:
+                # failed when the connection it was queued for dropped
+                continue
+            try:
+                await self.websocket.send(self.codec.encode(data))
+            except websockets.ConnectionClosed:
+                # _run() fails everything pending and reconnects
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                async for raw in self.websocket:
+                    await self._receive(raw)
+            except websockets.ConnectionClosed:
+                pass
+            self.online.clear()
+            self._fail_pending(SDKError("connection lost"))
+            if self.sdk.closing or not self.sdk.reconnect or not await self._reconnect():
+                await self.sdk._connection_closed(self)
+                return
+
+    def _fail_pending(self, error):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def _reconnect(self):
+        delay = self.sdk.reconnect_delay
+        hint, self.reconnect_hint = self.reconnect_hint, None
+        while not self.sdk.closing:
+            # jitter keeps the connections of many bots from coming back in lockstep
+            await asyncio.sleep(random.uniform(0, hint) if hint is not None else delay * random.uniform(0.5, 1.0))
+            hint = None
+            try:
+                self.websocket = await websockets.connect(
+                    self.sdk.uri, compression='deflate' if self.sdk.compression else None)
+            except (OSError, websockets.WebSocketException) as e:
+                log.debug("reconnect failed: %s", e)
+                delay = min(delay * 2, self.sdk.reconnect_max_delay)
+                continue
+            self.codec = JSON_CODEC
+            await self._resume_all()
+            return True
+        return False
+
+    async def _resume_all(self):
+        # sent ahead of anything queued meanwhile, then the writer goes on;
+        # the answers come through this connection's reader, so they are not awaited here
+        for user in list(self.users.values()):
+            ref = next(self._refs)
+            future = self.pending[ref] = asyncio.get_running_loop().create_future()
+            future.add_done_callback(functools.partial(self._resumed, user))
+            request = {'type': RESUME, 'ch': user.channel, 'ref': ref, 'username': user.username,
+                       'room': user.room, 'rooms': dict(user.rooms), 'epoch': user.epoch, 'token': user.token,
+                       'codecs': [self.sdk.codec]}
+            if user.auth is not None:
+                request['auth'] = user.auth
+            await self.websocket.send(JSON_CODEC.encode(request))
+        self.online.set()
+
+    def _resumed(self, user, future):
+        if future.cancelled() or future.exception() is not None:
+            log.warning("%s could not resume: %s", user.username, None if future.cancelled() else future.exception())
+            self.users.pop(user.channel, None)
+
+    async def _receive(self, raw):
+        self.frames += 1
+        if raw[:1] == CHUNK_PREFIX:
+            # file data, not supported here
+            return
+        try:
+            data = decode_message(raw)
+        except ValueError:
+            log.debug("undecodable frame: %r", raw[:64])
+            return
+        if not isinstance(raw, str):
+            self.codec = CODECS[self.sdk.codec]
+        message_type = data.get('type')
+        ref = data.get('ref')
+        if message_type == ACK or (message_type == ERROR and ref is not None):
+            future = self.pending.pop(ref, None)
+            if future is not None and not future.done():
+                if message_type == ACK:
+                    future.set_result(data)
+                else:
+                    future.set_exception(SDKError(data.get('message')))
+            return
+        if message_type == PING:
+            await self.websocket.send(self.codec.encode(_PONG))
+            return
+        if message_type == RECONNECT:
+            # the server is going away, _run() reconnects once it has closed the connection
+            self.reconnect_hint = data.get('spread', 0) / 1000
+            if data.get('url'):
+                self.sdk.uri = data['url']
+        channel = data.pop('ch', None)
+        if channel is not None:
+            user = self.users.get(channel)
+            if user is not None:
+                await self._deliver(user, data)
+        elif message_type == BATCH:
+            for item in data.get('messages', ()):
+                await self._broadcast(item)
+        else:
+            await self._broadcast(data)
+
+    async def _broadcast(self, data):
+        # one copy per connection: every user here that is in the room gets it
+        room = data.get('room')
+        if room is None:
+            await self.sdk.events.put(Event(None, data))
+            return
+        for user in list(self.users.values()):
+            if room in user.rooms:
+                await self._deliver(user, data)
+
+    async def _deliver(self, user, data):
+        if data.get('type') == RESUME:
+            # after a join or resume: the epoch, a new resume token and where each room's replay starts
+            if data.get('epoch') != user.epoch:
+                user.epoch = data.get('epoch')
+                user.rooms = dict.fromkeys(user.rooms, 0)
+            user.token = data.get('token')
+            user.rooms.update(data.get('rooms') or {})
+        else:
+            seq = data.get('seq')
+            if seq is not None:
+                room = data.get('room')
+                if seq <= user.rooms.get(room, 0):
+                    # replayed and broadcast, or seen before a reconnect
+                    return
+                user.rooms[room] = seq
+        await self.sdk.events.put(Event(user, data))
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self._fail_pending(SDKError("closed"))
+        if self.websocket is not None:
+            await self.websocket.close()
+
+
+class ChatSDK:
+    def __init__(self, host='localhost', port=12345, connections=1, codec=JSON, compression=False,
+                 queue_size=256, max_in_flight=64, event_queue_size=10000, reconnect=True,
+                 reconnect_delay=0.5, reconnect_max_delay=30.0):
+        self.uri = f"ws://{host}:{port}"
+        self.pool_size = connections
+        self.codec = codec  # offered on join, all users of a connection should use the same one
+        self.compression = compression
+        self.queue_size = queue_size
+        self.max_in_flight = max_in_flight
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.connections = []
+        self.events = asyncio.Queue(event_queue_size)
+        self.closing = False
+
+    async def connect(self):
+        for _ in range(self.pool_size):
+            connection = _Connection(self)
+            await connection.open()
+            self.connections.append(connection)
+
+    async def join(self, username, room=DEFAULT_ROOM, auth=None, history=0):
+        """在用户最少的连接上加入一个用户，服务端确认（历史回放之后）时返回 User；被拒绝时抛 SDKError"""
+        if not self.connections:
+            raise SDKError("not connected")
+        connection = min(self.connections, key=lambda c: len(c.users))
+        user = User(username, next(connection._channels), connection, room, auth)
+        connection.users[user.channel] = user
+        request = {'type': JOIN, 'username': username, 'room': room, 'history': history,
+                   'codecs': [self.codec]}
+        if auth is not None:
+            request['auth'] = auth
+        try:
+            await (await user.request(request))
+        except SDKError:
+            connection.users.pop(user.channel, None)
+            raise
+        return user
+
+    @property
+    def users(self):
+        return [user for connection in self.connections for user in connection.users.values()]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.events.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def _connection_closed(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+        if not self.connections:
+            # ends the async for
+            await self.events.put(None)
+
+    async def close(self):
+        self.closing = True
+        for connection in self.connections:
+            await connection.close()
+        self.connections = []
+        try:
+            self.events.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,433 @@
+"""
+聊天历史的全文搜索（倒排索引）
+
+索引的是持久化日志（core/message_log.py）里的每条房间消息，文档号就是日志的 cursor：
+    内容（聊天消息的 content、文件的 name）切成小写的词，连续的中日韩文字切成相邻两字（bigram）
+    "@用户名" 和 "#房间" 也是词项，按用户、房间过滤就是多求一个交集
+写入：persist() 只把消息放进待索引列表，切词在这一轮事件循环结束后（call_soon）统一做，广播不等它。
+词项追加到内存段（memtable）；满 segment_docs 条后冻结，在线程池里转成紧凑段：
+排好序的词项列表 + 一个首尾相接的 array('I') 倒排表（相同词项的 cursor 连续存放）。
+紧凑段分层合并：merge_factor 个同一层的相邻段合成一个，同样在线程池里做，完成后在事件循环里替换，
+查询总是看到一份完整、不重叠的段列表。启动时在线程池里从日志重建已有消息的索引，
+建好一段放进去一段，重建完成之前搜索只覆盖已经建好的部分。
+
+查询从新到旧：每个段先按时间范围二分出 cursor 区间，再对各词项的倒排表求交
+（最短的表从新到旧分块，和长得多的表相交时逐个二分，否则用集合求交），
+凑够 limit 条或者用完 scan_budget 就停，返回下一页的 before。所以一次查询的耗时有上限：
+两个很少同时出现的高频词可能返回不满一页、但带 next 的结果，继续翻页即可。
+"""
+import asyncio
+import heapq
+import json
+import re
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+from core.log import get_logger
+from core.presence import fold_name
+
+log = get_logger('search')
+
+_WORD = re.compile(r'[^\W_]{1,64}')  # longer words are cut into pieces, in messages and queries alike
+_CJK = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')  # kana, hanzi, hangul
+MAX_QUERY_TERMS = 16
+
+
+def tokenize(text):
+    """小写词项列表（可能重复）；中日韩文字切成 bigram，单独一个字时就是这个字"""
+    text = text.lower()
+    if _CJK.search(text) is None:
+        return _WORD.findall(text)
+    tokens = []
+    for word in _WORD.findall(text):
+        if _CJK.search(word) is None:
+            tokens.append(word)
+            continue
+        position = 0
+        for run in _CJK.finditer(word):
+            if run.start() > position:
+                tokens.append(word[position:run.start()])
+            chars = run.group()
+            if len(chars) == 1:
+                tokens.append(chars)
+            else:
+                tokens.extend(chars[i:i + 2] for i in range(len(chars) - 1))
+            position = run.end()
+        if position < len(word):
+            tokens.append(word[position:])
+    return tokens
+
+
+def user_term(username):
+    return '@' + fold_name(username)
+
+
+def room_term(room):
+    return '#' + room
+
+
+def message_terms(data, room):
+    # everything a stored room message can be found by
+    text = data.get('content')
+    if not isinstance(text, str):
+        # a shared file is found by its name
+        text = data.get('name')
+    terms = set(tokenize(text)) if isinstance(text, str) else set()
+    username = data.get('username')
+    if isinstance(username, str):
+        terms.add(user_term(username))
+    terms.add(room_term(room))
+    return terms
+
+
+def _contains(postings, cursor):
+    i = bisect_left(postings, cursor)
+    return i < len(postings) and postings[i] == cursor
+
+
+class _Memtable:
+    # the segment being written, postings appended in cursor order
+    __slots__ = ('base', 'timestamps', 'rooms', 'postings')
+
+    def __init__(self, base):
+        self.base = base  # cursor of the first document, the rest follow without gaps
+        self.timestamps = array('q')  # ms, never decreasing
+        self.rooms = array('I')  # room ids, see SearchIndex.room_names
+        self.postings = {}  # {term: array('I') of cursors}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def add(self, timestamp, room_id, terms):
+        cursor = self.base + len(self.timestamps)
+        self.timestamps.append(timestamp)
+        self.rooms.append(room_id)
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array('I')
+            postings.append(cursor)
+
+    def lookup(self, term):
+        return self.postings.get(term)
+
+    def compact(self):
+        # in a worker thread, the memtable is frozen by then
+        terms = sorted(self.postings)
+        starts = array('Q', [0])
+        postings = array('I')
+        for term in terms:
+            postings.extend(self.postings[term])
+            starts.append(len(postings))
+        return _Segment(self.base, self.timestamps, self.rooms, terms, starts, postings)
+
+
+class _Segment:
+    # immutable: sorted terms, the postings of term i are postings[starts[i]:starts[i + 1]]
+    __slots__ = ('base', 'timestamps', 'rooms', 'terms', 'starts', 'postings', '_view')
+
+    def __init__(self, base, timestamps, rooms, terms, starts, postings):
+        self.base = base
+        self.timestamps = timestamps
+        self.rooms = rooms
+        self.terms = terms
+        self.starts = starts
+        self.postings = postings
+        self._view = memoryview(postings)  # slices without copying
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def lookup(self, term):
+        i = bisect_left(self.terms, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            return None
+        return self._view[self.starts[i]:self.starts[i + 1]]
+
+
+def _merge(segments):
+    # adjacent segments, oldest first, into one; a term's postings stay in cursor order by concatenation
+    timestamps = array('q')
+    rooms = array('I')
+    for segment in segments:
+        timestamps.extend(segment.timestamps)
+        rooms.extend(segment.rooms)
+    terms = []
+    starts = array('Q', [0])
+    postings = array('I')
+    positions = [0] * len(segments)
+    for term in heapq.merge(*(segment.terms for segment in segments)):
+        if terms and terms[-1] == term:
+            continue
+        for j, segment in enumerate(segments):
+            i = positions[j]
+            if i < len(segment.terms) and segment.terms[i] == term:
+                postings.frombytes(segment._view[segment.starts[i]:segment.starts[i + 1]].cast('B'))
+                positions[j] = i + 1
+        terms.append(term)
+        starts.append(len(postings))
+    return _Segment(segments[0].base, timestamps, rooms, terms, starts, postings)
+
+
+class SearchIndex:
+    def __init__(self, message_log, segment_docs=65536, merge_factor=4, scan_budget=100000):
+        self.log = message_log
+        self.segment_docs = segment_docs
+        self.merge_factor = merge_factor
+        # postings looked at per query before it returns what it has with a next cursor
+        self.scan_budget = scan_budget
+        self.room_names = []
+        self._room_ids = {}  # {room: id}, also filled in by the rebuild thread
+        self._rooms_lock = threading.Lock()
+        # frozen memtables and compact segments, ordered by base, covering cursors without gaps
+        self.segments = []
+        # what was logged before this process started is indexed by the rebuild
+        self.start_cursor = message_log.next_cursor
+        self.memtable = _Memtable(self.start_cursor)
+        self.rebuilt = self.start_cursor == 1
+        self._last_timestamp = 0
+        self._pending = []  # (cursor, ms, room, message data) logged this loop round
+        self._scheduled = False
+        self._wakeup = None
+        self._worker = None
+        self._closed = False  # tells a rebuild still running in its thread to stop
+        self.queries = 0
+        self.compactions = 0
+
+    def _room_id(self, room):
+        room_id = self._room_ids.get(room)
+        if room_id is None:
+            with self._rooms_lock:
+                room_id = self._room_ids.get(room)
+                if room_id is None:
+                    room_id = self._room_ids[room] = len(self.room_names)
+                    self.room_names.append(room)
+        return room_id
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.create_task(self._compact_loop())
+
+    def add(self, cursor, timestamp, room, data):
+        """日志刚写入的一条房间消息；切词推迟到这一轮事件循环的末尾"""
+        self._pending.append((cursor, timestamp, room, data))
+        if not self._scheduled:
+            try:
+                asyncio.get_running_loop().call_soon(self._drain)
+            except RuntimeError:
+                # no loop to defer to
+                self._drain()
+                return
+            self._scheduled = True
+
+    def _drain(self):
+        self._scheduled = False
+        pending, self._pending = self._pending, []
+        for cursor, timestamp, room, data in pending:
+            if cursor < self.memtable.base + len(self.memtable):
+                continue
+            # sorted, so a time range is a cursor range; the wall clock may step back
+            if timestamp < self._last_timestamp:
+                timestamp = self._last_timestamp
+            self._last_timestamp = timestamp
+            room_id = self._room_id(room)
+            while self.memtable.base + len(self.memtable) < cursor:
+                # logged without being indexed, nothing will point at it
+                self.memtable.add(timestamp, room_id, ())
+            self.memtable.add(timestamp, room_id, message_terms(data, room))
+            if len(self.memtable) >= self.segment_docs:
+                self._freeze()
+
+    def _freeze(self):
+        # queried as it is until the worker has compacted it
+        self.segments.append(self.memtable)
+        self.memtable = _Memtable(self.memtable.base + len(self.memtable))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _tier(self, count):
+        tier = 0
+        size = self.segment_docs
+        while count > size:
+            size *= self.merge_factor
+            tier += 1
+        return tier
+
+    def _next_job(self):
+        # (start, stop) of the segments to compact or merge next, None when there is nothing to do
+        for i, segment in enumerate(self.segments):
+            if isinstance(segment, _Memtable):
+                return i, i + 1
+        # the oldest run of merge_factor adjacent segments of one tier, sizes grow like a counter
+        for start in range(len(self.segments) - self.merge_factor + 1):
+            run = self.segments[start:start + self.merge_factor]
+            if len({self._tier(len(segment)) for segment in run}) == 1:
+                return start, start + self.merge_factor
+        return None
+
+    async def _compact_loop(self):
+        loop = asyncio.get_running_loop()
+        if not self.rebuilt:
+            started = loop.time()
+            await loop.run_in_executor(None, self._rebuild, loop)
+            self.rebuilt = True
+            log.info("search index rebuilt from the log: %d messages in %.1fs",
+                     self.start_cursor - 1, loop.time() - started)
+        while True:
+            job = self._next_job()
+            if job is None:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            start, stop = job
+            old = self.segments[start:stop]
+            if len(old) == 1:
+                new = await loop.run_in_executor(None, old[0].compact)
+            else:
+                new = await loop.run_in_executor(None, _merge, old)
+            # only appended to meanwhile, the old ones are where they were
+            self.segments[start:stop] = [new]
+            self.compactions += 1
+
+    def _rebuild(self, loop):
+        # in a worker thread: everything logged before start_cursor, handed over one segment at a time
+        memtable = None
+        last_timestamp = 0
+        for cursor, timestamp, room, text in self.log.scan(self.start_cursor):
+            if self._closed:
+                return
+            try:
+                data = json.loads(text)
+            except ValueError:
+                data = {}
+            if not isinstance(data, dict):
+                data = {}
+            if memtable is None:
+                memtable = _Memtable(cursor)
+            timestamp = last_timestamp = max(timestamp, last_timestamp)
+            room_id = self._room_id(room)
+            while memtable.base + len(memtable) < cursor:
+                memtable.add(timestamp, room_id, ())
+            memtable.add(timestamp, room_id, message_terms(data, room))
+            if len(memtable) >= self.segment_docs:
+                loop.call_soon_threadsafe(self._install, memtable.compact())
+                memtable = None
+        if memtable is not None:
+            loop.call_soon_threadsafe(self._install, memtable.compact())
+
+    def _install(self, segment):
+        # a rebuilt segment, older than everything indexed live
+        i = bisect_right([part.base for part in self.segments], segment.base)
+        self.segments.insert(i, segment)
+
+    def _parts(self):
+        return self.segments + [self.memtable]
+
+    def search(self, terms, start=None, end=None, before=None, limit=20):
+        """匹配全部词项、start <= 时间 < end（毫秒）、cursor < before 的消息，从新到旧最多 limit 个 cursor；
+        返回 (cursors, 下一页的 before)，确定没有更多时后者为 None"""
+        if self._pending:
+            self._drain()
+        self.queries += 1
+        budget = self.scan_budget
+        found = []
+        upper = before if before is not None else 1 << 63
+        for part in reversed(self._parts()):
+            count = len(part)
+            if not count or part.base >= upper:
+                continue
+            if (end is not None and part.timestamps[0] >= end
+                    or start is not None and part.timestamps[-1] < start):
+                continue
+            low = part.base
+            high = min(upper, part.base + count)
+            if start is not None:
+                low = max(low, part.base + bisect_left(part.timestamps, start))
+            if end is not None:
+                high = min(high, part.base + bisect_left(part.timestamps, end))
+            if low >= high:
+                continue
+            lists = []
+            for term in terms:
+                postings = part.lookup(term)
+                if postings is None:
+                    break
+                postings = postings[bisect_left(postings, low):bisect_left(postings, high)]
+                if not len(postings):
+                    break
+                lists.append(postings)
+            else:
+                lists.sort(key=len)
+                shortest, others = lists[0], lists[1:]
+                position = len(shortest)
+                chunk = 256
+                while position > 0:
+                    need = limit - len(found)
+                    if not others:
+                        # one term: the newest postings are the answer
+                        hits = shortest[max(0, position - need):position].tolist()
+                        hits.reverse()
+                        found.extend(hits)
+                        position -= len(hits)
+                        budget -= len(hits)
+                    else:
+                        window = shortest[max(0, position - chunk):position]
+                        low_cursor = window[0]
+                        matches = set(window)
+                        budget -= len(window)
+                        for other in others:
+                            other = other[bisect_left(other, low_cursor):bisect_left(other, window[-1] + 1)]
+                            if len(other) > 8 * len(matches):
+                                # far longer: look each candidate up
+                                matches = {cursor for cursor in matches if _contains(other, cursor)}
+                                budget -= 4 * len(matches) + 1
+                            else:
+                                matches.intersection_update(other)
+                                budget -= len(other)
+                            if not matches:
+                                break
+                        found.extend(sorted(matches, reverse=True)[:need])
+                        position -= len(window)
+                        chunk = min(chunk * 2, 16384)
+                    if len(found) >= limit:
+                        return found, found[-1]
+                    if budget <= 0:
+                        # out of time: the next page goes on below what was looked at
+                        if position > 0:
+                            return found, shortest[position]
+                        return found, part.base if part.base > self._parts()[0].base else None
+        return found, None
+
+    def locate(self, cursor):
+        # (room, ms) of an indexed cursor
+        parts = self._parts()
+        part = parts[max(0, bisect_right([p.base for p in parts], cursor) - 1)]
+        i = cursor - part.base
+        return self.room_names[part.rooms[i]], part.timestamps[i]
+
+    def read(self, cursors):
+        """cursor 对应的消息（解码后的 dict），从日志读取"""
+        messages = []
+        for cursor in cursors:
+            room, _ = self.locate(cursor)
+            record = self.log.read_cursor(room, cursor)
+            if record is not None:
+                messages.append(json.loads(record[2]))
+        return messages
+
+    @property
+    def docs(self):
+        return sum(len(part) for part in self._parts())
+
+    def stats(self):
+        return {'docs': self.docs, 'segments': len(self.segments), 'pending': len(self._pending),
+                'queries': self.queries, 'compactions': self.compactions, 'rebuilt': self.rebuilt}
+
+    async def close(self):
+        self._closed = True
+        if self._worker is not None:
+            # a compaction already running in its thread only touches its own arrays
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
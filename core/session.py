@@ -0,0 +1,183 @@
+"""
+会话注册表
+
+每个连接对应一个 Session（__slots__，没有逐实例的 __dict__），连接状态只保存在这一处：
+    connection 还没 join 时 username 为 None，join 之后才算用户
+    joined_at  time.monotonic_ns()，整数
+    queue      该连接的 OutboundQueue（见 core/outbound.py）
+    codec      协商好的编码，默认 json
+    limits     限流状态（core/ratelimit.py），未开启限流时为 None
+    deflate    协商好的 permessage-deflate 窗口大小（core/compression.py），未压缩时为 None
+    token      join 时发给客户端的续连令牌，断线重连（resume）时凭它接管还没断开的旧会话
+    channel    多路复用的逻辑连接（core/mux.py）在物理连接内的编号，普通连接为 None；
+               物理连接的 channels 是 {编号: Channel}，没有多路复用时为 None
+SessionRegistry 以连接为主键，另外维护两个二级索引：
+    names  {fold_name(username): connection}，用户名忽略大小写唯一（见 core/presence.py）
+    rooms  {room: {connection, ...}}，广播目标直接取这里的集合
+会话自己的 rooms 是元组：大多数用户只在一两个房间里，元组比集合小得多。
+连接断开时 remove() 一次清掉会话和所有索引，不会再出现"连接已经不在、用户还在"的情况。
+"""
+import time
+
+from core.codec import JSON_CODEC
+from core.presence import fold_name
+
+
+class Session:
+    __slots__ = ('connection', 'username', 'room', 'rooms', 'joined_at', 'queue', 'codec',
+                 'messages_in', 'bytes_in', 'limits', 'deflate', 'token', 'channel', 'channels')
+
+    def __init__(self, connection, queue=None):
+        self.connection = connection
+        self.username = None  # set on join
+        self.room = None  # current room, used when a message does not name one
+        self.rooms = ()
+        self.joined_at = time.monotonic_ns()
+        self.queue = queue
+        self.codec = JSON_CODEC
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.limits = None  # ConnectionLimits when rate limiting is on, see core/ratelimit.py
+        self.deflate = None  # negotiated permessage-deflate window bits, see core/compression.py
+        self.token = None  # resume token, set on join
+        self.channel = None  # id within the physical connection, for a Channel
+        self.channels = None  # {id: Channel} of a physical connection that multiplexes users
+
+    @property
+    def joined(self):
+        return self.username is not None
+
+
+class SessionRegistry:
+    def __init__(self):
+        self.sessions = {}  # {connection: Session}
+        self.names = {}  # {folded username: connection}
+        self.rooms = {}  # {room: set(connection)}
+        self.users = 0  # sessions that have joined
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, connection):
+        return connection in self.sessions
+
+    def __iter__(self):
+        return iter(self.sessions)
+
+    def get(self, connection):
+        return self.sessions.get(connection)
+
+    def values(self):
+        return self.sessions.values()
+
+    def add(self, connection, queue=None):
+        session = self.sessions[connection] = Session(connection, queue)
+        return session
+
+    def remove(self, connection):
+        """删除连接的会话，返回它（已经删除时返回 None）；用户信息和房间留在返回的会话上"""
+        session = self.sessions.pop(connection, None)
+        if session is not None and session.username is not None:
+            self._unindex(session)
+        return session
+
+    # users
+
+    def add_user(self, connection, username, room=None):
+        # None when the connection is gone, already joined, or the name is taken
+        session = self.sessions.get(connection)
+        if session is None or session.username is not None:
+            return None
+        key = fold_name(username)
+        if key in self.names:
+            return None
+        session.username = username
+        session.joined_at = time.monotonic_ns()
+        self.names[key] = connection
+        self.users += 1
+        if room is not None:
+            self.join_room(connection, room)
+        return session
+
+    def remove_user(self, connection):
+        # back to a bare connection, returns the rooms the user was in
+        session = self.sessions.get(connection)
+        if session is None or session.username is None:
+            return ()
+        rooms = session.rooms
+        self._unindex(session)
+        session.username = None
+        session.room = None
+        session.rooms = ()
+        return rooms
+
+    def _unindex(self, session):
+        connection = session.connection
+        for room in session.rooms:
+            members = self.rooms.get(room)
+            if members is not None:
+                members.discard(connection)
+                if not members:
+                    del self.rooms[room]
+        key = fold_name(session.username)
+        if self.names.get(key) is connection:
+            del self.names[key]
+        self.users -= 1
+
+    def has_user(self, connection):
+        session = self.sessions.get(connection)
+        return session is not None and session.username is not None
+
+    def get_username(self, connection):
+        session = self.sessions.get(connection)
+        if session is None or session.username is None:
+            return 'unknown'
+        return session.username
+
+    def find(self, username):
+        # the connection joined under this name (any case), None when nobody is
+        return self.names.get(fold_name(username))
+
+    # rooms
+
+    def join_room(self, connection, room):
+        session = self.sessions.get(connection)
+        if session is None or session.username is None:
+            return False
+        self.rooms.setdefault(room, set()).add(connection)
+        if room not in session.rooms:
+            session.rooms += (room,)
+        session.room = room
+        return True
+
+    def leave_room(self, connection, room):
+        members = self.rooms.get(room)
+        if members is None or connection not in members:
+            return False
+        members.discard(connection)
+        if not members:
+            del self.rooms[room]
+        session = self.sessions[connection]
+        session.rooms = tuple(r for r in session.rooms if r != room)
+        if session.room == room:
+            # fall back to any room the user is still in
+            session.room = next(iter(session.rooms), None)
+        return True
+
+    def switch_room(self, connection, old_room, new_room):
+        self.leave_room(connection, old_room)
+        self.join_room(connection, new_room)
+
+    def get_room(self, connection):
+        session = self.sessions.get(connection)
+        return session.room if session is not None else None
+
+    def get_rooms(self, connection):
+        session = self.sessions.get(connection)
+        return session.rooms if session is not None else ()
+
+    def get_room_members(self, room):
+        return self.rooms.get(room, set())
+
+    def in_room(self, connection, room):
+        return connection in self.rooms.get(room, ())
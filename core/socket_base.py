@@ -1,49 +1,294 @@
 import asyncio
 import websockets
 import json
-from typing import Optional, Set, Callable
+from time import perf_counter
+from typing import Optional, Callable
+from core.codec import Payload
+from core.fanout import fanout
+from core.files import CHUNK_PREFIX
+from core.heartbeat import Heartbeat
+from core.log import get_logger
+from core.message_types import ERROR, PING
+from core.metrics import Registry
+from core.mux import Channel
+from core.outbound import OutboundQueue, DROP_OLDEST
+from core.ratelimit import ALLOW, DISCONNECT, REPLY
+from core.session import SessionRegistry
+
+log = get_logger('socket')
+
+# one shared ping, framed once per codec and reused for every connection
+_PING = Payload({'type': PING})
+_THROTTLED = Payload({'type': ERROR, 'message': 'Rate limit exceeded, slow down'})
 
 class SocketBase:
-    def __init__(self, host='localhost', port=12345):
+    def __init__(self, host='localhost', port=12345, queue_size=256, queue_policy=DROP_OLDEST,
+                 heartbeat_interval=20.0, idle_timeout=60.0, rate_limiter=None, deflate=None):
         self.host = host
         self.port = port
+        # per-connection bounded send queues, see core/outbound.py
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        # one Session per server-side connection: user, rooms, codec and send queue
+        self.sessions = SessionRegistry()
         self.server = None
+        # one websockets server per listening socket, server is the first
+        self.servers = []
         self.client_websocket: Optional[websockets.WebSocketClientProtocol] = None
-        self.connected_clients: Set[websockets.WebSocketServerProtocol] = set()
         self.message_handler: Optional[Callable] = None
-        
-    async def start_server(self, message_handler: Callable = None):
-        print(f"[WebSocket server starting]: ws://{self.host}:{self.port}")
+        # application-level ping and idle reaper, one timing wheel for all
+        # connections (see core/heartbeat.py); 0 keeps websockets' own keepalive
+        self.heartbeat = Heartbeat(heartbeat_interval, idle_timeout, self._send_ping,
+                                   self._reap) if heartbeat_interval else None
+        # optional token buckets per connection / user, checked before parsing
+        self.rate_limiter = rate_limiter
+        # optional permessage-deflate, each broadcast compressed once (core/compression.py)
+        self.deflate = deflate
+        # coroutine(frame, websocket) -> accepted, for file data frames (core/files.py)
+        self.chunk_handler: Optional[Callable] = None
+        # background tasks started by spawn(), the loop only keeps weak references to tasks
+        self.tasks = set()
+        self._setup_metrics()
+
+    def _setup_metrics(self):
+        # counters and histograms, exported by core/metrics.py
+        self.metrics = metrics = Registry()
+        self.messages_in = metrics.counter('chat_messages_in_total', 'frames received from clients')
+        self.bytes_in = metrics.counter('chat_bytes_in_total',
+                                        'size of received frames (characters for text frames)')
+        self.errors = metrics.counter('chat_errors_total', 'messages that could not be parsed or handled')
+        self.handler_time = metrics.histogram('chat_handler_seconds', 'time spent handling one frame')
+        self.fanout_time = metrics.histogram('chat_fanout_seconds', 'time spent in one broadcast fan-out')
+        self.fanout_recipients = metrics.counter('chat_fanout_recipients_total',
+                                                 'connections a broadcast was handed to')
+        # totals of closed connections' queues, the open ones are summed on read
+        self._retired = {'sent': 0, 'sent_bytes': 0, 'dropped': 0, 'coalesced': 0}
+        metrics.computed_counter('chat_messages_out_total', 'frames written to clients',
+                                 lambda: self._queue_total('sent'))
+        metrics.computed_counter('chat_bytes_out_total', 'bytes written to clients',
+                                 lambda: self._queue_total('sent_bytes'))
+        metrics.computed_counter('chat_dropped_total', 'frames dropped by slow-consumer policies',
+                                 lambda: self._queue_total('dropped'))
+        metrics.computed_counter('chat_coalesced_total', 'frames replaced by the coalesce policy',
+                                 lambda: self._queue_total('coalesced'))
+        if self.heartbeat is not None:
+            metrics.computed_counter('chat_pings_sent_total', 'heartbeat pings sent to idle connections',
+                                     lambda: self.heartbeat.pings)
+            metrics.computed_counter('chat_reaped_total', 'connections closed after the idle timeout',
+                                     lambda: self.heartbeat.reaped)
+        if self.deflate is not None:
+            metrics.computed_counter('chat_deflate_messages_total', 'messages compressed for fan-out',
+                                     lambda: self.deflate.compressed)
+            metrics.computed_counter('chat_deflate_saved_bytes_total', 'bytes saved by compressing them',
+                                     lambda: self.deflate.bytes_before - self.deflate.bytes_after)
+        if self.rate_limiter is not None:
+            metrics.computed_counter('chat_rate_limited_total', 'frames dropped by rate limits',
+                                     lambda: self.rate_limiter.dropped)
+            metrics.computed_counter('chat_rate_limit_disconnects_total',
+                                     'connections closed for sustained rate limit violations',
+                                     lambda: self.rate_limiter.disconnects)
+        metrics.gauge('chat_connections', 'open client connections', lambda: len(self.sessions))
+        metrics.gauge('chat_queued_bytes', 'bytes waiting in outbound queues',
+                      lambda: sum(session.queue.queued_bytes for session in self.sessions.values()))
+        # what queue_stats() lists per connection, summed up
+        metrics.gauge('chat_queued_frames', 'frames waiting in outbound queues',
+                      lambda: sum(len(session.queue.frames) for session in self.sessions.values()))
+        metrics.gauge('chat_backed_up_connections', 'connections with frames waiting in their queue',
+                      lambda: sum(1 for session in self.sessions.values() if session.queue.frames))
+        metrics.gauge('chat_queue_max_depth', 'deepest outbound queue right now',
+                      lambda: max((len(session.queue.frames) for session in self.sessions.values()), default=0))
+        metrics.gauge('chat_queue_peak_depth', 'deepest any open connection\'s queue has been',
+                      lambda: max((session.queue.peak_depth for session in self.sessions.values()), default=0))
+
+    @property
+    def connected_clients(self):
+        # {websocket: Session}, iterates and tests membership like the old set
+        return self.sessions.sessions
+
+    def _queue_total(self, field):
+        return self._retired[field] + sum(getattr(session.queue, field) for session in self.sessions.values())
+
+    async def start_server(self, message_handler: Callable = None, reuse_port: bool = False, sock=None):
+        log.info("WebSocket server starting: ws://%s:%s", self.host, self.port)
         self.message_handler = message_handler
 
+        heartbeat = self.heartbeat
+        if heartbeat is not None:
+            heartbeat.start()
+            # the heartbeat replaces websockets' keepalive task per connection
+            serve_options = {'ping_interval': None}
+        else:
+            serve_options = {}
+        # opt-in permessage-deflate; otherwise no extension, frames are shared as is
+        if self.deflate is not None:
+            serve_options['extensions'] = [self.deflate.server_extension()]
+
+        limiter = self.rate_limiter
+        chunk_handler = self.chunk_handler
+
         async def handle_client(websocket, path):
-            self.connected_clients.add(websocket)
-            print(f"[client connection]: {websocket.remote_address}")
+            session = self.add_connection(websocket)
+            log.debug("client connection: %s", websocket.remote_address)
             try:
                 async for message in websocket:
+                    if heartbeat is not None:
+                        heartbeat.touch(websocket)
+                    session.messages_in += 1
+                    session.bytes_in += len(message)
+                    self.messages_in.inc()
+                    self.bytes_in.inc(len(message))
+                    if chunk_handler is not None and message[:1] == CHUNK_PREFIX:
+                        # the next chunk of an accepted upload, within the window its last ack
+                        # granted, is not charged to the chat rate limits; anything else goes on below
+                        if await chunk_handler(message, websocket):
+                            continue
+                    if limiter is not None:
+                        # judged by frame size alone, nothing is parsed yet
+                        verdict = limiter.check(session.limits, len(message), session.username)
+                        if verdict is not ALLOW:
+                            if not self.throttle(websocket, verdict):
+                                break
+                            continue
+                    started = perf_counter()
                     if self.message_handler:
                         await self.message_handler(message, websocket)
                     else:
                         await self.broadcast(message, exclude=websocket)
+                    self.handler_time.observe(perf_counter() - started)
             except websockets.exceptions.ConnectionClosed:
-                print(f"[client disconnected]: {websocket.remote_address}")
+                log.debug("client disconnected: %s", websocket.remote_address)
             finally:
-                self.connected_clients.discard(websocket)
+                self.remove_connection(websocket)
+
+        # compression=None: websockets' own deflate keeps a context per connection,
+        # which would defeat encode-once broadcast
+        if sock is not None:
+            # already listening sockets: shared by worker processes, or handed over
+            # by the process this one replaces (one per address of the host)
+            for listener in sock if isinstance(sock, (list, tuple)) else (sock,):
+                self.servers.append(await websockets.serve(handle_client, sock=listener, compression=None,
+                                                           **serve_options))
+        else:
+            # reuse_port lets several server processes listen on the same port
+            self.servers.append(await websockets.serve(handle_client, self.host, self.port, compression=None,
+                                                       reuse_port=reuse_port or None, **serve_options))
+        self.server = self.servers[0]
+        log.info("WebSocket server started: ws://%s:%s", self.host, self.port)
+
+    def listening_sockets(self):
+        # the sockets accepting connections, to hand over to another process
+        return [listener for server in self.servers for listener in server.sockets]
+
+    def stop_accepting(self):
+        # listening sockets closed, open connections untouched; a dup of a socket keeps it
+        # listening, connections wait in its backlog for whoever accepts next
+        for server in self.servers:
+            server.server.close()
 
-        self.server = await websockets.serve(handle_client, self.host, self.port)
-        print(f"[WebSocket server started]: ws://{self.host}:{self.port}")
+    def spawn(self, coro):
+        # fire-and-forget task, referenced until it finishes
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
         
-    async def connect_as_client(self, uri: str = None):
-        # connect to a WebSocket server as a client
+    def add_connection(self, websocket):
+        # register a server-side connection and give it its own send queue
+        session = self.sessions.add(websocket, OutboundQueue(websocket, self.queue_size, self.queue_policy))
+        if self.heartbeat is not None:
+            self.heartbeat.add(websocket)
+        if self.rate_limiter is not None:
+            session.limits = self.rate_limiter.connect()
+        if self.deflate is not None:
+            session.deflate = self.deflate.window_of(websocket)
+        return session
+
+    def throttle(self, websocket, verdict):
+        # a frame the rate limiter refused; False once the physical connection is closed for it
+        if verdict is REPLY:
+            self.send_queued(websocket, _THROTTLED)
+        elif verdict is DISCONNECT:
+            connection = websocket.connection if isinstance(websocket, Channel) else websocket
+            log.info("rate limit exceeded, closing %s", connection.remote_address)
+            connection.fail_connection(1008, "rate limit exceeded")
+            return False
+        return True
+
+    def channel(self, websocket, channel_id, max_channels):
+        """websocket 上编号为 channel_id 的逻辑连接（core/mux.py），第一次用到时创建；超出上限时返回 None"""
+        session = self.sessions.get(websocket)
+        if session is None or session.channel is not None:
+            return None
+        channels = session.channels
+        if channels is None:
+            channels = session.channels = {}
+        channel = channels.get(channel_id)
+        if channel is None:
+            if len(channels) >= max_channels or not isinstance(channel_id, int):
+                return None
+            channel = channels[channel_id] = Channel(websocket, channel_id)
+            # the physical connection's queue, limits and compression are shared,
+            # except for the per-user buckets: each channel is charged to its own user
+            sub = self.sessions.add(channel, session.queue)
+            sub.channel = channel_id
+            sub.deflate = session.deflate
+            if self.rate_limiter is not None:
+                sub.limits = self.rate_limiter.share(session.limits)
+                self.rate_limiter.widen(session.limits, len(channels) + 1)
+        return channel
+
+    def remove_connection(self, websocket):
+        # returns the removed Session, None when it was already gone
+        session = self.sessions.remove(websocket)
+        if session is None:
+            return None
+        if session.channel is not None:
+            # a multiplexed user: the physical connection keeps its queue
+            parent = self.sessions.get(websocket.connection)
+            if parent is not None and parent.channels is not None:
+                parent.channels.pop(session.channel, None)
+            return session
+        if self.heartbeat is not None:
+            self.heartbeat.remove(websocket)
+        queue = session.queue
+        queue.close()
+        for field in self._retired:
+            self._retired[field] += getattr(queue, field)
+        return session
+
+    def _send_ping(self, websocket):
+        self.send_queued(websocket, _PING)
+
+    def _reap(self, websocket):
+        # nothing heard for idle_timeout seconds: likely a half-open connection
+        log.info("idle timeout, closing %s", websocket.remote_address)
+        self.remove_connection(websocket)
+        try:
+            websocket.fail_connection(1011, "idle timeout")
+        except Exception:
+            pass
+
+    def queue_stats(self):
+        # per-connection queue depth and drop counts, deepest backlog first
+        stats = []
+        for websocket, session in self.sessions.sessions.items():
+            item = session.queue.stats()
+            item['remote_address'] = websocket.remote_address
+            stats.append(item)
+        stats.sort(key=lambda item: item['queued_bytes'], reverse=True)
+        return stats
+
+    async def connect_as_client(self, uri: str = None, compression: bool = False):
+        # connect to a WebSocket server as a client, optionally offering permessage-deflate
         if uri is None:
             uri = f"ws://{self.host}:{self.port}"
         
         try:
-            self.client_websocket = await websockets.connect(uri)
-            print(f"[client connected]: {uri}")
+            self.client_websocket = await websockets.connect(uri, compression='deflate' if compression else None)
+            log.info("client connected: %s", uri)
             return True
         except Exception as e:
-            print(f"[connection failed]: {e}")
+            log.warning("connection failed: %s", e)
             return False
             
     async def send(self, data: str, target_websocket: websockets.WebSocketServerProtocol = None):
@@ -54,38 +299,62 @@ class SocketBase:
                 await target.send(data)
                 return True
             except websockets.exceptions.ConnectionClosed:
-                print("[connection failed]: unable to send message")
+                log.warning("connection closed: unable to send message")
                 return False
             except Exception as e:
-                print(f"[send error]: {e}")
+                log.warning("send error: %s", e)
                 return False
         else:
-            print("[no websocket available]: unable to send message")
+            log.warning("no websocket available: unable to send message")
             return False
     
-    async def broadcast(self, message: str, exclude: websockets.WebSocketServerProtocol = None):
-        # broadcast message to all connected clients
-        if not self.connected_clients:
+    async def broadcast(self, message, exclude: websockets.WebSocketServerProtocol = None, targets=None, key=None):
+        # broadcast message to targets (default: all connected clients)
+        # the frame is encoded once and written straight into each transport,
+        # slow peers never hold up the sender; key marks frames a later one with
+        # the same key supersedes (the coalesce queue policy)
+        self.broadcast_now(message, exclude, targets, key)
+
+    def broadcast_now(self, message, exclude=None, targets=None, key=None):
+        # synchronous body of broadcast, usable from loop callbacks
+        if targets is None:
+            targets = self.connected_clients
+        if not targets:
             return
-            
-        targets = self.connected_clients.copy()
-        if exclude:
-            targets.discard(exclude)
-            
-        tasks = []
-        for client in targets:
-            tasks.append(self._safe_send(client,message))
-                
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+
+        started = perf_counter()
+        sent, dead = fanout(message, targets, self.sessions.sessions, exclude=exclude, key=key,
+                            deflate=self.deflate)
+        self.fanout_time.observe(perf_counter() - started)
+        self.fanout_recipients.inc(sent)
+        for websocket in dead:
+            self.remove_connection(websocket)
+
+    def send_queued(self, websocket, message, key=None):
+        # send to a single server-side connection through its outbound queue
+        session = self.sessions.get(websocket)
+        if session is not None and session.channel is not None and isinstance(message, Payload):
+            # meant for one multiplexed user, the client needs to know which
+            message = Payload(dict(message.data, ch=session.channel))
+        sent, dead = fanout(message, (websocket,), self.sessions.sessions, key=key, deflate=self.deflate)
+        for client in dead:
+            self.remove_connection(client)
+        return sent > 0
+
+    async def wait_writable(self, websocket):
+        # back off while the connection's queue is half full, for bulk sends
+        session = self.sessions.get(websocket)
+        queue = session.queue if session is not None else None
+        while queue is not None and not queue.closed and len(queue.frames) >= queue.max_size // 2:
+            await asyncio.sleep(0.005)
 
     async def _safe_send(self, websocket, message):
         """安全发送消息"""
         try:
             await websocket.send(message)
         except Exception as e:
-            print(f"[safe_send error]: {e}")
-            self.connected_clients.discard(websocket)
+            log.debug("safe_send error: %s", e)
+            self.remove_connection(websocket)
 
     async def receive(self):
         # receive message (client mode)
@@ -94,13 +363,13 @@ class SocketBase:
                 message = await self.client_websocket.recv()
                 return message, f"{self.host}:{self.port}"
             except websockets.exceptions.ConnectionClosed:
-                print("[connection closed]: unable to receive message")
+                log.info("connection closed: unable to receive message")
                 return None, None
             except Exception as e:  
-                print(f"[receive error]: {e}")
+                log.warning("receive error: %s", e)
                 return None, None
         else:
-            print("[no available client connection]")
+            log.warning("no available client connection")
             return None, None
     
     async def listen_for_messages(self, message_callback: Callable = None):
@@ -111,30 +380,63 @@ class SocketBase:
                 if message_callback:
                     await message_callback(message)
                 else:
-                    print(f"[message received]: {message}")
+                    log.info("message received: %s", message)
             except websockets.exceptions.ConnectionClosed:
-                print("[connection closed]: unable to receive message")
+                log.info("connection closed: unable to receive message")
                 break
             except Exception as e:
-                print(f"[listen error]: {e}")
+                log.warning("listen error: %s", e)
                 break
     
+    async def close_connections(self, code=1001, reason='', timeout=5.0):
+        """并发关闭全部服务端连接：先等各自的发送队列写完，再走关闭握手；
+        timeout 秒后还没关掉的直接断开。返回 (正常关闭数, 强制断开数)"""
+        async def close(websocket, queue):
+            while queue is not None and queue.frames and not queue.closed:
+                await asyncio.sleep(0.005)
+            try:
+                await websocket.close(code, reason)
+            except Exception as e:
+                log.debug("close of %s failed: %s", websocket.remote_address, e)
+
+        # the multiplexed users go with their physical connection
+        connections = {websocket: session.queue for websocket, session in self.sessions.sessions.items()
+                       if session.channel is None}
+        if not connections:
+            return 0, 0
+        tasks = {asyncio.create_task(close(websocket, queue)): websocket for websocket, queue in connections.items()}
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+            websocket = tasks[task]
+            try:
+                websocket.fail_connection(code, reason)
+                # fail_connection() alone still waits close_timeout for the peer
+                websocket.transport.abort()
+            except Exception:
+                pass
+        for websocket in connections:
+            self.remove_connection(websocket)
+        return len(done), len(pending)
+
     async def close(self):
         # close all connections
         # close client connection
         if self.client_websocket:
             await self.client_websocket.close()
 
-        # close all server client connections
-        for client in self.connected_clients.copy():
-            await client.close()
-        self.connected_clients.clear()
+        # close all server client connections, all at once
+        self.stop_accepting()
+        await self.close_connections()
+
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
 
         # close server
-        if self.server:
-            self.server.close()
-            await self.server.wait_closed()
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
             
     def get_connected_count(self):
         # return the number of connected clients
-        return len(self.connected_clients)
\ No newline at end of file
+        return len(self.sessions)
\ No newline at end of file
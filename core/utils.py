@@ -1,4 +0,0 @@
-from datetime import datetime
-
-def now_iso():
-    return datetime.now().isoformat()
@@ -0,0 +1,99 @@
+"""
+多核模式：一个监听端口，N 个 worker 进程
+
+主进程绑定监听 socket，并在一个私有的 Unix socket 上运行 BusBroker；
+然后 fork 出 N 个 worker，每个 worker 在同一个监听 socket 上跑自己的 ChatServer 事件循环，
+通过 broker 互相转发消息和上下线事件，所以连到不同 worker 的客户端仍然能看到彼此。
+"""
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+
+from core.bus import BrokerBus, BusBroker
+from core.chat_server import ChatServer
+from core.log import get_logger
+from core.restart import install_signal_handlers
+
+log = get_logger('workers')
+
+
+def _worker_main(sock, bus_path, index, server_kwargs):
+    # drop the supervisor's signal handling inherited through fork
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    bus = BrokerBus(path=bus_path, node_id=f"worker-{index}")
+    if server_kwargs.get('metrics_port'):
+        # one metrics endpoint per worker on consecutive ports
+        server_kwargs = dict(server_kwargs, metrics_port=server_kwargs['metrics_port'] + index)
+    server = ChatServer(bus=bus, **server_kwargs)
+    try:
+        asyncio.run(_serve(server, sock))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve(server, sock):
+    # the supervisor's terminate() drains the worker's clients instead of killing it
+    install_signal_handlers(server)
+    await server.start(sock=sock)
+
+
+def create_listening_socket(host, port, backlog=1024):
+    sock = socket.create_server((host, port), backlog=backlog)
+    sock.setblocking(False)
+    return sock
+
+
+async def _supervise(workers, sock, bus_path, server_kwargs):
+    broker = BusBroker(path=bus_path)
+    await broker.start()
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    ctx = multiprocessing.get_context('fork')
+    processes = []
+    for index in range(workers):
+        process = ctx.Process(target=_worker_main, args=(sock, bus_path, index, server_kwargs),
+                              name=f"chat-worker-{index}", daemon=True)
+        process.start()
+        processes.append(process)
+    log.info("workers started: %d workers on %s", workers, sock.getsockname())
+
+    try:
+        while not stop.is_set() and any(process.is_alive() for process in processes):
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=0.5)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            # they drain their clients first
+            process.join(timeout=server_kwargs.get('drain_timeout', 5.0) + 5)
+            if process.is_alive():
+                process.kill()
+        await broker.close()
+        log.info("workers stopped")
+
+
+def run_workers(workers, host='localhost', port=12345, **server_kwargs):
+    # server_kwargs are passed to every worker's ChatServer
+    sock = create_listening_socket(host, port)
+    bus_dir = tempfile.mkdtemp(prefix='chatroom-')
+    bus_path = os.path.join(bus_dir, 'bus.sock')
+    server_kwargs.update(host=host, port=port)
+    try:
+        asyncio.run(_supervise(workers, sock, bus_path, server_kwargs))
+    finally:
+        sock.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
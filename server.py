@@ -1,10 +1,227 @@
+import time
+# startup time is measured from here, imports included
+_STARTED = time.monotonic()
+import argparse
 import asyncio
+import sys
+from core.auth import Authenticator, FileUserStore, read_secret
+from core.bus import BrokerBus, BusBroker, parse_address
 from core.chat_server import ChatServer
+from core.compression import DEFAULT_LEVEL, DEFAULT_MIN_SIZE, Deflate
+from core.log import LEVELS, setup_logging
+from core.message_log import MessageLog
+from core.outbound import POLICIES, DROP_OLDEST
+from core.ratelimit import RateLimiter, parse_limit
+from core.restart import Takeover, install_signal_handlers
+from core.workers import run_workers
+_IMPORTED = time.monotonic()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='WebSocket 聊天室服务器')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--queue-size', type=int, default=256,
+                        help='per-connection outbound queue size (high-water mark)')
+    parser.add_argument('--queue-policy', choices=POLICIES, default=DROP_OLDEST,
+                        help='what to do when a slow client fills its queue')
+    parser.add_argument('--bus', metavar='ADDRESS',
+                        help='join a cluster through the bus broker at tcp://host:port or unix:///path')
+    parser.add_argument('--run-broker', action='store_true',
+                        help='also run the bus broker at --bus in this process')
+    parser.add_argument('--node-id', help='name of this server on the bus')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='set SO_REUSEPORT so several servers can share --port')
+    parser.add_argument('--log-dir', help='persist chat messages to segmented log files in this directory')
+    parser.add_argument('--search', action='store_true',
+                        help='full-text search over the persisted history (needs --log-dir)')
+    parser.add_argument('--history', type=int, default=20,
+                        help='messages replayed to a client when it joins a room')
+    parser.add_argument('--history-cache', type=int, default=200,
+                        help='recent messages kept in memory per room for replay')
+    parser.add_argument('--history-cache-mb', type=int, default=64,
+                        help='memory cap of the history cache across all rooms')
+    parser.add_argument('--batch-window-ms', type=float, default=0,
+                        help='coalesce chat messages per room for this long before sending (0 = off)')
+    parser.add_argument('--batch-max', type=int, default=64,
+                        help='send a batch early once a room has this many messages')
+    parser.add_argument('--heartbeat', type=float, default=20.0,
+                        help='ping connections idle for this many seconds (0 = websockets keepalive)')
+    parser.add_argument('--idle-timeout', type=float, default=60.0,
+                        help='close connections idle for this many seconds')
+    parser.add_argument('--max-rooms', type=int, default=100000,
+                        help='rooms whose seq and last timestamp stay in memory, idle empty ones are forgotten')
+    parser.add_argument('--mailbox-size', type=int, default=100,
+                        help='direct messages kept per offline user (0 = refuse DMs to offline users)')
+    parser.add_argument('--mailbox-users', type=int, default=10000,
+                        help='offline users with a mailbox, the least recently written is dropped first')
+    parser.add_argument('--rate-limit', default='20/40', metavar='RATE[/BURST]',
+                        help='frames per second per connection, 0 disables rate limiting')
+    parser.add_argument('--byte-limit', default='65536/262144', metavar='RATE[/BURST]',
+                        help='bytes per second per connection, 0 = no byte limit')
+    parser.add_argument('--user-rate-limit', default='0', metavar='RATE[/BURST]',
+                        help='frames per second per user, across reconnects (0 = off)')
+    parser.add_argument('--user-byte-limit', default='0', metavar='RATE[/BURST]',
+                        help='bytes per second per user, across reconnects (0 = off)')
+    parser.add_argument('--file-byte-limit', default='8388608/16777216', metavar='RATE[/BURST]',
+                        help='upload bytes per second per connection, paced by holding back file_ack (0 = off)')
+    parser.add_argument('--rate-strikes', type=int, default=50,
+                        help='dropped frames (recovering one per second) before the connection is closed')
+    parser.add_argument('--compression', action='store_true',
+                        help='accept permessage-deflate, every broadcast is compressed once')
+    parser.add_argument('--compression-level', type=int, default=DEFAULT_LEVEL, choices=range(1, 10),
+                        metavar='1-9')
+    parser.add_argument('--compression-window', type=int, default=15, choices=range(9, 16), metavar='9-15',
+                        help='server window bits, smaller is cheaper for short chat messages')
+    parser.add_argument('--compression-min-size', type=int, default=DEFAULT_MIN_SIZE,
+                        help='messages shorter than this many bytes are sent uncompressed')
+    parser.add_argument('--iso-timestamps', action='store_true',
+                        help='send ISO timestamp strings instead of epoch milliseconds, for old clients')
+    parser.add_argument('--file-dir', help='accept file uploads and keep them in this directory')
+    parser.add_argument('--max-file-mb', type=int, default=1024, help='largest file a user can upload')
+    parser.add_argument('--file-store-mb', type=int, default=16384,
+                        help='disk space for uploaded files, the oldest are deleted first')
+    parser.add_argument('--auth-secret-file',
+                        help='require a join token signed with the key in this file (python -m core.auth)')
+    parser.add_argument('--auth-users', help='only these usernames may join, one per line, re-read on change')
+    parser.add_argument('--auth-cache-size', type=int, default=10000, help='verified tokens kept in memory')
+    parser.add_argument('--auth-cache-ttl', type=float, default=300.0,
+                        help='seconds a verified token is trusted without checking the user list again')
+    parser.add_argument('--auth-ip-limit', default='5/20', metavar='RATE[/BURST]',
+                        help='token verifications per second per client IP, cached tokens are free (0 = off)')
+    parser.add_argument('--max-channels', type=int, default=256,
+                        help='users one connection may multiplex, see core/mux.py (0 = off)')
+    parser.add_argument('--log-level', choices=LEVELS, default='info',
+                        help="debug logs every message, 'off' disables logging")
+    parser.add_argument('--log-sample', type=int, default=1, metavar='N',
+                        help='keep one in N per-message debug records')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics at http://127.0.0.1:PORT/metrics '
+                             '(worker i uses PORT + i)')
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='run N server processes sharing the listening socket')
+    parser.add_argument('--drain-timeout', type=float, default=5.0,
+                        help='on SIGTERM / Ctrl-C, seconds to let connections close before dropping them')
+    parser.add_argument('--reconnect-url',
+                        help='on SIGTERM, tell clients to reconnect to this ws:// URL instead of this server')
+    parser.add_argument('--reconnect-spread', type=float, default=1.0,
+                        help='clients reconnect at a random point within this many seconds')
+    parser.add_argument('--resume-grace', type=float, default=30.0,
+                        help='after a hot restart (SIGHUP), seconds a user that was online may take '
+                             'their session back before the name is free again')
+    # set on the new process by a hot restart, see core/restart.py
+    parser.add_argument('--takeover', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1 and args.bus:
+        parser.error('--workers runs its own bus, it cannot be combined with --bus')
+    if args.workers > 1 and args.file_dir:
+        parser.error('uploaded files stay on the process that received them, --file-dir needs --workers 1')
+    if args.workers > 1 and args.log_dir:
+        parser.error('every worker has its own cursors and sequence numbers, --log-dir needs --workers 1')
+    if args.search and not args.log_dir:
+        parser.error('--search indexes the message log, it needs --log-dir')
+    if args.takeover and args.workers > 1:
+        parser.error('hot restart hands over a single server, it cannot be combined with --workers')
+    try:
+        limits = [parse_limit(value) for value in (args.rate_limit, args.byte_limit,
+                                                   args.user_rate_limit, args.user_byte_limit)]
+        file_limit = parse_limit(args.file_byte_limit)
+    except ValueError:
+        parser.error('rate limits are RATE or RATE/BURST, for example 20/40')
+    args.rate_limiter = (RateLimiter(*limits, strikes=args.rate_strikes, file_byte_limit=file_limit)
+                         if limits[0][0] > 0 else None)
+    try:
+        ip_limit = parse_limit(args.auth_ip_limit)
+    except ValueError:
+        parser.error('--auth-ip-limit is RATE or RATE/BURST, for example 5/20')
+    if args.auth_users and not args.auth_secret_file:
+        parser.error('--auth-users needs --auth-secret-file')
+    args.auth = Authenticator(read_secret(args.auth_secret_file),
+                              FileUserStore(args.auth_users) if args.auth_users else None,
+                              args.auth_cache_size, args.auth_cache_ttl,
+                              ip_limit) if args.auth_secret_file else None
+    args.deflate = Deflate(args.compression_level, args.compression_window,
+                           args.compression_min_size) if args.compression else None
+    return args
+
+
+async def run(args):
+    startup = {'imports': _IMPORTED - _STARTED}
+    sock = None
+    state = None
+    takeover = None
+    if args.takeover:
+        # started by a running server on SIGHUP: its socket and state come once it has drained
+        takeover = await Takeover.connect(args.takeover)
+        began = time.monotonic()
+        sock, state = await takeover.receive()
+        startup['handover'] = time.monotonic() - began
+    broker = None
+    bus = None
+    if args.bus:
+        if args.run_broker:
+            broker = BusBroker(**parse_address(args.bus))
+            await broker.start()
+        bus = BrokerBus(node_id=args.node_id, **parse_address(args.bus))
+    began = time.monotonic()
+    message_log = MessageLog(args.log_dir) if args.log_dir else None
+    if message_log is not None:
+        startup['message log'] = time.monotonic() - began
+    server = ChatServer(host=args.host, port=args.port,
+                        queue_size=args.queue_size, queue_policy=args.queue_policy,
+                        bus=bus, reuse_port=args.reuse_port,
+                        message_log=message_log, history_limit=args.history,
+                        history_cache_size=args.history_cache,
+                        history_cache_bytes=args.history_cache_mb * 1024 * 1024,
+                        batch_window=args.batch_window_ms / 1000, batch_max=args.batch_max,
+                        metrics_host=args.metrics_host, metrics_port=args.metrics_port,
+                        heartbeat_interval=args.heartbeat, idle_timeout=args.idle_timeout,
+                        mailbox_size=args.mailbox_size, mailbox_users=args.mailbox_users,
+                        rate_limiter=args.rate_limiter, deflate=args.deflate,
+                        iso_timestamps=args.iso_timestamps, file_dir=args.file_dir,
+                        max_file_size=args.max_file_mb * 1024 * 1024,
+                        file_store_bytes=args.file_store_mb * 1024 * 1024, auth=args.auth,
+                        max_channels=args.max_channels, search=args.search,
+                        drain_timeout=args.drain_timeout, reconnect_url=args.reconnect_url,
+                        reconnect_spread=args.reconnect_spread, resume_grace=args.resume_grace,
+                        max_rooms=args.max_rooms)
+    if state is not None:
+        began = time.monotonic()
+        server.restore(state)
+        startup['snapshot'] = time.monotonic() - began
+        server.spawn(takeover.confirm(server))
+    server.startup.update(startup)
+    # the new process gets the same command line
+    install_signal_handlers(server, argv=sys.argv)
+    try:
+        await server.start(sock=sock, started=_STARTED)
+    finally:
+        if broker:
+            await broker.close()
+
 
 if __name__ == '__main__':
-    server = ChatServer(host='localhost', port=12345)
+    args = parse_args()
+    setup_logging(args.log_level, sample=args.log_sample)
     
     try:
-        asyncio.run(server.start())
+        if args.workers > 1:
+            run_workers(args.workers, args.host, args.port,
+                        queue_size=args.queue_size, queue_policy=args.queue_policy,
+                        history_limit=args.history, history_cache_size=args.history_cache,
+                        history_cache_bytes=args.history_cache_mb * 1024 * 1024,
+                        batch_window=args.batch_window_ms / 1000, batch_max=args.batch_max,
+                        metrics_host=args.metrics_host, metrics_port=args.metrics_port,
+                        heartbeat_interval=args.heartbeat, idle_timeout=args.idle_timeout,
+                        mailbox_size=args.mailbox_size, mailbox_users=args.mailbox_users,
+                        rate_limiter=args.rate_limiter, deflate=args.deflate,
+                        iso_timestamps=args.iso_timestamps, auth=args.auth,
+                        max_channels=args.max_channels,
+                        drain_timeout=args.drain_timeout, reconnect_url=args.reconnect_url,
+                        reconnect_spread=args.reconnect_spread, max_rooms=args.max_rooms)
+        else:
+            asyncio.run(run(args))
     except KeyboardInterrupt:
-        print("\n服务器已关闭")
\ No newline at end of file
+        pass
+    print("\n服务器已关闭")
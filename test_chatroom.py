@@ -1,159 +1,859 @@
 #!/usr/bin/env python3
 """
 WebSocket 聊天室测试脚本
-自动启动服务器和多个客户端进行测试
+在空闲端口上启动服务器，用几个客户端做功能检查，再跑一次小规模负载；
+各功能另有单项测试，大多不起服务器，用内存里的假连接（FakeSocket）直接调用处理函数
+
+    python test_chatroom.py
+    python -m pytest -q test_chatroom.py
+
+大规模压测见 benchmarks/loadgen.py
 """
-import subprocess
-import time
 import asyncio
-import sys
+import io
 import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import websockets
+from websockets.connection import State
+from websockets.frames import Opcode
+
+from benchmarks.loadgen import REPO_ROOT, free_port, run_load, spawn_server
+from core.auth import AuthError, issue_token, verify_token
+from core.bus import InProcessBus, InProcessHub
 from core.chat_client import ChatClient
+from core.chat_server import ChatServer
+from core.clock import Clock
+from core.codec import (BINARY_CODEC, BINARY_MAGIC, JSON_CODEC, ZJSON_CODEC, ZJSON_MAGIC, decode_message,
+                        negotiate)
+from core.files import chunk_header
+from core.heartbeat import Heartbeat, TimingWheel
+from core.history_cache import HistoryCache
+from core.log import LogPipeline, MESSAGES_LOGGER, RateLimitFilter, SampleFilter
+from core.message_log import MessageLog
+from core.message_types import JOIN_ROOM, MESSAGE, SWITCH_ROOM, build_message
+from core.metrics import Registry
+from core.outbound import COALESCE, DISCONNECT, DROP_NEWEST, DROP_OLDEST, OutboundQueue
+from core.presence import PresenceIndex
+from core.ratelimit import ALLOW, DROP, REPLY, RateLimiter
+from core.ratelimit import DISCONNECT as RATE_DISCONNECT
+from core.restart import read_snapshot, write_snapshot
+from core.sdk import ChatSDK, SDKError
+from core.session import SessionRegistry
 
-class TestClient(ChatClient):
+
+class RecordingClient(ChatClient):
     def __init__(self, server_host='localhost', server_port=12345):
         super().__init__(server_host=server_host, server_port=server_port)
         self.messages_received = []
-        self.running = False
 
-    async def start_listening(self):
-        """开始监听服务器消息"""
-        self.running = True
-        try:
-            await self.listen_for_messages(self.handle_server_message)
-        except asyncio.CancelledError:
-            print(f"[{self.username}] 消息监听已取消")
-        finally:
-            self.running = False
-
-    async def handle_server_message(self, raw_message):
-        """处理服务器消息"""
-        try:
-            message_data = json.loads(raw_message)
-            message_type = message_data.get('type')
-
-            # 只处理 join、message 和 leave 类型
-            if message_type in ['join', 'message', 'leave']:
-                self.messages_received.append(message_data)
-
-                if message_type == 'join':
-                    username = message_data.get('username')
-                    print(f"[{self.username}] 🟢 {username} 加入了聊天室")
-                elif message_type == 'message':
-                    username = message_data.get('username')
-                    content = message_data.get('content')
-                    timestamp = message_data.get('timestamp')
-                    print(f"[{self.username}] 收到聊天: [{timestamp}] {username}: {content}")
-                elif message_type == 'leave':
-                    username = message_data.get('username')
-                    print(f"[{self.username}] 🔴 {username} 离开了聊天室")
-            else:
-                # 忽略未处理的消息类型
-                print(f"[{self.username}] ⚠️ 未知消息类型: {message_type}")
-        except json.JSONDecodeError:
-            print(f"[{self.username}] 收到非JSON消息: {raw_message}")
-        except Exception as e:
-            print(f"[{self.username}] 处理消息时出错: {e}")
-
-    async def disconnect(self):
-        """断开连接"""
-        if self.running:
-            self.running = False
-            await asyncio.sleep(0.1)
-        await self.close()
-        print(f"[{self.username}] 已断开连接")
-
-def start_server():
-    """启动服务器进程"""
-    print("启动 WebSocket 聊天室服务器...")
+    def handle_event(self, message_data):
+        # 只记录 join、message 和 leave，batch 帧已由 ChatClient 展开
+        if message_data.get('type') in ('join', 'message', 'leave'):
+            self.messages_received.append(message_data)
+
+    def chat_messages(self):
+        return [m for m in self.messages_received if m['type'] == 'message']
+
+
+class FakeSocket:
+    """内存里的服务端连接：transport 就是它自己，写出的帧解码后记在 sent 里；
+    paused 为 True 时像对端读得慢一样，后续帧进发送队列"""
+
+    def __init__(self, index=0):
+        self.state = State.OPEN
+        self.extensions = []
+        self.remote_address = ('127.0.0.1', 20000 + index)
+        self.transport = self
+        self._paused = False
+        self.sent = []
+        self.failed = None  # (code, reason) once failed or closed
+
+    # transport
+
+    def write(self, data):
+        # unmasked server frames as built by core/fanout.py
+        view = memoryview(data)
+        while view:
+            opcode, length, offset = view[0] & 0x0F, view[1] & 0x7F, 2
+            if length == 126:
+                length, offset = int.from_bytes(view[2:4], 'big'), 4
+            elif length == 127:
+                length, offset = int.from_bytes(view[2:10], 'big'), 10
+            self.write_frame_sync(True, Opcode(opcode), bytes(view[offset:offset + length]))
+            view = view[offset + length:]
+
+    def is_closing(self):
+        return self.failed is not None
+
+    def abort(self):
+        pass
+
+    # websocket
+
+    def write_frame_sync(self, fin, opcode, data):
+        self.sent.append(decode_message(data.decode('utf-8') if opcode == Opcode.TEXT else data))
+
+    async def drain(self):
+        while self._paused:
+            await asyncio.sleep(0.001)
+
+    def fail_connection(self, code=1006, reason=''):
+        self.failed = (code, reason)
+        self.state = State.CLOSED
+
+    async def close(self, code=1000, reason=''):
+        self.fail_connection(code, reason)
+
+    def of_type(self, message_type):
+        return [m for m in self.sent if m.get('type') == message_type]
+
+
+async def joined(server, username, room='Chatroom 0', index=0):
+    websocket = FakeSocket(index)
+    server.add_connection(websocket)
+    await server.handle_join({'username': username, 'room': room, 'history': 0}, websocket)
+    return websocket
+
+
+@contextmanager
+def running_server(*args):
+    """启动 server.py，返回它的端口"""
+    port = free_port()
+    server_process = spawn_server(port, args)
     try:
-        server_process = subprocess.Popen(
-            [sys.executable, "server.py"],
-            cwd="/Users/wanchongyu/workspace/chatroom",
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        time.sleep(5)  # 延长等待时间，确保服务器完全启动
-        print("✅ 服务器启动完成")
-        return server_process
-    except Exception as e:
-        print(f"❌ 启动服务器失败: {e}")
-        print("请检查 server.py 是否存在或是否有权限运行")
-        return None
-
-async def test_basic_chat():
-    """基本聊天功能测试"""
-    print("\n开始基本聊天功能测试")
-    alice = TestClient()
-    bob = TestClient()
-    charlie = TestClient()
+        yield port
+    finally:
+        server_process.terminate()
+        server_process.wait()
+
 
+async def _basic_chat(port):
+    names = ('alice', 'bob', 'charlie')
+    clients = [RecordingClient(server_port=port) for _ in names]
+    listen_tasks = []
     try:
-        if not await alice.connect_to_server("alice"):
-            print("❌ Alice 连接失败")
-            return False
-        if not await bob.connect_to_server("bob"):
-            print("❌ Bob 连接失败")
-            return False
-        if not await charlie.connect_to_server("charlie"):
-            print("❌ Charlie 连接失败")
-            return False
-
-        listen_tasks = [
-            asyncio.create_task(alice.start_listening()),
-            asyncio.create_task(bob.start_listening()),
-            asyncio.create_task(charlie.start_listening())
-        ]
-
-        await alice.send_chat_message("大家好！我是Alice")
-        await bob.send_chat_message("你好Alice！我是Bob")
-        await charlie.send_chat_message("嗨！我是Charlie，很高兴见到大家")
-
-        # 等待一段时间以确保消息被处理
-        await asyncio.sleep(1)
-
-        # 停止监听任务
+        for client, name in zip(clients, names):
+            assert await client.connect_to_server(name), f"{name} 连接失败"
+            listen_tasks.append(asyncio.create_task(
+                client.listen_for_messages(client.handle_server_message)))
+
+        await clients[0].send_chat_message("大家好！我是Alice")
+        await clients[1].send_chat_message("你好Alice！我是Bob")
+        await clients[2].send_chat_message("嗨！我是Charlie，很高兴见到大家")
+
+        # 等到每个人都收到三条聊天消息（包括自己发的）
+        for _ in range(50):
+            if all(len(client.chat_messages()) >= 3 for client in clients):
+                break
+            await asyncio.sleep(0.05)
+        return {client.username: client.chat_messages() for client in clients}
+    finally:
+        for client in clients:
+            await client.close()
         for task in listen_tasks:
             task.cancel()
-        await asyncio.gather(*listen_tasks, return_exceptions=True)
-
-        # 检查消息接收情况
-        print(f"Alice 收到 {len(alice.messages_received)} 条消息")
-        print(f"Bob 收到 {len(bob.messages_received)} 条消息")
-        print(f"Charlie 收到 {len(charlie.messages_received)} 条消息")
-
-        # 验证消息传递
-        success = True
-        expected_min_messages = 2  # 每个客户端至少应该收到2条消息（如果服务端不广播给自己）
-
-        if len(alice.messages_received) < expected_min_messages:
-            print(f"❌ Alice 只收到 {len(alice.messages_received)} 条消息，期望至少 {expected_min_messages} 条")
-            success = False
-        if len(bob.messages_received) < expected_min_messages:
-            print(f"❌ Bob 只收到 {len(bob.messages_received)} 条消息，期望至少 {expected_min_messages} 条")
-            success = False
-        if len(charlie.messages_received) < expected_min_messages:
-            print(f"❌ Charlie 只收到 {len(charlie.messages_received)} 条消息，期望至少 {expected_min_messages} 条")
-            success = False
-
-        if success:
-            print("✅ 基本聊天功能测试通过！")
-        else:
-            print("❌ 基本聊天功能测试失败！")
-        return success
-    finally:
-        await alice.disconnect()
-        await bob.disconnect()
-        await charlie.disconnect()
-
-async def main():
-    server_process = start_server()
-    if not server_process:
-        return
+
+
+def test_basic_chat():
+    """基本聊天功能：每个客户端都收到全部三条消息，且顺序一致"""
+    with running_server() as port:
+        received = asyncio.run(_basic_chat(port))
+    contents = None
+    for username, messages in received.items():
+        print(f"{username} 收到 {len(messages)} 条消息")
+        assert len(messages) == 3
+        if contents is None:
+            contents = [m['content'] for m in messages]
+        assert [m['content'] for m in messages] == contents
+
+
+def test_load_smoke():
+    """小规模负载：所有消息都送达房间里的每个成员"""
+    with running_server() as port:
+        result = run_load({
+            'host': 'localhost', 'port': port, 'users': 30, 'processes': 2, 'ramp': 300,
+            'rooms': 3, 'distribution': 'uniform', 'rate': 2, 'duration': 1.0, 'settle': 5.0,
+            'codec': 'json', 'seed': 0,
+        })
+    print(f"送达 {result['received']}/{result['expected']}，p99 {result['latency']['p99_ms']}ms")
+    assert result['connect_failures'] == 0
+    assert result['expected'] > 0
+    assert result['received'] == result['expected']
+
+
+async def _full_queue(policy):
+    # a paused connection, a queue of two, three frames put
+    websocket = FakeSocket()
+    queue = OutboundQueue(websocket, max_size=2, policy=policy)
+    websocket._paused = True
+    results = [queue.put('{"n":1}', key='k'), queue.put('{"n":2}'), queue.put('{"n":3}', key='k')]
+    queued = [message for _, message, _ in queue.frames]
+    websocket._paused = False
+    for _ in range(100):
+        if not queue.frames:
+            break
+        await asyncio.sleep(0.001)
+    queue.close()
+    return results, queued, queue, websocket
+
+
+def test_outbound_queue_policies():
+    """发送队列满时各策略的结果，恢复可写后按顺序写出留下的帧"""
+    results, queued, queue, websocket = asyncio.run(_full_queue(DROP_OLDEST))
+    assert results == [True, True, True]
+    assert queued == ['{"n":2}', '{"n":3}'] and queue.dropped == 1
+    assert [m['n'] for m in websocket.sent] == [2, 3]
+
+    results, queued, queue, websocket = asyncio.run(_full_queue(DROP_NEWEST))
+    assert queued == ['{"n":1}', '{"n":2}'] and queue.dropped == 1
+    assert [m['n'] for m in websocket.sent] == [1, 2]
+
+    # the third frame replaces the queued one with the same key, in its place
+    results, queued, queue, websocket = asyncio.run(_full_queue(COALESCE))
+    assert queued == ['{"n":3}', '{"n":2}'] and queue.coalesced == 1 and queue.dropped == 0
+    assert [m['n'] for m in websocket.sent] == [3, 2]
+
+    results, queued, queue, websocket = asyncio.run(_full_queue(DISCONNECT))
+    assert results[2] is False and queue.closed and queue.dropped == 3
+    assert websocket.failed[0] == 1008 and websocket.sent == []
+
+
+async def _rooms():
+    server = ChatServer(heartbeat_interval=0)
+    alice = await joined(server, 'alice', 'lobby', index=0)
+    bob = await joined(server, 'bob', 'games', index=1)
+    await server.handle_chat_message({'content': 'lobby only'}, alice)
+    await server.handle_room_change(JOIN_ROOM, {'room': 'lobby', 'history': 5}, bob)
+    await server.handle_chat_message({'content': 'both', 'room': 'lobby'}, alice)
+    await server.handle_chat_message({'content': 'games', 'room': 'games'}, bob)
+    await server.handle_chat_message({'content': 'not a member', 'room': 'games'}, alice)
+    await server.handle_room_change(SWITCH_ROOM, {'room': 'games', 'history': 0}, alice)
+    return server, alice, bob
+
+
+def test_rooms():
+    """消息只发给房间成员；join_room 回放历史后留在两个房间，switch_room 离开原来的房间"""
+    server, alice, bob = asyncio.run(_rooms())
+    assert [m['content'] for m in bob.of_type('message')] == ['lobby only', 'both', 'games']
+    assert [m['content'] for m in alice.of_type('message')] == ['lobby only', 'both']
+    assert alice.of_type('error')[-1]['message'] == "You are not in room games"
+    assert server.sessions.get_rooms(alice) == ('games',)
+    assert server.sessions.get_rooms(bob) == ('games', 'lobby')
+    assert server.sessions.get_room_members('lobby') == {bob}
+    assert server.sessions.get_room_members('games') == {alice, bob}
+
+
+async def _binary_join():
+    server = ChatServer(heartbeat_interval=0)
+    websocket = FakeSocket()
+    server.add_connection(websocket)
+    frames = []
+    write = websocket.write_frame_sync
+    websocket.write_frame_sync = lambda fin, opcode, data: (frames.append(data), write(fin, opcode, data))
+    await server.handle_join({'username': 'alice', 'codecs': ['cbor', 'binary', 'json']}, websocket)
+    await server.handle_chat_message({'content': 'hi'}, websocket)
+    return server.sessions.get(websocket).codec, frames, websocket
+
+
+def test_codec_round_trip():
+    """json / binary 编码后都能原样解回来；join 里按客户端的偏好协商编码"""
+    samples = [
+        {'type': 'message', 'username': 'alice', 'room': 'Chatroom 0', 'content': '大家好 hello',
+         'timestamp': 1714564800123, 'seq': 42, 'cursor': 7},
+        {'type': 'who', 'users': ['alice', 'bob'], 'next': None, 'total': 2, 'version': 3},
+        {'type': 'resume', 'epoch': 'ab12', 'token': 'x', 'rooms': {'a': 1, 'b': 0}, 'complete': True},
+        {'type': 'custom', 'unknown_key': -5, 'ratio': 0.25, 'big': 1 << 40, 'flag': False},
+    ]
+    for codec in (JSON_CODEC, BINARY_CODEC):
+        for data in samples:
+            assert decode_message(codec.encode(data)) == data, codec.name
+    assert negotiate(['cbor', 'binary']) is BINARY_CODEC
+    assert negotiate(['cbor']) is JSON_CODEC and negotiate(None) is JSON_CODEC
+    codec, frames, websocket = asyncio.run(_binary_join())
+    assert codec is BINARY_CODEC
+    assert frames and all(frame[0] == BINARY_MAGIC for frame in frames)
+    assert websocket.of_type('message')[-1]['content'] == 'hi'
+
+
+async def _two_nodes():
+    hub = InProcessHub()
+    servers = [ChatServer(heartbeat_interval=0, bus=InProcessBus(hub, f"node{i}")) for i in range(2)]
+    for server in servers:
+        await server.bus.start(server.handle_bus_event)
+    alice = await joined(servers[0], 'alice', index=0)
+    bob = await joined(servers[1], 'bob', index=1)
+    await asyncio.sleep(0.01)
+    await servers[0].handle_chat_message({'content': 'across'}, alice)
+    await servers[0].handle_dm({'to': 'bob', 'content': 'psst'}, alice)
+    await asyncio.sleep(0.01)
+    return servers, alice, bob
+
+
+def test_bus_between_servers():
+    """两个节点共用一条总线：房间消息和私信转发到另一个节点上的用户，在线人数按全部节点算"""
+    servers, alice, bob = asyncio.run(_two_nodes())
+    assert [m['content'] for m in bob.of_type('message')] == ['across']
+    assert [m['content'] for m in bob.of_type('dm')] == ['psst']
+    assert servers[0].cluster_count('Chatroom 0') == 2
+
+
+def test_workers_refuse_log_dir():
+    """--workers 没有共享的 cursor / seq，和 --log-dir 一起用时启动就报错"""
+    with tempfile.TemporaryDirectory() as directory:
+        result = subprocess.run([sys.executable, 'server.py', '--workers', '2', '--log-dir', directory],
+                                capture_output=True, text=True, timeout=30, cwd=REPO_ROOT)
+    assert result.returncode == 2
+    assert '--log-dir needs --workers 1' in result.stderr
+
+
+async def _persisted(directory):
+    message_log = MessageLog(directory)
+    await message_log.start()
+    server = ChatServer(heartbeat_interval=0, message_log=message_log)
+    alice = await joined(server, 'alice', index=0)
+    for content in ('one', 'two', 'three'):
+        await server.handle_chat_message({'content': content}, alice)
+    cursor = alice.of_type('message')[0]['cursor']
+    await message_log.close()
+
+    # a new process on the same log
+    message_log = MessageLog(directory)
+    await message_log.start()
+    server = ChatServer(heartbeat_interval=0, message_log=message_log)
+    bob = FakeSocket(1)
+    server.add_connection(bob)
+    await server.handle_join({'username': 'bob', 'since': cursor}, bob)
+    carol = FakeSocket(2)
+    server.add_connection(carol)
+    await server.handle_join({'username': 'carol', 'history': -1}, carol)
+    await message_log.close()
+    return server, bob, carol
+
+
+def test_log_replay_since():
+    """消息写进日志，换一个进程读同一个日志，join 带 since 只回放那个 cursor 之后的；history 不合法时什么都不登记"""
+    with tempfile.TemporaryDirectory() as directory:
+        server, bob, carol = asyncio.run(_persisted(directory))
+    assert [m['content'] for m in bob.of_type('message')] == ['two', 'three']
+    assert carol.of_type('error')[-1]['message'] == "history and since must be non-negative integers"
+    assert not server.sessions.has_user(carol) and 'carol' not in server.presence.display
+
+
+def test_history_cache_bounds():
+    """历史缓存每个房间最多 per_room 条，内存按 JSON 文本加帧计算，超过总上限时淘汰最久没用的房间"""
+    cache = HistoryCache(per_room=3, max_bytes=10 ** 6)
+    for n in range(5):
+        payload = build_message(MESSAGE, username='alice', room='a', content=f"m{n}", timestamp=1, seq=n + 1)
+        # frames for other codecs, as fanout leaves them on a broadcast payload
+        payload.frames['binary'] = (b'', b'x' * 1000)
+        cache.add('a', payload)
+    assert [p.data['content'] for p in cache.recent('a', 10)] == ['m2', 'm3', 'm4']
+    assert [p.data['seq'] for p in cache.after_seq('a', 3)] == [4, 5]
+    text = cache.recent('a', 1)[0].encode(JSON_CODEC)
+    assert cache.total_bytes < 3 * 2 * (len(text) + 10)
+    assert cache.stats()['evictions'] == 0
+    # replays reuse the cached json frame
+    assert JSON_CODEC.name in cache.recent('a', 1)[0].frames
+
+    cache.max_bytes = cache.total_bytes + 1
+    cache.add('b', build_message(MESSAGE, username='bob', room='b', content='new room', timestamp=1, seq=1))
+    assert 'a' not in cache.rooms and cache.stats()['evictions'] == 1
+    assert [p.data['content'] for p in cache.recent('b', 10)] == ['new room']
+
+
+async def _batched():
+    server = ChatServer(heartbeat_interval=0, batch_window=0.01)
+    alice = await joined(server, 'alice', index=0)
+    bob = await joined(server, 'bob', index=1)
+    for n in range(3):
+        await server.handle_chat_message({'content': f"m{n}"}, alice)
+    before = list(bob.sent)
+    await asyncio.sleep(0.05)
+    await server.handle_chat_message({'content': 'alone'}, alice)
+    await asyncio.sleep(0.05)
+    return server, before, bob
+
+
+def test_batching():
+    """窗口内同一房间的消息合并成一个 batch 帧；窗口里只有一条时照常发单条"""
+    server, before, bob = asyncio.run(_batched())
+    assert not [m for m in before if m['type'] in ('message', 'batch')]
+    batches = bob.of_type('batch')
+    assert len(batches) == 1 and batches[0]['room'] == 'Chatroom 0'
+    assert [m['content'] for m in batches[0]['messages']] == ['m0', 'm1', 'm2']
+    assert [m['content'] for m in bob.of_type('message')] == ['alone']
+    assert server.batcher.stats() == {'batches': 2, 'messages': 4, 'pending': 0}
+
+
+async def _scrape():
+    port = free_port()
+    server = ChatServer(heartbeat_interval=0, metrics_port=port)
+    await server.metrics_server.start()
+    alice = await joined(server, 'alice', index=0)
+    await joined(server, 'bob', index=1)
+    await server.handle_chat_message({'content': 'hi'}, alice)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    response = await reader.read()
+    writer.close()
+    await server.metrics_server.close()
+    return response.decode(), server.metrics.snapshot()
+
+
+def test_metrics_endpoint():
+    """/metrics 输出 Prometheus 文本格式，计数和直方图跟着广播变化"""
+    response, snapshot = asyncio.run(_scrape())
+    head, _, body = response.partition('\r\n\r\n')
+    assert head.startswith('HTTP/1.1 200 OK')
+    assert '# TYPE chat_fanout_seconds histogram' in body
+    assert 'chat_connections 2' in body
+    assert snapshot['chat_fanout_recipients_total'] >= 2
+    registry = Registry()
+    registry.counter('x_total', 'x')
     try:
-        await test_basic_chat()
-    finally:
-        server_process.terminate()
+        registry.counter('x_total', 'again')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("registered the same name twice")
+
+
+def _record(name, level, msg, *args, created=None):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    if created is not None:
+        record.created = created
+    return record
+
+
+def test_log_pipeline():
+    """日志在后台线程批量写出，队列满时丢弃并报告；重复的 warning 限流，逐条消息日志按采样保留"""
+    stream = io.StringIO()
+    pipeline = LogPipeline(stream, logging.Formatter('%(message)s'), max_queue=2)
+    for n in range(3):
+        pipeline.enqueue(_record('chatroom.server', logging.INFO, f"line {n}"))
+    pipeline.start()
+    pipeline.stop()
+    assert stream.getvalue().splitlines() == ['line 0', 'line 1', '1 log records dropped, queue full']
+    assert pipeline.stats()['dropped'] == 1
+
+    limit = RateLimitFilter(burst=2, interval=1.0)
+    passed = [limit.filter(_record('chatroom.server', logging.WARNING, "slow %s", n, created=100.0))
+              for n in range(5)]
+    assert passed == [True, True, False, False, False]
+    later = _record('chatroom.server', logging.WARNING, "slow %s", 5, created=101.5)
+    assert limit.filter(later) and later.suppressed == 3
+    assert limit.filter(_record('chatroom.server', logging.INFO, "info", created=100.0))
+
+    sample = SampleFilter(every=3)
+    kept = [sample.filter(_record(MESSAGES_LOGGER, logging.DEBUG, "m")) for _ in range(6)]
+    assert kept == [True, False, False, True, False, False]
+    assert sample.filter(_record('chatroom.server', logging.DEBUG, "other"))
+
+
+async def _idle(heartbeat):
+    heartbeat.add('idle')
+    heartbeat.add('busy')
+    heartbeat.start()
+    for _ in range(60):
+        heartbeat.touch('busy')
+        await asyncio.sleep(0.01)
+    heartbeat.stop()
+
+
+def test_heartbeat_reaps_idle():
+    """空闲的连接先收到 ping，超时后被回收；一直有活动的连接不受影响"""
+    pings, reaped = [], []
+    heartbeat = Heartbeat(interval=0.1, timeout=0.3, on_ping=pings.append, on_timeout=reaped.append, tick=0.01)
+    asyncio.run(_idle(heartbeat))
+    assert reaped == ['idle'] and 'idle' in pings
+    assert 'busy' not in pings and 'busy' in heartbeat.last_seen
+
+    wheel = TimingWheel(tick=1.0, slots=4)
+    wheel.schedule('k', 10)
+    expired = [n for n in range(1, 13) if 'k' in wheel.advance()]
+    assert expired == [10] and len(wheel) == 0
+
+
+def test_session_registry():
+    """会话和用户名、房间索引一起登记，remove() 一次清掉；用户名忽略大小写唯一"""
+    registry = SessionRegistry()
+    a, b = FakeSocket(0), FakeSocket(1)
+    registry.add(a)
+    registry.add(b)
+    assert registry.add_user(a, 'Alice', 'lobby') is not None
+    assert registry.add_user(b, 'ALICE', 'lobby') is None
+    assert registry.add_user(b, 'bob', 'lobby') is not None
+    registry.join_room(a, 'games')
+    assert registry.find('alice') is a and registry.get_rooms(a) == ('lobby', 'games')
+    assert registry.get_room_members('lobby') == {a, b} and registry.users == 2
+    session = registry.remove(a)
+    assert session.username == 'Alice' and registry.find('alice') is None
+    assert registry.get_room_members('lobby') == {b} and 'games' not in registry.rooms
+    assert registry.users == 1 and a not in registry
+    assert not hasattr(session, '__dict__')
+
+
+async def _presence():
+    server = ChatServer(heartbeat_interval=0)
+    alice = await joined(server, 'alice', index=0)
+    taken = FakeSocket(1)
+    server.add_connection(taken)
+    await server.handle_join({'username': 'ALICE'}, taken)
+    await server.handle_who({'subscribe': True}, alice)
+    bob = await joined(server, 'bob', index=2)
+    ghost = await joined(server, 'ghost', index=3)
+    await server.handle_leave({}, ghost)
+    await asyncio.sleep(0)
+    return alice, taken
+
+
+def test_presence():
+    """同名（忽略大小写）的 join 被拒绝；who 按前缀和游标分页；订阅者收到同一轮合并后的增量"""
+    alice, taken = asyncio.run(_presence())
+    assert taken.of_type('error')[-1]['message'] == "Username ALICE is already taken"
+    assert alice.of_type('who')[-1]['users'] == ['alice']
+    assert [(d['online'], d['offline']) for d in alice.of_type('presence')] == [(['bob'], [])]
+
+    index = PresenceIndex(send=None)
+    for name in ('carol', 'Bob', 'alice', 'bert', 'dave'):
+        index.add(name)
+    assert index.page(limit=2) == (['alice', 'bert'], 'bert')
+    assert index.page(after='bert', limit=2) == (['Bob', 'carol'], 'carol')
+    assert index.page(prefix='B') == (['bert', 'Bob'], None)
+
+
+async def _dms():
+    server = ChatServer(heartbeat_interval=0)
+    alice = await joined(server, 'alice', index=0)
+    bob = await joined(server, 'bob', index=1)
+    carol = await joined(server, 'carol', index=2)
+    await server.handle_dm({'to': 'BOB', 'content': 'hi bob'}, alice)
+    await server.handle_dm({'to': 'dave', 'content': 'later'}, alice)
+    dave = await joined(server, 'dave', index=3)
+    return alice, bob, carol, dave
+
+
+def test_direct_messages():
+    """私信按用户名直接投递给对方，发送者收到同一条的副本；不在线的用户 join 时从信箱收到"""
+    alice, bob, carol, dave = asyncio.run(_dms())
+    assert [(m['to'], m['content']) for m in bob.of_type('dm')] == [('BOB', 'hi bob')]
+    assert [m['content'] for m in alice.of_type('dm')] == ['hi bob', 'later']
+    assert carol.of_type('dm') == []
+    assert [m['content'] for m in dave.of_type('dm')] == ['later']
+    assert bob.of_type('dm')[0]['id'] == alice.of_type('dm')[0]['id']
+
+
+def test_rate_limiter_strikes():
+    """超限的帧被丢弃，每秒最多回一次错误；违规桶扣空后断开"""
+    limiter = RateLimiter(message_limit=(0.001, 1), byte_limit=(0, 0), strikes=3, strike_rate=0.001)
+    limits = limiter.connect()
+    verdicts = [limiter.check(limits, 10) for _ in range(6)]
+    assert verdicts == [ALLOW, REPLY, DROP, DROP, RATE_DISCONNECT, RATE_DISCONNECT]
+    assert limiter.dropped == 5 and limiter.disconnects == 2
+
+
+async def _flood(port):
+    async with websockets.connect(f"ws://localhost:{port}") as websocket:
+        await websocket.send(json.dumps({'type': 'join', 'username': 'flooder'}))
+        for n in range(20):
+            await websocket.send(json.dumps({'type': 'message', 'content': f"spam {n}"}))
+        errors = []
+        try:
+            async for raw in websocket:
+                message = json.loads(raw)
+                if message.get('type') == 'error':
+                    errors.append(message['message'])
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        return errors, websocket.close_code
+
+
+def test_rate_limit_disconnects():
+    """服务端：持续超限的连接收到限流错误，然后被以 1008 断开"""
+    with running_server('--rate-limit', '1/2', '--rate-strikes', '3') as port:
+        errors, code = asyncio.run(asyncio.wait_for(_flood(port), 10))
+    assert len(errors) == 1 and 'rate' in errors[0].lower()
+    assert code == 1008
+
+
+async def _mux_limits():
+    limiter = RateLimiter((100, 100), (10 ** 6, 10 ** 6), user_message_limit=(0.001, 2), strikes=100)
+    server = ChatServer(heartbeat_interval=0, rate_limiter=limiter)
+    websocket = FakeSocket()
+    server.add_connection(websocket)
+
+    async def send(data):
+        # what the connection handler does before handing the frame over
+        raw = json.dumps(data)
+        assert limiter.check(server.sessions.get(websocket).limits, len(raw)) is ALLOW
+        await server.handle_message(raw, websocket)
+
+    for channel in (1, 2):
+        await send({'type': 'join', 'username': f"bot{channel}", 'ch': channel})
+    for n in range(4):
+        await send({'type': 'message', 'content': f"one {n}", 'ch': 1})
+    await send({'type': 'message', 'content': 'two', 'ch': 2})
+    return websocket
+
+
+def test_rate_limit_per_channel_user():
+    """多路复用连接上的每个用户各按自己的用户级限额扣，超限的只丢这个用户的帧"""
+    websocket = asyncio.run(_mux_limits())
+    contents = [m['content'] for m in websocket.of_type('message')]
+    assert contents == ['one 0', 'one 1', 'two']
+    errors = websocket.of_type('error')
+    assert len(errors) == 1 and errors[0]['ch'] == 1 and 'rate' in errors[0]['message'].lower()
+
+
+def test_zjson():
+    """zjson 用共享字典压缩，首字节是 ZJSON_MAGIC；普通消息不到 JSON 的一半，损坏的帧解码报错"""
+    data = {'type': 'message', 'username': 'alice', 'room': 'Chatroom 0', 'content': 'hello there',
+            'timestamp': 1714564800123, 'seq': 42}
+    frame = ZJSON_CODEC.encode(data)
+    assert frame[0] == ZJSON_MAGIC and decode_message(frame) == data
+    assert len(frame) < len(JSON_CODEC.encode(data)) // 2
+    for broken in (frame[:-3], bytes([ZJSON_MAGIC]) + b'\xff' * 8):
+        try:
+            decode_message(broken)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"decoded {broken!r}")
+
+
+async def _resume_after_gap():
+    server = ChatServer(heartbeat_interval=0)
+    alice = await joined(server, 'alice', index=0)
+    bob = await joined(server, 'bob', index=1)
+    await server.handle_chat_message({'content': 'one'}, alice)
+    session = bob.of_type('resume')[-1]
+    seen = bob.of_type('message')[-1]['seq']
+    # bob's connection dies, two messages go by
+    server.remove_connection(bob)
+    await server.handle_chat_message({'content': 'two'}, alice)
+    await server.handle_chat_message({'content': 'three'}, alice)
+    again = FakeSocket(2)
+    server.add_connection(again)
+    await server.handle_resume({'username': 'bob', 'room': 'Chatroom 0', 'rooms': {'Chatroom 0': seen},
+                                'epoch': session['epoch'], 'token': session['token']}, again)
+    await server.handle_chat_message({'content': 'four'}, alice)
+    return seen, again.sent
+
+
+def test_resume_replays_gap():
+    """续连从客户端最后看到的 seq 之后补发，不重复也不遗漏，之后照常收消息"""
+    seen, sent = asyncio.run(_resume_after_gap())
+    assert sent[0]['type'] == 'resume' and sent[0]['complete'] is True
+    assert sent[0]['rooms'] == {'Chatroom 0': seen}
+    messages = [m for m in sent if m['type'] == 'message']
+    assert [m['content'] for m in messages] == ['two', 'three', 'four']
+    assert [m['seq'] for m in messages] == [seen + 1, seen + 2, seen + 3]
+
+
+async def _stamps():
+    clock = Clock()
+    first = [clock.stamp('a'), clock.stamp('b')]
+    reads = clock.reads
+    await asyncio.sleep(0.002)
+    later = clock.stamp('a')
+    clock.last['a'] = later + 60000  # as if the system clock was set back a minute
+    await asyncio.sleep(0)
+    again = clock.stamp('a')
+    return first, reads, later, again, clock
+
+
+def test_clock():
+    """同一轮事件循环只读一次系统时间；系统时间往回调时房间里的时间戳不倒退"""
+    first, reads, later, again, clock = asyncio.run(_stamps())
+    assert first[0] == first[1] and reads == 1
+    assert later > first[0]
+    assert again == later + 60000
+    assert Clock(iso=True).format(1714564800123).startswith('2024-05-0')
+
+
+async def _upload_out_of_order(directory):
+    server = ChatServer(heartbeat_interval=0, file_dir=directory)
+    alice = await joined(server, 'alice', index=0)
+    bob = await joined(server, 'bob', index=1)
+    await server.handle_file_offer({'name': 'notes.txt', 'size': 10}, alice)
+    file_id = alice.of_type('file_offer')[-1]['id']
+
+    async def chunk(offset, data):
+        # what the connection handler does: chunks not taken go the normal way
+        raw = chunk_header(file_id, offset) + data
+        if not await server.handle_chunk(raw, alice):
+            await server.handle_message(raw, alice)
+
+    await chunk(0, b'hello')
+    await chunk(8, b'ld')  # a chunk went missing
+    await chunk(9, b'd')   # and the rest of the window after it
+    acks = [m['offset'] for m in alice.of_type('file_ack')]
+    await chunk(5, b'world')
+    stored = server.files.get(file_id)
+    with open(stored.path, 'rb') as f:
+        content = f.read()
+    return acks, content, bob.of_type('file')
+
+
+def test_upload_out_of_order_chunk():
+    """乱序的数据块不写入，只回一次 file_ack 告诉客户端从哪里续传；续上之后上传完成并通知房间"""
+    with tempfile.TemporaryDirectory() as directory:
+        acks, content, announced = asyncio.run(_upload_out_of_order(directory))
+    assert acks == [5]
+    assert content == b'helloworld'
+    assert len(announced) == 1 and announced[0]['name'] == 'notes.txt' and announced[0]['size'] == 10
+
+
+def test_verify_token():
+    """签名、篡改、过期和格式错误的令牌"""
+    secret = b'test-secret'
+    now = 1_700_000_000
+    token = issue_token(secret, 'alice', ttl=60, now=now)
+    assert verify_token(secret, token, now=now + 1) == ('alice', now + 60)
+    body, _, signature = token.partition('.')
+    forged = issue_token(secret, 'mallory', ttl=60, now=now).partition('.')[0] + '.' + signature
+    cases = [
+        (issue_token(b'other-secret', 'alice', ttl=60, now=now), "Invalid token"),
+        (forged, "Invalid token"),
+        (body, "Invalid token"),
+        ('not a token', "Invalid token"),
+        ('', "Invalid token"),
+        (token, "Token expired"),
+    ]
+    for bad, reason in cases:
+        try:
+            verify_token(secret, bad, now=now + 60)
+        except AuthError as e:
+            assert str(e) == reason, (bad, e)
+        else:
+            raise AssertionError(f"accepted {bad!r}")
+
+
+async def _sdk(port):
+    async with ChatSDK('localhost', port) as sdk:
+        alice = await sdk.join('alice', room='lobby')
+        bob = await sdk.join('bob', room='lobby')
+        try:
+            await sdk.join('ALICE', room='lobby')
+        except SDKError as e:
+            refused = str(e)
+        else:
+            refused = None
+        ack = await alice.send('hello')
+        received = None
+        async for event in sdk:
+            if event.type == MESSAGE and event.user is bob:
+                received = (event.username, event.content, event.seq)
+                break
+        return len(sdk.connections), ack, received, refused
+
+
+def test_sdk_multiplexing():
+    """SDK 在一条连接上承载多个用户：请求按 ack 确认，房间消息分发给这条连接上的每个用户"""
+    with running_server() as port:
+        connections, ack, received, refused = asyncio.run(asyncio.wait_for(_sdk(port), 10))
+    assert connections == 1
+    assert received == ('alice', 'hello', ack['seq'])
+    assert 'already taken' in refused
+
+
+async def _search(directory):
+    message_log = MessageLog(directory)
+    await message_log.start()
+    server = ChatServer(heartbeat_interval=0, message_log=message_log, search=True)
+    await server.search_index.start()
+    alice = await joined(server, 'alice', 'lobby', index=0)
+    bob = await joined(server, 'bob', 'games', index=1)
+    await server.handle_chat_message({'content': 'the deploy is done'}, alice)
+    await server.handle_chat_message({'content': 'lunch?'}, alice)
+    await server.handle_chat_message({'content': 'Deploy failed again'}, bob)
+    await server.handle_search({'query': 'deploy'}, alice)
+    await server.handle_search({'query': 'deploy', 'room': 'games'}, alice)
+    await server.handle_search({'query': 'deploy', 'limit': 1}, alice)
+    await server.handle_search({'query': 'deploy', 'start': -1}, alice)
+    await server.search_index.close()
+    await message_log.close()
+    return alice.of_type('search'), alice.of_type('error')
+
+
+def test_search():
+    """按词搜索存储的消息，新的在前；可以限定房间、分页；参数不合法时回 error"""
+    with tempfile.TemporaryDirectory() as directory:
+        pages, errors = asyncio.run(_search(directory))
+    everything, games, first = pages
+    assert [r['content'] for r in everything['results']] == ['Deploy failed again', 'the deploy is done']
+    assert [r['username'] for r in games['results']] == ['bob']
+    assert len(first['results']) == 1 and first['next'] is not None
+    assert errors[-1]['message'] == "Search start, end and before must be integers"
+
+
+async def _restart_with_snapshot(path):
+    old = ChatServer(heartbeat_interval=0)
+    alice = await joined(old, 'alice')
+    for content in ('one', 'two', 'three'):
+        await old.handle_chat_message({'content': content}, alice)
+    session = alice.of_type('resume')[-1]
+    await old.drain(restart=True)
+    state = old.snapshot()
+    write_snapshot(path, state)
+
+    new = ChatServer(heartbeat_interval=0)
+    new.restore(read_snapshot(path))
+    again = FakeSocket(1)
+    new.add_connection(again)
+    await new.handle_resume({'username': 'alice', 'room': 'Chatroom 0', 'rooms': {'Chatroom 0': 1},
+                             'epoch': session['epoch'], 'token': session['token']}, again)
+    await new.handle_chat_message({'content': 'four'}, again)
+    return state, old, new, alice, again
+
+
+def test_snapshot_restore():
+    """热重启：快照写出再读回，新进程接上 epoch、seq、续连令牌和最近消息"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'state.snapshot')
+        state, old, new, alice, again = asyncio.run(_restart_with_snapshot(path))
+        assert read_snapshot(path) == json.loads(json.dumps(state))
+    assert alice.failed[0] == 1012
+    assert state['room_seqs'] == {'Chatroom 0': 3}
+    assert new.epoch == old.epoch and new.room_seqs == {'Chatroom 0': 4}
+    assert not new.restored  # alice came back with the resume token
+    assert again.sent[0]['complete'] is True
+    messages = again.of_type('message')
+    assert [(m['content'], m['seq']) for m in messages] == [('two', 2), ('three', 3), ('four', 4)]
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    test_basic_chat()
+    test_load_smoke()
+    test_outbound_queue_policies()
+    test_rooms()
+    test_codec_round_trip()
+    test_bus_between_servers()
+    test_workers_refuse_log_dir()
+    test_log_replay_since()
+    test_history_cache_bounds()
+    test_batching()
+    test_metrics_endpoint()
+    test_log_pipeline()
+    test_heartbeat_reaps_idle()
+    test_session_registry()
+    test_presence()
+    test_direct_messages()
+    test_rate_limiter_strikes()
+    test_rate_limit_disconnects()
+    test_rate_limit_per_channel_user()
+    test_zjson()
+    test_resume_replays_gap()
+    test_clock()
+    test_upload_out_of_order_chunk()
+    test_verify_token()
+    test_sdk_multiplexing()
+    test_search()
+    test_snapshot_restore()
+    print("✅ 测试通过")